@@ -1,9 +1,12 @@
+import atexit
 import logging
 
 import app.settings
 
 from structlog import wrap_logger
 
+from app.logs import QueuedLogging, SeftBoundLogger
+
 
 __version__ = "2.6.0"
 
@@ -13,8 +16,14 @@ logging.basicConfig(format=app.settings.LOGGING_FORMAT,
                     datefmt="%Y-%m-%dT%H:%M:%S",
                     level=app.settings.LOGGING_LEVEL)
 
+app.logs.sample_every = app.settings.LOGGING_SAMPLE_EVERY
+if app.settings.LOGGING_QUEUE_SIZE:
+    queued_logging = QueuedLogging(app.settings.LOGGING_QUEUE_SIZE)
+    queued_logging.start()
+    atexit.register(queued_logging.stop)
+
 
 def create_and_wrap_logger(logger_name):
-    logger = wrap_logger(logging.getLogger(logger_name))
+    logger = wrap_logger(logging.getLogger(logger_name), wrapper_class=SeftBoundLogger)
     logger.info("START", version=__version__)
     return logger
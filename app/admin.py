@@ -0,0 +1,278 @@
+"""Admin endpoints, only served when ADMIN_TOKEN is set and only to requests that present it.
+
+`server.start(0)` forks a process per CPU and any one of them may get a request, so each registers
+its pid in ADMIN_RUN_DIR. An endpoint that needs every process writes a request file there and sends
+the others SIGUSR2; they pick it up on their io loops and write their results back alongside it.
+"""
+import atexit
+import collections
+import hmac
+import json
+import os
+import signal
+import time
+import uuid
+
+import tornado.ioloop
+from tornado import gen
+from tornado.web import HTTPError, RequestHandler
+
+from app import create_and_wrap_logger
+from app import settings
+from app import profiling
+from app import tuning
+
+logger = create_and_wrap_logger(__name__)
+
+SIGNAL = signal.SIGUSR2
+
+
+def _start_time(pid):
+    """When the process started, to tell a registered pid from a later process that reused it."""
+    try:
+        with open("/proc/{}/stat".format(pid)) as stat:
+            return stat.read().rsplit(")", 1)[1].split()[19]
+    except (IOError, IndexError):
+        return ""
+
+
+class ProcessRegistry:
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.processes = os.path.join(directory, "processes")
+        self.requests = os.path.join(directory, "requests")
+        self.results = os.path.join(directory, "results")
+
+    def register(self):
+        for directory in (self.processes, self.requests, self.results):
+            os.makedirs(directory, exist_ok=True)
+        _write(os.path.join(self.processes, str(os.getpid())), _start_time(os.getpid()))
+
+    def unregister(self):
+        try:
+            os.remove(os.path.join(self.processes, str(os.getpid())))
+        except FileNotFoundError:
+            pass
+
+    def pids(self):
+        """Registered pids that are still running, forgetting any that aren't."""
+        pids = []
+        for name in os.listdir(self.processes) if os.path.isdir(self.processes) else []:
+            path = os.path.join(self.processes, name)
+            try:
+                with open(path) as registered:
+                    started = registered.read()
+                pid = int(name)
+                os.kill(pid, 0)
+                if started != _start_time(pid):
+                    raise ProcessLookupError()
+                pids.append(pid)
+            except (ValueError, ProcessLookupError, FileNotFoundError):
+                _remove(path)
+            except PermissionError:
+                # Not ours, so it can't be one of our workers
+                _remove(path)
+        return pids
+
+    def broadcast(self, request):
+        """Asks every other registered process to handle `request`, returning its id and their pids."""
+        request_id = uuid.uuid4().hex
+        _write(os.path.join(self.requests, request_id + ".json"), json.dumps(request))
+        pids = [pid for pid in self.pids() if pid != os.getpid()]
+        for pid in pids:
+            try:
+                os.kill(pid, SIGNAL)
+            except ProcessLookupError:
+                pass
+        return request_id, pids
+
+    def pending(self, handled):
+        for name in sorted(os.listdir(self.requests)):
+            request_id = name[:-len(".json")]
+            if name.endswith(".json") and request_id not in handled:
+                try:
+                    with open(os.path.join(self.requests, name)) as request:
+                        yield request_id, json.load(request)
+                except (FileNotFoundError, ValueError):
+                    continue
+
+    def reply(self, request_id, result):
+        _write(os.path.join(self.results, "{}.{}.json".format(request_id, os.getpid())), json.dumps(result))
+
+    def replies(self, request_id, pids):
+        """The results written so far for `request_id`, by pid."""
+        replies = {}
+        for pid in pids:
+            try:
+                with open(os.path.join(self.results, "{}.{}.json".format(request_id, pid))) as reply:
+                    replies[pid] = json.load(reply)
+            except (FileNotFoundError, ValueError):
+                continue
+        return replies
+
+    def forget(self, request_id, pids):
+        _remove(os.path.join(self.requests, request_id + ".json"))
+        for pid in pids:
+            _remove(os.path.join(self.results, "{}.{}.json".format(request_id, pid)))
+
+
+def _write(path, contents):
+    # Readers poll for these files, so they must never see one half written
+    temporary = "{}.{}.tmp".format(path, os.getpid())
+    with open(temporary, "w") as written:
+        written.write(contents)
+    os.replace(temporary, path)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+registry = ProcessRegistry(settings.ADMIN_RUN_DIR)
+_handled = collections.deque(maxlen=100)
+
+
+def enable():
+    """Registers this process to take part in admin requests. Call in each forked process."""
+    registry.register()
+    atexit.register(registry.unregister)
+    signal.signal(SIGNAL, _on_signal)
+    logger.info("Admin endpoints enabled", pid=os.getpid())
+
+
+def _on_signal(signum, frame):
+    tornado.ioloop.IOLoop.current().add_callback_from_signal(_serve_requests)
+
+
+def _serve_requests():
+    ioloop = tornado.ioloop.IOLoop.current()
+    for request_id, request in registry.pending(_handled):
+        _handled.append(request_id)
+        if request["kind"] == "settings":
+            # Listeners resize pools pika and the admission controller use, so run on the io loop
+            registry.reply(request_id, _apply_settings(request["changes"]))
+        else:
+            ioloop.run_in_executor(None, _serve, request_id, request)
+
+
+def _apply_settings(changes):
+    try:
+        return {"pid": os.getpid(), "settings": tuning.apply(changes)}
+    except ValueError as e:
+        return {"pid": os.getpid(), "error": str(e)}
+
+
+def _serve(request_id, request):
+    try:
+        result = profiling.profile(request["kind"], request["seconds"], request["limit"])
+    except profiling.ProfilerBusy:
+        result = {"pid": os.getpid(), "error": "a profile is already running"}
+    registry.reply(request_id, result)
+
+
+async def _collect(request_id, pids, grace=10):
+    # The others started at the same time as us, so give them a little longer to write back
+    end = time.monotonic() + grace
+    replies = registry.replies(request_id, pids)
+    while len(replies) < len(pids) and time.monotonic() < end:
+        await gen.sleep(0.1)
+        replies = registry.replies(request_id, pids)
+    return replies
+
+
+class AdminHandler(RequestHandler):
+    """Base for admin endpoints, which need `Authorization: Bearer <ADMIN_TOKEN>`."""
+
+    def prepare(self):
+        token = settings.ADMIN_TOKEN
+        supplied = self.request.headers.get("Authorization", "")
+        if not token or not hmac.compare_digest(supplied.encode(), "Bearer {}".format(token).encode()):
+            raise HTTPError(403)
+
+    def write_error(self, status_code, **kwargs):
+        self.finish({"error": self._reason})
+
+
+class SettingsHandler(AdminHandler):
+    """Shows and changes the settings that can be tuned at runtime.
+
+       GET returns this process's values. POST a JSON object of settings to change, which is
+       applied to every process (or only this one with `?scope=process`) and returns the values
+       each process has afterwards."""
+
+    def get(self):
+        self.write({"pid": os.getpid(), "settings": tuning.values()})
+
+    async def post(self):
+        scope = self.get_query_argument("scope", "all")
+        if scope not in ("all", "process"):
+            raise HTTPError(400, reason="unknown scope")
+        try:
+            changes = tuning.validate(json.loads(self.request.body or b"null"))
+        except ValueError as e:
+            raise HTTPError(400, reason=str(e))
+
+        local = _apply_settings(changes)
+        request_id, pids = None, []
+        if scope == "all":
+            request_id, pids = registry.broadcast({"kind": "settings", "changes": changes})
+        try:
+            replies = await _collect(request_id, pids, grace=5) if pids else {}
+        finally:
+            if request_id:
+                registry.forget(request_id, pids)
+        self.write({"processes": [local] + [replies[pid] for pid in pids if pid in replies],
+                    "missing": [pid for pid in pids if pid not in replies]})
+
+
+class ProfileHandler(AdminHandler):
+    """Profiles the service for `seconds` and returns the result.
+
+       `kind=cpu` samples stacks and returns them collapsed (`format=collapsed`, for flamegraph
+       tools) or as JSON per process; `kind=memory` returns the `limit` call sites whose allocations
+       grew most. `scope=all` (the default) profiles every process, `scope=process` only this one."""
+
+    async def get(self):
+        kind = self.get_query_argument("kind", "cpu")
+        scope = self.get_query_argument("scope", "all")
+        output = self.get_query_argument("format", "collapsed" if kind == "cpu" else "json")
+        try:
+            seconds = float(self.get_query_argument("seconds", "10"))
+            limit = int(self.get_query_argument("limit", "50"))
+        except ValueError:
+            raise HTTPError(400, reason="seconds and limit must be numbers")
+        if kind not in profiling.KINDS or scope not in ("all", "process") or output not in ("json", "collapsed"):
+            raise HTTPError(400, reason="unknown kind, scope or format")
+        if output == "collapsed" and kind != "cpu":
+            raise HTTPError(400, reason="only cpu profiles can be collapsed")
+        if not 0 < seconds <= settings.ADMIN_PROFILE_MAX_SECONDS:
+            raise HTTPError(400, reason="seconds must be between 0 and {}".format(settings.ADMIN_PROFILE_MAX_SECONDS))
+
+        request_id, pids = None, []
+        if scope == "all":
+            request_id, pids = registry.broadcast({"kind": kind, "seconds": seconds, "limit": limit})
+        try:
+            try:
+                local = await tornado.ioloop.IOLoop.current().run_in_executor(None, profiling.profile,
+                                                                              kind, seconds, limit)
+            except profiling.ProfilerBusy:
+                raise HTTPError(409, reason="a profile is already running")
+            replies = await _collect(request_id, pids) if pids else {}
+        finally:
+            if request_id:
+                registry.forget(request_id, pids)
+
+        results = [local] + [replies[pid] for pid in pids if pid in replies]
+        missing = [pid for pid in pids if pid not in replies]
+        if output == "collapsed":
+            stacks = collections.Counter()
+            for result in results:
+                stacks.update(result.get("stacks", {}))
+            self.set_header("Content-Type", "text/plain")
+            self.write("".join("{} {}\n".format(stack, count) for stack, count in stacks.most_common()))
+        else:
+            self.write({"processes": results, "missing": missing})
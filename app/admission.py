@@ -0,0 +1,100 @@
+import collections
+import time
+
+from app import create_and_wrap_logger
+from app.metrics import metrics
+
+logger = create_and_wrap_logger(__name__)
+
+Waiting = collections.namedtuple('Waiting', 'estimate queued start')
+
+
+class AdmissionController:
+    """Decides when a delivered message may start processing.
+
+       Each message reserves an estimate of the memory it will need before it is decrypted, and
+       is only started while the total reserved stays within `budget_bytes` and fewer than
+       `max_in_flight` messages are being processed. Messages that don't fit wait; smaller
+       messages queued behind them can still start if they fit, unless the message at the front
+       has been waiting for more than `max_bypass_wait` seconds, at which point it goes next.
+
+       A message bigger than the whole budget is started on its own once nothing else is
+       reserved. A budget of 0 disables the memory check.
+
+       Not thread safe, everything is called from the io loop."""
+
+    def __init__(self, budget_bytes, max_in_flight, max_bypass_wait=30, clock=time.monotonic):
+        self.budget_bytes = budget_bytes
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_bypass_wait = max_bypass_wait
+        self.reserved_bytes = 0
+        self.in_flight = 0
+        self._clock = clock
+        self._waiting = []
+        self._publish_metrics()
+
+    @property
+    def waiting(self):
+        return len(self._waiting)
+
+    def submit(self, estimate, start):
+        """Calls `start` once there is room for a message needing `estimate` bytes."""
+        self._waiting.append(Waiting(estimate=estimate, queued=self._clock(), start=start))
+        self._admit()
+
+    def release(self, estimate, slot=True):
+        """Returns the reservation of a message that has finished processing.
+
+        `slot` is False if the message already gave up its processing slot with `release_slot`.
+        """
+        self.reserved_bytes -= estimate
+        if slot:
+            self.in_flight -= 1
+        self._admit()
+
+    def release_slot(self):
+        """Lets another message start while this one, still holding its memory, waits elsewhere."""
+        self.in_flight -= 1
+        self._admit()
+
+    def set_max_in_flight(self, max_in_flight):
+        """Changes how many messages may be processed at once, starting waiting ones if it went up."""
+        self.max_in_flight = max(1, max_in_flight)
+        self._admit()
+
+    def clear(self):
+        """Forgets the messages waiting to start, returning how many there were."""
+        cleared, self._waiting = len(self._waiting), []
+        self._publish_metrics()
+        return cleared
+
+    def _fits(self, estimate):
+        return not self.budget_bytes or not self.reserved_bytes or self.reserved_bytes + estimate <= self.budget_bytes
+
+    def _admit(self):
+        now = self._clock()
+        index = 0
+        while index < len(self._waiting) and self.in_flight < self.max_in_flight:
+            waiting = self._waiting[index]
+            if self._fits(waiting.estimate):
+                del self._waiting[index]
+                self.reserved_bytes += waiting.estimate
+                self.in_flight += 1
+                metrics.observe("admission.wait", now - waiting.queued)
+                waiting.start()
+                continue
+            if index == 0 and now - waiting.queued > self.max_bypass_wait:
+                break
+            index += 1
+
+        if self._waiting and self.in_flight < self.max_in_flight:
+            logger.debug("Memory budget exhausted, deliveries waiting", waiting=len(self._waiting),
+                         reserved_bytes=self.reserved_bytes, budget_bytes=self.budget_bytes)
+        self._publish_metrics()
+
+    def _publish_metrics(self):
+        metrics.set_gauge("admission.budget_bytes", self.budget_bytes)
+        metrics.set_gauge("admission.reserved_bytes", self.reserved_bytes)
+        metrics.set_gauge("admission.in_flight", self.in_flight)
+        metrics.set_gauge("admission.max_in_flight", self.max_in_flight)
+        metrics.set_gauge("admission.waiting", len(self._waiting))
@@ -1,36 +1,112 @@
 import collections
-import time
+import os
+import threading
 
 import requests
 from requests.adapters import HTTPAdapter
 from sdc.rabbit.exceptions import QuarantinableError, RetryableError, BadMessageError
+from urllib3.exceptions import NewConnectionError
 
 from app import create_and_wrap_logger
 from app import settings
+from app import tuning
+from app.deadline import NO_DEADLINE
+from app.logs import Lazy
+from app.metrics import metrics
+from app.ratelimit import AIMDLimiter, SharedTokenBucket
+from app.timeline import NO_TIMELINE
 
 logger = create_and_wrap_logger(__name__)
 
+# Every scan in the process shares these; the request rate is also shared with the other processes
+rate_limiter = SharedTokenBucket(settings.ANTI_VIRUS_RATE_LIMIT_FILE, settings.ANTI_VIRUS_RATE_LIMIT)
+concurrency = AIMDLimiter(settings.ANTI_VIRUS_MAX_IN_FLIGHT, minimum=settings.ANTI_VIRUS_MIN_IN_FLIGHT)
+tuning.listen("ANTI_VIRUS_RATE_LIMIT", rate_limiter.set_rate)
+tuning.listen("ANTI_VIRUS_MAX_IN_FLIGHT",
+              lambda maximum: concurrency.set_bounds(maximum, settings.ANTI_VIRUS_MIN_IN_FLIGHT))
+tuning.listen("ANTI_VIRUS_MIN_IN_FLIGHT",
+              lambda minimum: concurrency.set_bounds(settings.ANTI_VIRUS_MAX_IN_FLIGHT, minimum))
+
 AVResult = collections.namedtuple('AVResult', 'safe ready scan_results')
 
+# Requests that can't reach the A/V service are retried this many times, backing off from
+# CONNECT_RETRY_WAIT seconds up to CONNECT_RETRY_MAX_WAIT, for as long as the message's deadline allows
+CONNECT_RETRIES = 15
+CONNECT_RETRY_WAIT = 0.1
+CONNECT_RETRY_MAX_WAIT = 2.0
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def shared_session():
+    """The process's session for the A/V service, so scans reuse its pooled TLS connections."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            if settings.ANTI_VIRUS_CA_CERT:
+                session.verify = settings.ANTI_VIRUS_CA_CERT
+            # No retries in the adapter: AntiVirusCheck retries connections itself, within the deadline
+            session.mount(settings.ANTI_VIRUS_BASE_URL,
+                          HTTPAdapter(pool_maxsize=max(1, settings.ANTI_VIRUS_MAX_IN_FLIGHT)))
+            _session = session
+        return _session
+
+
+def _forget_session():
+    # A forked process must not share the parent's sockets
+    global _session
+    _session = None
+
+
+os.register_at_fork(after_in_child=_forget_session)
+
+
+def warm(timeout=10):
+    """Opens a connection to the A/V service, so the first scan doesn't pay for the TLS handshake.
+
+    Any response will do; only a failure to connect raises, and the connection isn't retried.
+    """
+    shared_session().head(settings.ANTI_VIRUS_BASE_URL, timeout=timeout)
+
+
+def _connect_failed(error):
+    """Whether a requests ConnectionError happened before the connection was made."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
 
 class AntiVirusCheck:
     def __init__(self, tx_id):
         self.bound_logger = logger.bind(tx_id=tx_id)
-        self.session = requests.Session()
-        if settings.ANTI_VIRUS_CA_CERT:
-            self.session.verify = settings.ANTI_VIRUS_CA_CERT
-        self.session.mount(settings.ANTI_VIRUS_BASE_URL, HTTPAdapter(max_retries=15))
+        self.session = shared_session()
 
-    def send_for_av_scan(self, payload):
+    def send_for_av_scan(self, payload, deadline=NO_DEADLINE, timeline=NO_TIMELINE):
         """Sends the file to the anti-virus service to be scanned.
         This function is blocking as it repeatedly checks every few seconds (as defined by
         the ANTI_VIRUS_WAIT_TIME variable) to see if the scan is done, only proceeding once it's
         complete.
 
-        Raises a QuarantinableError if the file is deemed not safe.
+        Raises a QuarantinableError if the file is deemed not safe, and DeadlineExceeded if
+        `deadline` passes before the scan completes.
         """
+        with metrics.timer("anti_virus.concurrency_wait"):
+            if not concurrency.acquire(timeout=deadline.remaining()):
+                deadline.check("anti_virus")
+        self._publish_concurrency()
+        try:
+            return self._scan(payload, deadline, timeline)
+        finally:
+            concurrency.release()
+            self._publish_concurrency()
+
+    def _scan(self, payload, deadline, timeline):
         self.bound_logger.info("Sending for AV check", filename=payload.file_name)
-        data_id = self._send_for_anti_virus_check(payload.file_name, payload.decoded_contents)
+        with timeline.stage("anti_virus_submit"), payload.contents() as contents:
+            data_id = self._send_for_anti_virus_check(payload.file_name, contents, deadline)
         self.bound_logger.info("Sent for A/V check", data_id=data_id)
 
         # this loop will block the consumer until the anti virus finishes
@@ -39,10 +115,12 @@ class AntiVirusCheck:
         attempts = 0
         while attempts <= settings.ANTI_VIRUS_MAX_ATTEMPTS:
             attempts += 1
-            results = self._get_anti_virus_result(data_id)
+            timeline.note(av_attempts=attempts)
+            results = self._get_anti_virus_result(data_id, deadline)
             if not results.ready:
-                self.bound_logger.info("Results not ready", attempts=attempts, case_id=payload.case_id, filename=payload.file_name)
-                time.sleep(settings.ANTI_VIRUS_WAIT_TIME)
+                self.bound_logger.info("Results not ready", attempts=attempts, case_id=payload.case_id, filename=payload.file_name,
+                                       _sample=data_id)
+                deadline.sleep(settings.ANTI_VIRUS_WAIT_TIME, "anti_virus poll")
             elif not results.safe:
                 self._write_scan_report(results, payload.file_name)
                 self.bound_logger.error("Unsafe file detected", case_id=payload.case_id, filename=payload.file_name)
@@ -65,9 +143,45 @@ class AntiVirusCheck:
             self.bound_logger.debug("Setting A/V API key")
             headers['apikey'] = settings.ANTI_VIRUS_API_KEY
 
-    def _check_av_response(self, response):
+    @staticmethod
+    def _publish_concurrency():
+        metrics.set_gauge("anti_virus.in_flight", concurrency.in_flight)
+        metrics.set_gauge("anti_virus.concurrency_limit", concurrency.limit)
+
+    def _throttle(self):
+        with metrics.timer("anti_virus.rate_wait"):
+            rate_limiter.acquire()
+
+    def _overloaded(self):
+        metrics.increment("anti_virus.overloaded")
+        if concurrency.on_overload():
+            self.bound_logger.warning("Reduced A/V scans in flight", limit=concurrency.limit)
+            self._publish_concurrency()
+
+    def _request(self, method, url, deadline, stage, data=None, **kwargs):
+        """Sends a request, retrying while the deadline allows if the A/V service can't be reached.
+
+        Only a failure to connect is retried for a POST, as otherwise the file may have been
+        received; a GET is also retried if the connection drops before the response.
+        """
+        attempts = 0
+        while True:
+            try:
+                return self.session.request(method, url, data=data, timeout=deadline.timeout(stage), **kwargs)
+            except requests.ConnectionError as e:
+                if attempts >= CONNECT_RETRIES or not (method == "GET" or _connect_failed(e)):
+                    raise
+            attempts += 1
+            metrics.increment("anti_virus.connect_retries")
+            self.bound_logger.warning("Unable to reach A/V service, retrying", attempts=attempts, stage=stage)
+            deadline.sleep(min(CONNECT_RETRY_WAIT * 2 ** (attempts - 1), CONNECT_RETRY_MAX_WAIT), stage)
+            if hasattr(data, "seek"):
+                data.seek(0)
+
+    def _check_av_response(self, response, deadline=NO_DEADLINE):
         try:
             response.raise_for_status()
+            concurrency.on_success()
         except requests.HTTPError:
             self.bound_logger.exception("Error received for A/V server", status_code=response.status_code)
             if response.status_code == 401:
@@ -75,6 +189,7 @@ class AntiVirusCheck:
                 raise RetryableError()
             elif response.status_code == 403:
                 self.bound_logger.warning("OPSWAT API Rejected request may have hit usage limit - unable to continue")
+                self._overloaded()
                 raise RetryableError()
             elif response.status_code == 404:
                 # this could mean that the primary A/V server has failed and we've failed over to the backup
@@ -86,13 +201,14 @@ class AntiVirusCheck:
                 raise RetryableError()
             elif response.status_code == 503:
                 self.bound_logger.warning("OPSWAT server busy - waiting before retrying")
-                time.sleep(settings.ANTI_VIRUS_WAIT_TIME)
+                self._overloaded()
+                deadline.sleep(settings.ANTI_VIRUS_WAIT_TIME, "anti_virus")
                 raise RetryableError()
             else:
                 self.bound_logger.warning("Unexpected error from OPSWAT API")
                 raise BadMessageError()
 
-    def _send_for_anti_virus_check(self, filename, contents):
+    def _send_for_anti_virus_check(self, filename, contents, deadline=NO_DEADLINE):
         url = settings.ANTI_VIRUS_BASE_URL
         headers = {
             "filename": filename,
@@ -102,15 +218,16 @@ class AntiVirusCheck:
         self._add_api_key(headers)
 
         self.bound_logger.info("Sending for A/V scan", url=url)
+        self._throttle()
         try:
-            response = self.session.post(url=url, headers=headers, data=contents)
+            response = self._request("POST", url, deadline, "anti_virus submit", headers=headers, data=contents)
         except requests.RequestException:
             self.bound_logger.exception("Error sending request to Anti-virus server")
             raise RetryableError()
 
-        self._check_av_response(response)
+        self._check_av_response(response, deadline)
 
-        self.bound_logger.info("Response received", response=response.text)
+        self.bound_logger.debug("Response received", response=Lazy(lambda: response.text))
         try:
             result = response.json()
         except (ValueError, TypeError):
@@ -120,7 +237,7 @@ class AntiVirusCheck:
         if result.get("err"):
             self.bound_logger.error("Unable to send file for anti virus scan", error=result.get("err"))
             self.bound_logger.info("Waiting before attempting again")
-            time.sleep(settings.ANTI_VIRUS_WAIT_TIME)
+            deadline.sleep(settings.ANTI_VIRUS_WAIT_TIME, "anti_virus submit")
             self.bound_logger.info("Return message to rabbit")
             raise RetryableError()
 
@@ -128,7 +245,7 @@ class AntiVirusCheck:
         self.bound_logger.info("File sent successfully for anti virus scan", data_id=data_id)
         return data_id
 
-    def _get_anti_virus_result(self, data_id):
+    def _get_anti_virus_result(self, data_id, deadline=NO_DEADLINE):
         url = f"{settings.ANTI_VIRUS_BASE_URL}/{data_id}"
         headers = {
             "user_agent": settings.ANTI_VIRUS_USER_AGENT,
@@ -136,15 +253,16 @@ class AntiVirusCheck:
 
         self._add_api_key(headers)
 
-        self.bound_logger.info("Getting result for A/V scan", url=url)
+        self.bound_logger.info("Getting result for A/V scan", url=url, _sample=data_id)
 
+        self._throttle()
         try:
-            response = self.session.get(url=url, headers=headers)
+            response = self._request("GET", url, deadline, "anti_virus poll", headers=headers)
         except requests.RequestException:
             self.bound_logger.exception("Error sending request to Anti-virus server")
             raise RetryableError()
 
-        self._check_av_response(response)
+        self._check_av_response(response, deadline)
 
         result = response.json()
         scan_results = result.get("scan_results")
@@ -165,9 +283,9 @@ class AntiVirusCheck:
                     else:
                         self.bound_logger.error("File is not safe")
                 else:
-                    self.bound_logger.info("Scan not yet complete", progress_percentage=progress_percentage)
+                    self.bound_logger.info("Scan not yet complete", progress_percentage=progress_percentage, _sample=data_id)
             else:
-                self.bound_logger.info("Results not yet available")
+                self.bound_logger.info("Results not yet available", _sample=data_id)
         except ValueError:
             self.bound_logger.exception("Unable to get progress percentage for A/V scan")
             raise RetryableError()
@@ -176,3 +294,18 @@ class AntiVirusCheck:
 
     def _write_scan_report(self, av_results, filename):
         self.bound_logger.error("A/V report generated", filename=filename, report=av_results.scan_results)
+
+
+class SimulatedAntiVirusCheck:
+    """Stands in for AntiVirusCheck when replaying or load testing, without calling OPSWAT.
+
+       Every file is reported safe after `latency` seconds, roughly what a real scan takes."""
+
+    def __init__(self, tx_id, latency=None):
+        self.bound_logger = logger.bind(tx_id=tx_id)
+        self.latency = settings.ANTI_VIRUS_WAIT_TIME if latency is None else latency
+
+    def send_for_av_scan(self, payload, deadline=NO_DEADLINE, timeline=NO_TIMELINE):
+        self.bound_logger.debug("Simulating A/V check", filename=payload.file_name, latency=self.latency)
+        deadline.sleep(self.latency, "anti_virus")
+        return True
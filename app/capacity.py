@@ -0,0 +1,106 @@
+import json
+import time
+
+import tornado.ioloop
+from tornado.httpclient import AsyncHTTPClient, HTTPError
+from tornado.web import RequestHandler
+
+from app import create_and_wrap_logger
+from app import settings
+from app.metrics import metrics
+
+logger = create_and_wrap_logger(__name__)
+
+
+class CapacitySignals:
+    """Figures an autoscaler can scale the service on, refreshed in the background.
+
+       The queue's depth, consumer count and ack rate come from the rabbit management API; the
+       average time to process a message and the messages in flight against the process's
+       capacity come from its own metrics. Messages in flight include those handed to the
+       scheduler's lanes, also given as `scheduled`, so utilisation goes over 1 as they back up. The time to drain the queue uses the rate rabbit has
+       seen messages acked at, or failing that, what every consumer could get through at the
+       average processing time.
+
+       Requests are answered from the last refresh, so scraping `/capacity` never waits on rabbit."""
+
+    def __init__(self, queue_url, clock=time.time):
+        self.queue_url = queue_url
+        self.clock = clock
+        self.signals = {}
+        self.refreshed = None
+        self.error = None
+        self._periodic = None
+
+    def start(self, interval):
+        self._periodic = tornado.ioloop.PeriodicCallback(self.refresh, interval * 1000)
+        self._periodic.start()
+        tornado.ioloop.IOLoop.current().add_callback(self.refresh)
+
+    def stop(self):
+        if self._periodic:
+            self._periodic.stop()
+
+    async def refresh(self):
+        try:
+            response = await AsyncHTTPClient().fetch(self.queue_url, request_timeout=10)
+            queue = json.loads(response.body.decode())
+        except (HTTPError, OSError, ValueError) as e:
+            # Keep serving the last figures; `age` shows how stale they are
+            self.error = str(e)
+            logger.warning("Unable to get queue figures from rabbit", error=self.error)
+            return
+        self.error = None
+        self.signals = self.calculate(queue)
+        self.refreshed = self.clock()
+
+    @staticmethod
+    def calculate(queue):
+        snapshot = metrics.snapshot()["gauges"]
+        scheduled = snapshot.get("scheduler.in_flight", 0)
+        in_flight = snapshot.get("admission.in_flight", 0) + scheduled
+        capacity = snapshot.get("admission.max_in_flight", settings.CONSUMER_WORKERS)
+        processing_time = metrics.recent_mean("messages.duration")
+        messages = queue.get("messages", 0)
+        consumers = queue.get("consumers", 0)
+        ack_rate = queue.get("message_stats", {}).get("ack_details", {}).get("rate", 0)
+
+        if not messages:
+            drain_time = 0
+        elif ack_rate:
+            drain_time = messages / ack_rate
+        elif processing_time and consumers:
+            drain_time = messages * processing_time / (consumers * capacity)
+        else:
+            # Nothing is getting through, so the queue won't drain at this size
+            drain_time = None
+
+        return {
+            "queue": queue.get("name", settings.RABBIT_QUEUE),
+            "messages": messages,
+            "messages_ready": queue.get("messages_ready", 0),
+            "messages_unacknowledged": queue.get("messages_unacknowledged", 0),
+            "consumers": consumers,
+            "ack_rate": ack_rate,
+            "processing_time": round(processing_time, 6) if processing_time is not None else None,
+            "in_flight": in_flight,
+            "scheduled": scheduled,
+            "capacity": capacity,
+            "utilisation": round(in_flight / capacity, 3) if capacity else None,
+            "drain_time": round(drain_time, 1) if drain_time is not None else None,
+        }
+
+    def as_dict(self):
+        return dict(self.signals,
+                    age=round(self.clock() - self.refreshed, 1) if self.refreshed is not None else None,
+                    error=self.error)
+
+
+signals = CapacitySignals(settings.RABBIT_QUEUE_URL)
+
+
+class CapacityHandler(RequestHandler):
+    """Returns the last queue depth and capacity figures of the process that handles the request."""
+
+    def get(self):
+        self.write(signals.as_dict())
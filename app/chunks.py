@@ -0,0 +1,191 @@
+import base64
+import binascii
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+
+from app import create_and_wrap_logger
+from app.encoding import decompress_stream
+from app.metrics import metrics
+
+logger = create_and_wrap_logger(__name__)
+
+DIGEST = re.compile(r"^[0-9a-f]{64}$")
+
+
+class ChunkError(Exception):
+    """A chunk, or the file assembled from a set of them, can't be used."""
+
+
+class ChunkStore:
+    """Spills the chunks of large files to disk and assembles each file once all of its chunks are in.
+
+       A set of chunks is identified by the case, the chunk count and the SHA-256 digest of the
+       whole file. Each chunk is written to its own part file as it arrives, so no more than one
+       chunk is held in memory, and the message carrying it can be acked. Every process
+       consuming the queue must share `directory`, as the chunks of a file may go to any of them.
+
+       The message that brings in the last chunk claims the set and has it assembled into one
+       spill file, checked against the digest. The claim records its tx_id, so if the message is
+       redelivered after a retryable failure the same message picks the set up again, reusing
+       the assembled file. Anyone else completing the set at the same moment leaves it be.
+
+       Sets are removed with `discard` once the file is delivered or quarantined. The messages
+       carrying a set's chunks have all been acked by then, so a set no chunk has arrived for in
+       `timeout` seconds can't be completed by redelivery: `expire` moves it aside to `.expired`,
+       where nothing removes it, and logs it as an error to be looked into."""
+
+    def __init__(self, directory, timeout, clock=time.time):
+        self.directory = directory
+        self.timeout = timeout
+        self.clock = clock
+
+    def _set_directory(self, case_id, chunk_count, digest):
+        key = hashlib.sha256("{}:{}:{}".format(case_id, chunk_count, digest).encode()).hexdigest()
+        return os.path.join(self.directory, key)
+
+    def add(self, case_id, digest, index, count, chunk, tx_id):
+        """Stores base64 encoded `chunk`, returning the assembled file's path if this completes the set, else None.
+
+        Raises ChunkError if the chunk is malformed or the assembled file doesn't match `digest`.
+        """
+        if not isinstance(digest, str) or not DIGEST.match(digest):
+            raise ChunkError("file_digest must be a hex SHA-256 digest")
+        if not isinstance(count, int) or not isinstance(index, int) or not 0 <= index < count:
+            raise ChunkError("chunk_index {} out of range for chunk_count {}".format(index, count))
+        try:
+            data = base64.b64decode(chunk)
+        except (binascii.Error, TypeError) as e:
+            raise ChunkError("Unable to decode chunk") from e
+
+        set_directory = self._set_directory(case_id, count, digest)
+        parts = os.path.join(set_directory, "parts")
+        os.makedirs(parts, exist_ok=True)
+        self._describe(set_directory, case_id, count, digest)
+        # Written aside and renamed into place, so a part is either whole or absent
+        temporary = os.path.join(set_directory, "{}.{}.tmp".format(index, os.getpid()))
+        with open(temporary, "wb") as part:
+            part.write(data)
+        os.replace(temporary, os.path.join(parts, "{:06d}".format(index)))
+        metrics.increment("chunks.received")
+
+        received = len(os.listdir(parts))
+        logger.info("Stored chunk", tx_id=tx_id, case_id=case_id, chunk_index=index, chunk_count=count,
+                    received=received)
+        if received < count or not self._claim(set_directory, tx_id):
+            return None
+        return self._assemble(set_directory, parts, count, digest, tx_id)
+
+    @staticmethod
+    def _describe(set_directory, case_id, count, digest):
+        # Says which file an expired set was part of
+        description = os.path.join(set_directory, "set.json")
+        if os.path.exists(description):
+            return
+        temporary = "{}.{}.tmp".format(description, os.getpid())
+        with open(temporary, "w") as file:
+            json.dump({"case_id": case_id, "chunk_count": count, "file_digest": digest}, file)
+        os.replace(temporary, description)
+
+    @staticmethod
+    def _claim(set_directory, tx_id):
+        owner = os.path.join(set_directory, "owner")
+        try:
+            descriptor = os.open(owner, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            with open(owner) as file:
+                return file.read() == str(tx_id)
+        with os.fdopen(descriptor, "w") as file:
+            file.write(str(tx_id))
+        return True
+
+    def _assemble(self, set_directory, parts, count, digest, tx_id):
+        assembled = os.path.join(set_directory, "assembled")
+        if os.path.exists(assembled):
+            return assembled
+        temporary = assembled + ".tmp"
+        sha256 = hashlib.sha256()
+        with open(temporary, "wb") as file:
+            for index in range(count):
+                with open(os.path.join(parts, "{:06d}".format(index)), "rb") as part:
+                    while True:
+                        block = part.read(1024 * 1024)
+                        if not block:
+                            break
+                        sha256.update(block)
+                        file.write(block)
+        if sha256.hexdigest() != digest:
+            self.discard(assembled)
+            raise ChunkError("Assembled file doesn't match its digest")
+        os.replace(temporary, assembled)
+        metrics.increment("chunks.assembled")
+        logger.info("Assembled file from chunks", tx_id=tx_id, chunk_count=count, size=os.path.getsize(assembled))
+        return assembled
+
+    @staticmethod
+    def decompress(path, encoding, max_bytes=0):
+        """Decompresses the assembled file at `path` alongside it, returning the decompressed file's path.
+
+        Raises DecodingError as `decompress_stream` does.
+        """
+        decompressed = path + ".decompressed"
+        if os.path.exists(decompressed):
+            return decompressed
+        temporary = decompressed + ".tmp"
+        with open(path, "rb") as source, open(temporary, "wb") as destination:
+            decompress_stream(source, destination, encoding, max_bytes)
+        os.replace(temporary, decompressed)
+        return decompressed
+
+    @staticmethod
+    def discard(path):
+        """Removes the set an assembled file at `path` was built from."""
+        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+    def expire(self):
+        """Moves aside sets that no chunk has arrived for in `timeout` seconds, returning how many."""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return 0
+        expired = 0
+        for name in names:
+            if name.startswith("."):
+                continue
+            set_directory = os.path.join(self.directory, name)
+            try:
+                last_chunk = os.stat(os.path.join(set_directory, "parts")).st_mtime
+            except FileNotFoundError:
+                try:
+                    last_chunk = os.stat(set_directory).st_mtime
+                except FileNotFoundError:
+                    continue
+            if self.clock() - last_chunk > self.timeout:
+                self._expire(name, set_directory)
+                expired += 1
+        metrics.increment("chunks.expired", expired)
+        return expired
+
+    def _expire(self, name, set_directory):
+        try:
+            with open(os.path.join(set_directory, "set.json")) as file:
+                description = json.load(file)
+        except (OSError, ValueError):
+            description = {}
+        try:
+            received = len(os.listdir(os.path.join(set_directory, "parts")))
+        except FileNotFoundError:
+            received = 0
+        expired_directory = os.path.join(self.directory, ".expired")
+        os.makedirs(expired_directory, exist_ok=True)
+        destination = os.path.join(expired_directory, name)
+        try:
+            os.replace(set_directory, destination)
+        except OSError:
+            # Already moved aside by another process
+            return
+        logger.error("Chunks of an incomplete file expired, acked chunks can't be redelivered",
+                     set=name, received=received, path=destination, **description)
@@ -0,0 +1,74 @@
+import threading
+import time
+
+from sdc.rabbit.exceptions import RetryableError
+
+from app import create_and_wrap_logger
+from app.metrics import metrics
+
+logger = create_and_wrap_logger(__name__)
+
+
+class DeadlineExceeded(RetryableError):
+    """Raised when a message runs out of time, so that it is nacked and redelivered."""
+
+
+class Deadline:
+    """The time left to process one message.
+
+       Each stage uses `timeout` for its socket timeouts and calls `check` between steps, so a
+       message that runs out of time gives up wherever it has got to rather than holding a worker.
+       A deadline of None or 0 seconds never expires, unless it is cancelled."""
+
+    def __init__(self, seconds, tx_id=None, clock=time.monotonic):
+        self._clock = clock
+        self.expires = clock() + seconds if seconds else None
+        self.tx_id = tx_id
+        self._cancelled = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        """Expires the deadline now, so whatever is working to it gives up at its next check,
+           or straight away if it is in `sleep`."""
+        self._cancelled.set()
+
+    def remaining(self):
+        """Seconds left, or None if there is no deadline."""
+        if self.cancelled:
+            return 0.0
+        if self.expires is None:
+            return None
+        return max(0.0, self.expires - self._clock())
+
+    def check(self, stage):
+        """Raises DeadlineExceeded if the deadline has passed."""
+        if self.cancelled or (self.expires is not None and self._clock() >= self.expires):
+            self._exceeded(stage)
+
+    def timeout(self, stage, cap=None):
+        """A socket timeout for the next step: the time remaining, but no more than `cap`."""
+        self.check(stage)
+        remaining = self.remaining()
+        if remaining is None:
+            return cap
+        return remaining if cap is None else min(remaining, cap)
+
+    def sleep(self, seconds, stage):
+        """Sleeps before retrying, giving up straight away if the deadline would pass first or
+           as soon as it is cancelled."""
+        remaining = self.remaining()
+        if remaining is not None and remaining < seconds:
+            self._exceeded(stage)
+        if self._cancelled.wait(seconds):
+            self._exceeded(stage)
+
+    def _exceeded(self, stage):
+        metrics.increment("messages.deadline_exceeded")
+        logger.warning("Deadline exceeded, message will be requeued", stage=stage, tx_id=self.tx_id)
+        raise DeadlineExceeded()
+
+
+NO_DEADLINE = Deadline(None)
@@ -0,0 +1,146 @@
+"""Where decrypted and scanned files are delivered to.
+
+A delivery backend is anything with SDXFTP's `deliver_binary(folder, filename, data, deadline=,
+timeline=)`, where `data` is the file's bytes or a file open for reading. DELIVERY_BACKEND picks
+the one the consumer uses: "ftp" (SDXFTP, or ShardedFTP for several targets), "filesystem"
+(LocalDirectoryDelivery into DELIVERY_DIR, such as a mounted collection volume) or "null".
+"""
+import errno
+import io
+import os
+import shutil
+import uuid
+
+from app import settings
+from app.deadline import NO_DEADLINE
+from app.ftp_targets import ftp_from_settings
+from app.timeline import NO_TIMELINE
+
+BACKENDS = ("ftp", "filesystem", "null")
+
+# Bytes copied between deadline checks
+COPY_BLOCK_SIZE = 8 * 1024 ** 2
+
+
+class LocalDirectoryDelivery:
+    """Delivers files into a directory on the local filesystem instead of the FTP server.
+
+       Has the same `deliver_binary` interface as SDXFTP, with folders created under `root`. Each
+       file is written to a hidden temporary file beside it and renamed into place once complete,
+       so whatever collects from the directory never sees part of a file. Spill files are copied
+       by the kernel with sendfile and bytes written straight from the buffer, without copies in
+       between. With `fsync` the file and its directory are flushed to disk before it counts as
+       delivered, which a volume shared with other hosts needs to survive a crash."""
+
+    def __init__(self, logger, root, fsync=False):
+        self.logger = logger
+        self.root = os.path.abspath(root)
+        self.fsync = fsync
+
+    def deliver_binary(self, folder, filename, data, deadline=NO_DEADLINE, timeline=NO_TIMELINE):
+        directory = os.path.normpath(os.path.join(self.root, folder.lstrip(os.sep)))
+        path = os.path.normpath(os.path.join(directory, filename))
+        if os.path.commonpath([self.root, path]) != self.root:
+            raise IOError("Refusing to deliver outside of {}: {}".format(self.root, path))
+        os.makedirs(directory, exist_ok=True)
+        temporary = os.path.join(directory, ".{}.{}.part".format(os.path.basename(path)[:200], uuid.uuid4().hex))
+        with timeline.stage("write"):
+            fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+            try:
+                try:
+                    if hasattr(data, "read"):
+                        self._copy_file(data, fd, deadline)
+                    else:
+                        self._write_bytes(data, fd, deadline)
+                    if self.fsync:
+                        os.fsync(fd)
+                finally:
+                    os.close(fd)
+                os.replace(temporary, path)
+            except BaseException:
+                self._remove(temporary)
+                raise
+        if self.fsync:
+            self._fsync_directory(directory)
+        self.logger.info("Delivered binary file to directory", folder=directory, filename=filename)
+
+    @staticmethod
+    def _write_bytes(data, fd, deadline):
+        view = memoryview(data)
+        written = 0
+        while written < len(view):
+            deadline.check("write")
+            written += os.write(fd, view[written:written + COPY_BLOCK_SIZE])
+
+    @staticmethod
+    def _copy_file(file, fd, deadline):
+        try:
+            source = file.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            source = None
+        offset = file.tell() if source is not None else 0
+        while source is not None:
+            deadline.check("write")
+            try:
+                sent = os.sendfile(fd, source, offset, COPY_BLOCK_SIZE)
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.ENOSYS) or offset != file.tell():
+                    raise
+                # Not a pair of files the kernel can copy between, so copy through user space
+                break
+            if not sent:
+                file.seek(offset)
+                return
+            offset += sent
+        with os.fdopen(os.dup(fd), "wb") as delivered:
+            shutil.copyfileobj(file, delivered, COPY_BLOCK_SIZE)
+
+    @staticmethod
+    def _fsync_directory(directory):
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def available(self):
+        """Whether files can be delivered: the root exists, or can be created, and is writable."""
+        try:
+            os.makedirs(self.root, exist_ok=True)
+        except OSError:
+            return False
+        return os.access(self.root, os.W_OK | os.X_OK)
+
+
+class NullDelivery:
+    """Discards every file, for replays and capacity tests that must not deliver anything."""
+
+    def __init__(self, logger):
+        self.logger = logger
+
+    def deliver_binary(self, folder, filename, data, deadline=None, timeline=None):
+        size = os.fstat(data.fileno()).st_size if hasattr(data, "read") else len(data)
+        self.logger.debug("Discarded binary file", folder=folder, filename=filename, size=size)
+
+    def available(self):
+        return True
+
+
+def delivery_from_settings(logger):
+    """The delivery backend DELIVERY_BACKEND names."""
+    if settings.DELIVERY_BACKEND == "ftp":
+        return ftp_from_settings(logger)
+    if settings.DELIVERY_BACKEND == "filesystem":
+        if not settings.DELIVERY_DIR:
+            raise ValueError("DELIVERY_DIR must be set to deliver to the filesystem")
+        return LocalDirectoryDelivery(logger, settings.DELIVERY_DIR, fsync=settings.DELIVERY_FSYNC)
+    if settings.DELIVERY_BACKEND == "null":
+        return NullDelivery(logger)
+    raise ValueError("DELIVERY_BACKEND must be one of {}: {}".format(", ".join(BACKENDS), settings.DELIVERY_BACKEND))
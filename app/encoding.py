@@ -0,0 +1,101 @@
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import zlib
+
+BLOCK_SIZE = 1024 * 1024
+
+
+class DecodingError(Exception):
+    """A compressed file couldn't be decompressed, or decompressed to more than it may."""
+
+
+def _reader(source, encoding):
+    if encoding == "gzip":
+        return gzip.GzipFile(fileobj=source, mode="rb")
+    raise DecodingError("Unsupported content_encoding {}".format(encoding))
+
+
+def check_encoding(encoding):
+    """Raises DecodingError unless files with this content_encoding can be decompressed."""
+    _reader(io.BytesIO(), encoding).close()
+
+
+def decompress_stream(source, destination, encoding, max_bytes=0):
+    """Decompresses readable `source` into writable `destination` a block at a time, returning the size.
+
+    Raises DecodingError if the data is corrupt or decompresses to more than `max_bytes` (0 for no limit),
+    without ever holding more than a block beyond the limit.
+    """
+    size = 0
+    errors = (OSError, EOFError, zlib.error)
+    try:
+        with _reader(source, encoding) as reader:
+            while True:
+                block = reader.read(BLOCK_SIZE)
+                if not block:
+                    return size
+                size += len(block)
+                if max_bytes and size > max_bytes:
+                    raise DecodingError("Decompressed file is bigger than {} bytes".format(max_bytes))
+                destination.write(block)
+    except errors as e:
+        raise DecodingError("Unable to decompress {} file: {}".format(encoding, e)) from e
+
+
+def decompress(data, encoding, max_bytes=0):
+    """Decompresses `data`, with the same limit as `decompress_stream`."""
+    decompressed = io.BytesIO()
+    decompress_stream(io.BytesIO(data), decompressed, encoding, max_bytes)
+    return decompressed.getvalue()
+
+
+class _SpillingWriter:
+    """Keeps what is written in memory until it passes `max_in_memory` bytes, then in a file of its own directory."""
+
+    def __init__(self, max_in_memory, directory=None):
+        self.max_in_memory = max_in_memory
+        self.directory = directory
+        self.buffer = io.BytesIO()
+        self.path = None
+        self._file = None
+
+    def write(self, block):
+        if self._file is None and self.buffer.tell() + len(block) > self.max_in_memory:
+            self.path = os.path.join(tempfile.mkdtemp(prefix="sdx-seft-", dir=self.directory), "decompressed")
+            self._file = open(self.path, "wb")
+            self._file.write(self.buffer.getbuffer())
+            self.buffer = None
+        (self._file or self.buffer).write(block)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+    def discard(self):
+        self.close()
+        if self.path is not None:
+            shutil.rmtree(os.path.dirname(self.path), ignore_errors=True)
+
+
+def decompress_spilling(data, encoding, max_bytes=0, max_in_memory=0, directory=None):
+    """Decompresses `data` in memory, or into a spill file once it passes `max_in_memory` bytes (0 for no limit).
+
+    Returns the decompressed bytes and None, or None and the path of the spill file, which is alone
+    in a directory of its own under `directory` (the temporary directory by default). Raises
+    DecodingError as `decompress_stream` does, leaving no spill file behind.
+    """
+    if not max_in_memory:
+        return decompress(data, encoding, max_bytes), None
+    writer = _SpillingWriter(max_in_memory, directory)
+    try:
+        decompress_stream(io.BytesIO(data), writer, encoding, max_bytes)
+    except BaseException:
+        writer.discard()
+        raise
+    writer.close()
+    if writer.path is None:
+        return writer.buffer.getvalue(), None
+    return None, writer.path
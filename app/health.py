@@ -7,7 +7,7 @@ from tornado.web import RequestHandler
 
 from app import create_and_wrap_logger
 from app import settings
-from app.sdxftp import SDXFTP
+from app.delivery import delivery_from_settings
 
 logger = create_and_wrap_logger(__name__)
 
@@ -17,21 +17,15 @@ class GetHealth:
 
        The status of the application is determined by the rabbitmq health and ftp health.
        This is done by performing a healthcheck on rabbitmq and checking the application
-       has a live ftp connection. This check is done in the background after a delay.
+       has a live ftp connection. This check is done in the background once the process has started.
        When the healthcheck endpoint endpoint is hit a 200 status is returned with
        app status as well as the dependencies of rabbitmq and ftp."""
 
     def __init__(self):
-        self.ftp = SDXFTP(logger,
-                          settings.FTP_HOST,
-                          settings.FTP_USER,
-                          settings.FTP_PASS,
-                          settings.FTP_PORT,
-                          )
+        self.ftp = delivery_from_settings(logger)
         self.rabbit_status = False
         self.ftp_status = False
         self.app_health = False
-        self.determine_health()
 
     @gen.coroutine
     def determine_rabbit_status(self):
@@ -60,6 +54,10 @@ class GetHealth:
                 self.rabbit_status = True
 
     def determine_ftp_status(self):
+        if settings.DELIVERY_BACKEND != "ftp":
+            # Nothing to connect to, so healthy as long as files can be delivered
+            self.ftp_status = self.ftp.available()
+            return
         try:
             self.ftp_status = False
             conn = self.ftp.get_connection()
@@ -0,0 +1,100 @@
+import os
+
+import tornado.ioloop
+import yaml
+from sdc.crypto.exceptions import CryptoError
+from sdc.crypto.key_store import Key, KeyStore, validate_required_keys
+
+from app import create_and_wrap_logger
+from app.metrics import metrics
+
+logger = create_and_wrap_logger(__name__)
+
+
+class ParsedKey(Key):
+    """A Key whose PEM is parsed once, up front, rather than on every lookup."""
+
+    def __init__(self, key):
+        super().__init__(key.kid, key.purpose, key.key_type, key.value, key.service)
+        try:
+            self._jwk = super().as_jwk()
+        except (ValueError, TypeError) as e:
+            raise CryptoError("Unable to parse key {}".format(key.kid)) from e
+
+    def as_jwk(self):
+        return self._jwk
+
+
+class ParsedKeyStore(KeyStore):
+    """A KeyStore with every key parsed as it is built, so an unusable key fails the load rather than a message."""
+
+    def __init__(self, keys):
+        super().__init__(keys)
+        self.keys = {kid: ParsedKey(key) for kid, key in self.keys.items()}
+
+
+def load_key_store(path, purpose):
+    """Reads, validates and parses the keys file at `path`."""
+    with open(path) as file:
+        keys = yaml.safe_load(file)
+    validate_required_keys(keys, purpose)
+    return ParsedKeyStore(keys)
+
+
+class KeyStoreReloader:
+    """Reloads the keys file when it changes, handing each new ParsedKeyStore to `on_reload`.
+
+       The file is checked every `interval` seconds, or straight away on `reload()` (which the
+       service calls on SIGHUP). Loading happens on the io loop's executor, so messages carry on
+       with the old keys meanwhile; a file that doesn't load is logged and the old keys are kept."""
+
+    def __init__(self, path, purpose, on_reload):
+        self.path = path
+        self.purpose = purpose
+        self.on_reload = on_reload
+        self._loaded = self._signature()
+        self._loading = None
+        self._periodic = None
+
+    def _signature(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def start(self, interval):
+        if interval:
+            self._periodic = tornado.ioloop.PeriodicCallback(self.check, interval * 1000)
+            self._periodic.start()
+
+    def stop(self):
+        if self._periodic:
+            self._periodic.stop()
+
+    def check(self):
+        if self._signature() != self._loaded:
+            self.reload()
+
+    def reload(self):
+        """Starts loading the keys file, returning a Future that resolves once it is loaded (or not)."""
+        if self._loading is None:
+            ioloop = tornado.ioloop.IOLoop.current()
+            signature = self._signature()
+            self._loading = ioloop.run_in_executor(None, load_key_store, self.path, self.purpose)
+            ioloop.add_future(self._loading, lambda loading: self._on_loaded(loading, signature))
+        return self._loading
+
+    def _on_loaded(self, loading, signature):
+        self._loading = None
+        # Don't retry a bad file on every check, only once it changes again
+        self._loaded = signature
+        try:
+            key_store = loading.result()
+        except (CryptoError, IOError, KeyError, TypeError, yaml.YAMLError) as e:
+            metrics.increment("keys.reload_failed")
+            logger.error("Unable to reload keys, carrying on with the current keys", path=self.path, error=str(e))
+            return
+        self.on_reload(key_store)
+        metrics.increment("keys.reloaded")
+        logger.info("Reloaded keys", path=self.path, kids=sorted(key_store.keys))
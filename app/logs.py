@@ -0,0 +1,124 @@
+"""Keeps logging off the hot path of message processing.
+
+`SeftBoundLogger` checks the level before any structlog processing (as structlog's
+`filter_by_level` would, without raising DropEvent for every skipped line), computes `Lazy`
+fields only for lines that are emitted, and samples repetitive lines that pass `_sample=<key>`,
+such as one per A/V poll. `QueuedLogging` moves formatting and writing to stdout onto a
+background thread.
+"""
+import collections
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+import structlog
+
+from app.metrics import metrics
+
+LEVELS = {
+    "debug": logging.DEBUG,
+    "info": logging.INFO,
+    "msg": logging.INFO,
+    "warning": logging.WARNING,
+    "warn": logging.WARNING,
+    "error": logging.ERROR,
+    "exception": logging.ERROR,
+    "critical": logging.CRITICAL,
+    "fatal": logging.CRITICAL,
+}
+
+# Emit the 1st, then every nth, of the lines logged with the same event and `_sample` key
+sample_every = 1
+# Time every call to a logger as `logging.call`, for benchmarks
+measuring = False
+
+_samples = collections.OrderedDict()
+_samples_lock = threading.Lock()
+
+
+class Lazy:
+    """A log field that is only computed if the line is emitted: `response=Lazy(lambda: response.text)`."""
+
+    __slots__ = ("compute",)
+
+    def __init__(self, compute):
+        self.compute = compute
+
+
+def _sampled_out(event, key):
+    if sample_every <= 1:
+        return False
+    with _samples_lock:
+        count = _samples.pop((event, key), 0) + 1
+        _samples[(event, key)] = count
+        if len(_samples) > 10000:
+            _samples.popitem(last=False)
+    return count != 1 and count % sample_every != 0
+
+
+class SeftBoundLogger(structlog.BoundLogger):
+
+    def _proxy_to_logger(self, method_name, event=None, **event_kw):
+        if not measuring:
+            return self._log(method_name, event, event_kw)
+        start = time.perf_counter()
+        try:
+            return self._log(method_name, event, event_kw)
+        finally:
+            metrics.observe("logging.call", time.perf_counter() - start)
+
+    def _log(self, method_name, event, event_kw):
+        level = LEVELS.get(method_name)
+        if level is not None and not self._logger.isEnabledFor(level):
+            return None
+        sample = event_kw.pop("_sample", None)
+        if sample is not None and _sampled_out(event, sample):
+            return None
+        for name, value in event_kw.items():
+            if isinstance(value, Lazy):
+                event_kw[name] = value.compute()
+        return super()._proxy_to_logger(method_name, event, **event_kw)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Drops records, counting them, rather than block the caller when the queue is full."""
+
+    def prepare(self, record):
+        # The listener is in this process, so the record can be formatted there rather than here
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.increment("logging.dropped")
+
+
+class QueuedLogging:
+    """Replaces the root logger's handlers with a queue they are served from on a listener thread.
+
+       Threads don't survive a fork, so each forked process starts a listener (and queue) of its own."""
+
+    def __init__(self, size):
+        self.size = size
+        self.handlers = None
+        self.listener = None
+
+    def start(self):
+        root = logging.getLogger()
+        if self.handlers is None:
+            self.handlers = root.handlers[:]
+            os.register_at_fork(after_in_child=self.start)
+        records = queue.Queue(self.size)
+        self.listener = logging.handlers.QueueListener(records, *self.handlers, respect_handler_level=True)
+        root.handlers = [DroppingQueueHandler(records)]
+        self.listener.start()
+
+    def stop(self):
+        """Writes out anything still queued."""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
@@ -1,34 +1,54 @@
 import base64
 import collections
-
+import contextlib
+from ftplib import all_errors as ftp_errors
+import functools
+import logging
 import os
+import signal
+import threading
+import weakref
 
 
 import requests
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3 import Retry
 from sdc.crypto.decrypter import decrypt
-from sdc.crypto.exceptions import CryptoError, InvalidTokenException
-from sdc.crypto.key_store import KeyStore, validate_required_keys
-from sdc.rabbit.publishers import QueuePublisher
+from sdc.crypto.exceptions import InvalidTokenException
 from sdc.rabbit.exceptions import QuarantinableError, RetryableError
-from sdc.rabbit.consumers import MessageConsumer
 
 import tornado.httpserver
 import tornado.ioloop
 import tornado.web
-import yaml
 
 from app import create_and_wrap_logger
 from app import settings
-from app.anti_virus_check import AntiVirusCheck
+from app import admin, anti_virus_check, capacity, tuning
+from app.admission import AdmissionController
+from app.deadline import Deadline, NO_DEADLINE
+from app.delivery import NullDelivery, delivery_from_settings
+from app.encoding import DecodingError, check_encoding, decompress_spilling
+from app.keys import KeyStoreReloader, ParsedKeyStore, load_key_store
+from app.anti_virus_check import AntiVirusCheck, SimulatedAntiVirusCheck
+from app.capacity import CapacityHandler
+from app.chunks import ChunkError, ChunkStore
 from app.health import HealthCheck, GetHealth
+from app.message_consumer import SeftMessageConsumer
+from app.metrics import MetricsHandler, metrics
+from app.precheck import check_jwe_header
+from app.quarantine import DiscardingQuarantinePublisher, QuarantinePublisher
+from app.recorder import TrafficRecorder
+from app.scheduler import Lane, Scheduler
+from app.ftp_targets import ShardedFTP
 from app.sdxftp import SDXFTP
+from app.startup import ReadinessHandler, Startup
+from app.timeline import NO_TIMELINE, Timeline, TimelineHandler
 from app.settings import SERVICE_REQUEST_TOTAL_RETRIES, SERVICE_REQUEST_BACKOFF_FACTOR
 
 
 logger = create_and_wrap_logger(__name__)
 HEALTHCHECK_DELAY_MILLISECONDS = settings.SEFT_CONSUMER_HEALTHCHECK_DELAY
+CHUNK_SWEEP_INTERVAL_MILLISECONDS = 60 * 1000
 
 KEY_PURPOSE_CONSUMER = "inbound"
 
@@ -37,7 +57,31 @@ class ConsumerError(Exception):
     pass
 
 
-Payload = collections.namedtuple('Payload', 'decoded_contents file_name case_id survey_id')
+def _within(path, directory):
+    path, directory = os.path.abspath(path), os.path.abspath(directory)
+    return os.path.commonpath([path, directory]) == directory
+
+
+class Payload(collections.namedtuple('Payload', 'decoded_contents file_name case_id survey_id spill_path temporary',
+                                     defaults=(None, False))):
+    """A decrypted file, held in memory or, once assembled from chunks or decompressed, in a spill file.
+
+       A `temporary` spill file belongs to this delivery alone and is removed however it ends, where
+       an assembled set of chunks is kept for a retry to pick up again."""
+    __slots__ = ()
+
+    @property
+    def size(self):
+        return os.path.getsize(self.spill_path) if self.spill_path else len(self.decoded_contents)
+
+    @contextlib.contextmanager
+    def contents(self):
+        """The file's bytes, or an open spill file, either of which A/V and delivery accept."""
+        if self.spill_path is None:
+            yield self.decoded_contents
+        else:
+            with open(self.spill_path, "rb") as file:
+                yield file
 
 
 class SeftConsumer:
@@ -60,6 +104,15 @@ class SeftConsumer:
             logger.debug("Decrypted file", file_name=file_name,
                          tx_id=tx_id, case_id=case_id, survey_id=survey_id)
             decoded_contents = base64.b64decode(file_contents)
+            encoding = decrypted_payload.get('content_encoding')
+            if encoding:
+                # Admission only reserved memory in proportion to the message, so anything bigger goes to disk
+                decoded_contents, spill_path = decompress_spilling(
+                    decoded_contents, encoding, settings.MAX_DECOMPRESSED_BYTES,
+                    max_in_memory=int(len(file_contents) * settings.MEMORY_ESTIMATE_FACTOR))
+                if spill_path:
+                    return Payload(decoded_contents=None, file_name=file_name, case_id=case_id, survey_id=survey_id,
+                                   spill_path=spill_path, temporary=True)
             return Payload(decoded_contents=decoded_contents, file_name=file_name, case_id=case_id, survey_id=survey_id)
         except (KeyError, ConsumerError) as e:
             logger.error("Required claims missing",
@@ -68,23 +121,112 @@ class SeftConsumer:
                          action="quarantining",
                          tx_id=tx_id)
             raise QuarantinableError()
+        except DecodingError as e:
+            logger.error("Unable to decompress file",
+                         exception=str(e),
+                         action="quarantining",
+                         tx_id=tx_id)
+            raise QuarantinableError()
 
-    def __init__(self, keys):
-        self.bound_logger = logger
-        self.key_store = KeyStore(keys)
-
-        self._ftp = SDXFTP(logger,
-                           settings.FTP_HOST,
-                           settings.FTP_USER,
-                           settings.FTP_PASS,
-                           settings.FTP_PORT)
-
-        self.publisher = QueuePublisher(urls=settings.RABBIT_URLS,
-                                        queue=settings.RABBIT_QUARANTINE_QUEUE)
-        self.consumer = MessageConsumer(durable_queue=True, exchange=settings.RABBIT_EXCHANGE, exchange_type="topic",
-                                        rabbit_queue=settings.RABBIT_QUEUE,
-                                        rabbit_urls=settings.RABBIT_URLS, quarantine_publisher=self.publisher,
-                                        process=self.process)
+    def extract_chunk(self, decrypted_payload, tx_id):
+        """Stores one chunk of a file sent in several messages.
+
+        Returns the Payload of the whole file once this message completes it, else None.
+        """
+        if self.chunks is None:
+            logger.error("Chunked file received without a chunk spill directory set", action="quarantining", tx_id=tx_id)
+            raise QuarantinableError()
+        try:
+            file_name = decrypted_payload['filename']
+            case_id = decrypted_payload['case_id']
+            survey_id = decrypted_payload['survey_id']
+            if not file_name or not case_id or not survey_id:
+                raise ConsumerError()
+            # The digest and the chunks are of the file as sent, compressed or not
+            encoding = decrypted_payload.get('content_encoding')
+            if encoding:
+                check_encoding(encoding)
+            spill_path = self.chunks.add(case_id, decrypted_payload['file_digest'], decrypted_payload['chunk_index'],
+                                         decrypted_payload['chunk_count'], decrypted_payload['file'], tx_id)
+        except (KeyError, ConsumerError, ChunkError, DecodingError) as e:
+            logger.error("Unusable chunk",
+                         exception=str(e),
+                         keys=decrypted_payload.keys(),
+                         action="quarantining",
+                         tx_id=tx_id)
+            raise QuarantinableError()
+        if spill_path is None:
+            return None
+        if encoding:
+            try:
+                spill_path = self.chunks.decompress(spill_path, encoding, settings.MAX_DECOMPRESSED_BYTES)
+            except DecodingError as e:
+                logger.error("Unable to decompress file",
+                             exception=str(e),
+                             action="quarantining",
+                             tx_id=tx_id)
+                self.chunks.discard(spill_path)
+                raise QuarantinableError()
+        return Payload(decoded_contents=None, file_name=file_name, case_id=case_id, survey_id=survey_id,
+                       spill_path=spill_path)
+
+    def __init__(self, keys, delivery=None, anti_virus=None, shadow=None):
+        # Without keys nothing can be decrypted until use_key_store is called
+        self.key_store = ParsedKeyStore(keys) if keys is not None else None
+        self.shadow = settings.SHADOW_MODE if shadow is None else shadow
+        if self.shadow:
+            # Decrypt and extract for real, but deliver nowhere and leave A/V alone unless asked to
+            logger.warning("Running in shadow mode, nothing will be delivered or quarantined", queue=settings.SHADOW_QUEUE)
+            delivery = delivery or NullDelivery(logger)
+            metrics.set_gauge("shadow", 1)
+            if anti_virus is None and settings.SHADOW_ANTI_VIRUS == "stub":
+                anti_virus = functools.partial(SimulatedAntiVirusCheck, latency=settings.SHADOW_ANTI_VIRUS_LATENCY)
+        self._anti_virus = anti_virus or AntiVirusCheck
+        # Deadlines of the messages being worked on, cancelled once they have been abandoned on drain
+        self._deadlines = weakref.WeakSet()
+        self._deadlines_lock = threading.Lock()
+        self._stopped = False
+        self.abandoned = 0
+
+        self._ftp = delivery or delivery_from_settings(logger)
+
+        # Chunks are only accepted with a spill directory set explicitly, as every consumer must share it.
+        # Shadow consumers get copies of the production chunks, so must assemble them somewhere else,
+        # outside the production directory whose expiry would take their sets for its own
+        spill_dir = settings.SHADOW_CHUNK_SPILL_DIR if self.shadow else settings.CHUNK_SPILL_DIR
+        if self.shadow and spill_dir and settings.CHUNK_SPILL_DIR and _within(spill_dir, settings.CHUNK_SPILL_DIR):
+            raise ValueError("SHADOW_CHUNK_SPILL_DIR must be outside CHUNK_SPILL_DIR: {}".format(spill_dir))
+        self.chunks = ChunkStore(spill_dir, settings.CHUNK_SET_TIMEOUT) if spill_dir else None
+
+        self.scheduler = None
+        if settings.SCHEDULER_POLICY == "lanes":
+            self.scheduler = Scheduler([Lane("small", settings.SCHEDULER_SMALL_WORKERS, settings.SCHEDULER_LARGE_FILE_BYTES),
+                                        Lane("large", settings.SCHEDULER_LARGE_WORKERS)])
+
+        if self.shadow:
+            self.publisher = DiscardingQuarantinePublisher(queue=settings.RABBIT_QUARANTINE_QUEUE)
+            queue, routing_key = settings.SHADOW_QUEUE, settings.RABBIT_QUEUE
+            # A shadow queue nobody is consuming mustn't grow without limit; the oldest copies are dropped
+            queue_arguments = {"x-max-length": settings.SHADOW_QUEUE_MAX_LENGTH}
+        else:
+            self.publisher = QuarantinePublisher(queue=settings.RABBIT_QUARANTINE_QUEUE,
+                                                 batch_size=settings.QUARANTINE_BATCH_SIZE,
+                                                 batch_window=settings.QUARANTINE_BATCH_WINDOW)
+            queue, routing_key, queue_arguments = settings.RABBIT_QUEUE, None, None
+        self.recorder = None
+        if settings.RECORD_TRAFFIC_FILE:
+            self.recorder = TrafficRecorder("{}.{}".format(settings.RECORD_TRAFFIC_FILE, os.getpid()),
+                                            sample_rate=settings.RECORD_TRAFFIC_SAMPLE_RATE,
+                                            max_bytes=settings.RECORD_TRAFFIC_MAX_BYTES)
+        self.consumer = SeftMessageConsumer(durable_queue=True, exchange=settings.RABBIT_EXCHANGE, exchange_type="topic",
+                                            rabbit_queue=queue, routing_key=routing_key, queue_arguments=queue_arguments,
+                                            rabbit_urls=settings.RABBIT_URLS, quarantine_publisher=self.publisher,
+                                            process=self.process_scheduled,
+                                            prefetch_count=max(settings.RABBIT_PREFETCH_COUNT, settings.CONSUMER_WORKERS),
+                                            recorder=self.recorder,
+                                            admission=AdmissionController(settings.MEMORY_BUDGET_BYTES,
+                                                                          settings.CONSUMER_WORKERS),
+                                            memory_estimate_factor=settings.MEMORY_ESTIMATE_FACTOR)
         self.session = requests.Session()
         retries = Retry(total=SERVICE_REQUEST_TOTAL_RETRIES,
                         backoff_factor=SERVICE_REQUEST_BACKOFF_FACTOR)
@@ -92,50 +234,167 @@ class SeftConsumer:
         self.session.mount('https://', HTTPAdapter(max_retries=retries))
 
     def process(self, encrypted_jwt, tx_id=None):
-
-        self.bound_logger = self.bound_logger.bind(tx_id=tx_id)
-        self.bound_logger.debug("Message Received")
+        """Decrypts, scans and delivers a message, raising the sdc.rabbit error for the way it failed."""
+        deadline = self._deadline(tx_id)
+        timeline = Timeline(tx_id, encrypted_bytes=len(encrypted_jwt))
         try:
-            self.bound_logger.info("Decrypting message")
-            decrypted_payload = self._decrypt(encrypted_jwt, tx_id)
-
-            self.bound_logger.info("Extracting file")
+            payload = self.prepare(encrypted_jwt, tx_id, deadline, timeline)
+            if payload is not None:
+                self.deliver(payload, tx_id, deadline, timeline)
+        except BaseException as e:
+            timeline.finish(e)
+            raise
+        timeline.finish()
+
+    def process_scheduled(self, encrypted_jwt, tx_id=None):
+        """Decrypts a message and hands it to the scheduler for scanning and delivery.
+
+        Returns the scheduler's Future, which completes (or raises) as `process` would. With the
+        fifo policy, or for a chunk that doesn't complete its file, the whole message is processed here.
+        """
+        if self.scheduler is None:
+            return self.process(encrypted_jwt, tx_id)
+        deadline = self._deadline(tx_id)
+        timeline = Timeline(tx_id, encrypted_bytes=len(encrypted_jwt))
+        try:
+            payload = self.prepare(encrypted_jwt, tx_id, deadline, timeline)
+        except BaseException as e:
+            timeline.finish(e)
+            raise
+        if payload is None:
+            timeline.finish()
+            return None
+        future = self.scheduler.submit(payload.survey_id, payload.size, self.deliver, payload, tx_id,
+                                       deadline, timeline)
+        future.add_done_callback(lambda done: timeline.finish(done.exception()))
+        return future
+
+    def _deadline(self, tx_id):
+        deadline = Deadline(settings.MESSAGE_DEADLINE, tx_id=tx_id)
+        with self._deadlines_lock:
+            if self._stopped:
+                deadline.cancel()
+            self._deadlines.add(deadline)
+        return deadline
+
+    def cancel_in_flight(self):
+        """Makes every message being worked on give up at its next deadline check, and any started later."""
+        with self._deadlines_lock:
+            self._stopped = True
+            deadlines = list(self._deadlines)
+        for deadline in deadlines:
+            deadline.cancel()
+        return len(deadlines)
+
+    def prepare(self, encrypted_jwt, tx_id=None, deadline=NO_DEADLINE, timeline=NO_TIMELINE):
+        """Decrypts a message and extracts its file, or None for a chunk that doesn't complete its file."""
+        # Messages are processed on several threads at once, so each gets its own bound logger
+        bound_logger = logger.bind(tx_id=tx_id)
+        bound_logger.debug("Message Received")
+        try:
+            bound_logger.info("Decrypting message")
+            deadline.check("decrypt")
+            with timeline.stage("decrypt"):
+                decrypted_payload = self._decrypt(encrypted_jwt, tx_id)
+
+            bound_logger.info("Extracting file")
+
+            with timeline.stage("extract"):
+                if 'chunk_count' in decrypted_payload:
+                    timeline.note(chunk_index=decrypted_payload.get('chunk_index'),
+                                  chunk_count=decrypted_payload['chunk_count'])
+                    payload = self.extract_chunk(decrypted_payload, tx_id)
+                    if payload is None:
+                        return None
+                else:
+                    payload = self.extract_file(decrypted_payload, tx_id)
+            timeline.note(survey_id=payload.survey_id, case_id=payload.case_id, bytes=payload.size)
+            return payload
 
-            payload = self.extract_file(decrypted_payload, tx_id)
-            self.bound_logger = self.bound_logger.bind(case_id=payload.case_id, survey_id=payload.survey_id)
+        except QuarantinableError:
+            metrics.increment("messages.quarantined")
+            bound_logger.error("Unable to process message")
+            raise
+        except TypeError:
+            bound_logger.exception()
+            raise
 
+    def deliver(self, payload, tx_id=None, deadline=NO_DEADLINE, timeline=NO_TIMELINE):
+        bound_logger = logger.bind(tx_id=tx_id, case_id=payload.case_id, survey_id=payload.survey_id)
+        try:
             if settings.ANTI_VIRUS_ENABLED:
-                av_check = AntiVirusCheck(tx_id=tx_id)
-                av_check.send_for_av_scan(payload)
+                deadline.check("anti_virus")
+                with timeline.stage("anti_virus"):
+                    av_check = self._anti_virus(tx_id=tx_id)
+                    av_check.send_for_av_scan(payload, deadline=deadline, timeline=timeline)
 
             file_path = self._get_ftp_file_path(payload.survey_id)
-            self.bound_logger.info("Sent to ftp server.", filename=payload.file_name)
-            self._send_to_ftp(payload.decoded_contents, file_path, payload.file_name, tx_id)
+            # Not delivered at all if the message has been abandoned while it was scanned
+            deadline.check("deliver")
+            bound_logger.info("Sent to ftp server.", filename=payload.file_name)
+            with timeline.stage("deliver"), payload.contents() as contents:
+                self._send_to_ftp(contents, file_path, payload.file_name, tx_id, deadline, timeline)
+            metrics.increment("messages.delivered")
+            metrics.increment("bytes.delivered", payload.size)
+            if payload.spill_path:
+                ChunkStore.discard(payload.spill_path)
 
         except QuarantinableError:
-            self.bound_logger.error("Unable to process message")
+            metrics.increment("messages.quarantined")
+            bound_logger.error("Unable to process message")
+            if payload.spill_path:
+                ChunkStore.discard(payload.spill_path)
             raise
         except TypeError:
-            self.bound_logger.exception()
+            bound_logger.exception()
             raise
+        finally:
+            if payload.temporary:
+                ChunkStore.discard(payload.spill_path)
 
-        self.bound_logger = self.bound_logger.try_unbind("survey_id", "case_id", "tx_id")
-
-    def _send_to_ftp(self, decoded_contents, file_path, file_name, tx_id):
+    def _send_to_ftp(self, decoded_contents, file_path, file_name, tx_id, deadline=NO_DEADLINE, timeline=NO_TIMELINE):
         try:
-            self._ftp.deliver_binary(file_path, file_name, decoded_contents)
+            self._ftp.deliver_binary(file_path, file_name, decoded_contents, deadline=deadline, timeline=timeline)
             logger.debug("Delivered to FTP server", tx_id=tx_id,
                          file_path=file_path, file_name=file_name)
-        except IOError as e:
+        except ftp_errors as e:
+            # ftplib raises EOFError if the server drops the control connection, and its own errors for 4xx/5xx replies
             logger.error("Unable to deliver to the FTP server",
                          action="nack",
                          exception=str(e),
                          tx_id=tx_id)
             raise RetryableError()
 
+    def listen_for_tuning(self):
+        """Resizes the consumer's workers and connections when their settings are changed at runtime."""
+        def prefetch(value):
+            self.consumer.set_prefetch(max(settings.RABBIT_PREFETCH_COUNT, settings.CONSUMER_WORKERS))
+
+        tuning.listen("CONSUMER_WORKERS", self.consumer.set_workers)
+        tuning.listen("CONSUMER_WORKERS", prefetch)
+        tuning.listen("RABBIT_PREFETCH_COUNT", prefetch)
+        if isinstance(self._ftp, (SDXFTP, ShardedFTP)):
+            tuning.listen("FTP_POOL_SIZE", self._ftp.resize)
+
+    def use_key_store(self, key_store):
+        """Swaps in new keys. Messages already being decrypted finish with the keys they started with."""
+        self.key_store = key_store
+
     def _decrypt(self, encrypted_jwt, tx_id):
+        key_store = self.key_store
+        try:
+            # Malformed or wrongly keyed tokens are quarantined before any RSA or AES work
+            check_jwe_header(encrypted_jwt, key_store, KEY_PURPOSE_CONSUMER, settings.MAX_TOKEN_BYTES)
+        except InvalidTokenException as e:
+            metrics.increment("messages.rejected_before_decrypt")
+            logger.error("Invalid token header",
+                         action="quarantining",
+                         exception=str(e),
+                         tx_id=tx_id)
+            raise QuarantinableError()
+
         try:
-            return decrypt(encrypted_jwt, self.key_store, KEY_PURPOSE_CONSUMER)
+            return decrypt(encrypted_jwt, key_store, KEY_PURPOSE_CONSUMER)
         except (InvalidTokenException, ValueError) as e:
             logger.error("Bad decrypt",
                          action="quarantining",
@@ -157,6 +416,20 @@ class SeftConsumer:
         logger.debug("Stopping consumer")
         self.consumer.stop()
 
+    def drain(self, grace):
+        """Stops taking messages, lets those in flight finish for up to `grace` seconds, then closes everything."""
+        self.consumer.drain(grace, on_drained=self._on_drained)
+
+    def _on_drained(self, report):
+        # The broker requeues abandoned messages as the channel closes, so they mustn't be delivered from here too
+        self.abandoned = report["abandoned"]
+        self.cancel_in_flight()
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        if hasattr(self._ftp, "close"):
+            self._ftp.close()
+        logger.info("SEFT consumer drained", **report)
+
     @staticmethod
     def _get_ftp_file_path(survey_id):
         file_path = "{0}/{1}".format(settings.FTP_FOLDER, survey_id)
@@ -164,9 +437,23 @@ class SeftConsumer:
 
 
 def make_app():
-    return tornado.web.Application([
+    handlers = [
         (r"/healthcheck", HealthCheck),
-    ])
+        (r"/readiness", ReadinessHandler),
+        (r"/capacity", CapacityHandler),
+        (r"/metrics", MetricsHandler),
+        (r"/debug/timelines", TimelineHandler),
+    ]
+    if settings.ADMIN_TOKEN:
+        handlers.append((r"/admin/profile", admin.ProfileHandler))
+        handlers.append((r"/admin/settings", admin.SettingsHandler))
+    return tornado.web.Application(handlers)
+
+
+def _forward_sigterm(signum, frame):
+    # The forked processes share the parent's process group; the parent exits once they all have
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    os.killpg(os.getpgrp(), signal.SIGTERM)
 
 
 def main():
@@ -175,15 +462,19 @@ def main():
     app = make_app()
     server = tornado.httpserver.HTTPServer(app)
     server.bind(int(os.getenv("SDX_SEFT_CONSUMER_SERVICE_PORT", '8080')))
+    # SIGHUP reloads keys in the forked processes; the parent, which only waits on them, ignores it
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    # SIGTERM sent to the parent is passed on to the forked processes, which drain and exit
+    signal.signal(signal.SIGTERM, _forward_sigterm)
     server.start(0)
 
-    with open(settings.SDX_SEFT_CONSUMER_KEYS_FILE) as file:
-        keys = yaml.safe_load(file)
+    if settings.ADMIN_TOKEN:
+        admin.enable()
 
     try:
+        loop = tornado.ioloop.IOLoop.current()
 
         # Create the scheduled health task
-
         task = GetHealth()
         sched = tornado.ioloop.PeriodicCallback(
             task.determine_health,
@@ -192,17 +483,59 @@ def main():
 
         sched.start()
         logger.info("Scheduled healthcheck started.")
+        capacity.signals.start(settings.CAPACITY_REFRESH_INTERVAL)
+
+        # Keys are loaded alongside the other startup work, and the consumer connects to rabbit
+        # meanwhile but only consumes once they are in place
+        seft_consumer = SeftConsumer(None)
+        seft_consumer.consumer.hold()
+        seft_consumer.listen_for_tuning()
+        tuning.listen("SEFT_CONSUMER_HEALTHCHECK_DELAY", lambda delay: setattr(sched, "callback_time", delay))
+
+        # Incomplete sets of chunks are cleaned up off the io loop, as removing them may take a while
+        if seft_consumer.chunks is not None:
+            tornado.ioloop.PeriodicCallback(lambda: loop.run_in_executor(None, seft_consumer.chunks.expire),
+                                            CHUNK_SWEEP_INTERVAL_MILLISECONDS).start()
+
+        def on_ready():
+            reloader = KeyStoreReloader(settings.SDX_SEFT_CONSUMER_KEYS_FILE, KEY_PURPOSE_CONSUMER,
+                                        seft_consumer.use_key_store)
+            reloader.start(settings.KEYS_RELOAD_INTERVAL)
+            signal.signal(signal.SIGHUP, lambda signum, frame: loop.add_callback_from_signal(reloader.reload))
+            seft_consumer.consumer.resume()
+            # Get initial health
+            task.determine_health()
+
+        def on_failed(error):
+            # Without keys there is nothing this process can do
+            loop.stop()
+
+        tasks = {"keys": lambda: seft_consumer.use_key_store(
+            load_key_store(settings.SDX_SEFT_CONSUMER_KEYS_FILE, KEY_PURPOSE_CONSUMER))}
+        if isinstance(seft_consumer._ftp, (SDXFTP, ShardedFTP)):
+            for i in range(settings.FTP_POOL_SIZE):
+                tasks["ftp_{}".format(i)] = functools.partial(seft_consumer._ftp.warm, settings.STARTUP_WARM_TIMEOUT)
+        if settings.ANTI_VIRUS_ENABLED:
+            tasks["anti_virus"] = functools.partial(anti_virus_check.warm, settings.STARTUP_WARM_TIMEOUT)
+
+        startup = Startup(tasks, on_ready, on_failed, required=("keys",))
+        seft_consumer.consumer.on_connected = lambda: startup.mark("rabbit")
+        loop.add_callback(startup.run)
+
+        def drain(signum, frame):
+            loop.add_callback_from_signal(seft_consumer.drain, settings.DRAIN_GRACE_PERIOD)
+
+        signal.signal(signal.SIGTERM, drain)
+        signal.signal(signal.SIGINT, drain)
 
-        # Get initial health
-        loop = tornado.ioloop.IOLoop.current()
-        loop.call_later(HEALTHCHECK_DELAY_MILLISECONDS, task.determine_health)
-
-        validate_required_keys(keys, KEY_PURPOSE_CONSUMER)
-        seft_consumer = SeftConsumer(keys)
         seft_consumer.run()
+        if seft_consumer.abandoned:
+            # Their deadlines are cancelled, but a worker blocked on a socket would keep the process
+            # alive until it timed out, as worker threads are joined at exit
+            logger.warning("Exiting without waiting for abandoned messages", abandoned=seft_consumer.abandoned)
+            logging.shutdown()
+            os._exit(0)
 
-    except CryptoError as e:
-        logger.critical("Unable to find valid keys", error=str(e))
     except KeyboardInterrupt:
         logger.debug("SEFT consumer service stopping")
         seft_consumer.stop()
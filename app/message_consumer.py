@@ -0,0 +1,303 @@
+import collections
+import concurrent.futures
+import functools
+import time
+
+from sdc.rabbit.consumers import MessageConsumer
+from sdc.rabbit.exceptions import BadMessageError, QuarantinableError, RetryableError
+
+from app import create_and_wrap_logger
+from app.admission import AdmissionController
+
+logger = create_and_wrap_logger(__name__)
+
+
+class SeftMessageConsumer(MessageConsumer):
+    """A MessageConsumer that processes messages on a pool of worker threads.
+
+       Deliveries are started through an AdmissionController, which limits how many are
+       processed at once and how much memory they may reserve. The worker only runs `process`;
+       acks, nacks and quarantines all happen back on the io loop, as pika is not thread safe.
+
+       Quarantined messages are handed to a batching QuarantinePublisher. The original delivery
+       is only rejected once the broker has confirmed the quarantine publish, so nothing is lost
+       if the broker goes away mid-batch, and processing of the next message carries on while
+       the confirm is outstanding.
+
+       A consumer put on `hold` connects as usual but only starts consuming once `resume` is
+       called, so the service can connect to rabbit while it is still starting up.
+
+       `drain` stops the consumer taking new messages and gives those being processed a grace
+       period to finish and be settled before the connection is closed. Anything unsettled by
+       then is requeued by the broker as the channel closes, and whatever `on_drained` is given
+       must stop the work still going on for it."""
+
+    def __init__(self, prefetch_count=1, recorder=None, admission=None, memory_estimate_factor=1, routing_key=None,
+                 queue_arguments=None, **kwargs):
+        super().__init__(**kwargs)
+        self.prefetch_count = prefetch_count
+        # Lets the publisher tell when no more deliveries can arrive to fill a quarantine batch
+        self.quarantine_publisher.prefetch_count = prefetch_count
+        # The queue is bound with its own name as the routing key unless told otherwise
+        self.routing_key = routing_key
+        self.queue_arguments = queue_arguments
+        self.recorder = recorder
+        self.admission = admission or AdmissionController(budget_bytes=0, max_in_flight=1)
+        self.memory_estimate_factor = memory_estimate_factor
+        self._workers = self.admission.max_in_flight
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._workers,
+                                                               thread_name_prefix="seft-worker")
+        # Called each time the channel is ready to consume on
+        self.on_connected = None
+        self._held = False
+        self._waiting = False
+        # Messages started and not yet settled, including those handed off to a scheduler
+        self._active = 0
+        self._draining = False
+        self._drained = collections.Counter()
+
+    def on_channel_open(self, channel):
+        super().on_channel_open(channel)
+        self.quarantine_publisher.open(self._connection)
+
+    def setup_queue(self, queue_name):
+        logger.info('Declaring queue', name=queue_name, arguments=self.queue_arguments)
+        self._channel.queue_declare(queue=queue_name,
+                                    durable=self._durable_queue,
+                                    arguments=self.queue_arguments,
+                                    callback=self.on_queue_declareok)
+
+    def on_queue_declareok(self, _unused_frame):
+        logger.info('Binding to rabbit', exchange=self._exchange, queue=self._queue, routing_key=self.routing_key)
+        self._channel.queue_bind(self._queue,
+                                 self._exchange,
+                                 routing_key=self.routing_key,
+                                 callback=self.on_bindok)
+
+    def hold(self):
+        """Keeps the consumer from consuming once it has connected, until `resume` is called."""
+        self._held = True
+
+    def resume(self):
+        self._held = False
+        waiting, self._waiting = self._waiting, False
+        if waiting and self._channel is not None and self._channel.is_open:
+            self._consume()
+
+    def start_consuming(self):
+        if self.on_connected:
+            self.on_connected()
+        if self._held:
+            logger.info('Connected, waiting until ready before consuming')
+            self._waiting = True
+            return
+        self._consume()
+
+    def _consume(self):
+        logger.info('Issuing consumer related RPC commands', prefetch_count=self.prefetch_count)
+        self.add_on_cancel_callback()
+        self._channel.basic_qos(prefetch_count=self.prefetch_count)
+        self._consumer_tag = self._channel.basic_consume(self._queue, self.on_message)
+
+    def set_workers(self, workers):
+        """Changes how many messages are processed at once. Messages already being processed carry on."""
+        if workers > self._workers:
+            # Worker pools can't grow, so new messages go to a bigger one and the old one winds down
+            previous, self._executor = self._executor, concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="seft-worker")
+            previous.shutdown(wait=False)
+            self._workers = workers
+        self.admission.set_max_in_flight(workers)
+
+    def set_prefetch(self, prefetch_count):
+        """Changes the prefetch count, consuming again so it applies to the consumer already running.
+
+        Messages delivered before the change stay unacknowledged on the channel and are settled as usual.
+        """
+        self.prefetch_count = prefetch_count
+        self.quarantine_publisher.prefetch_count = prefetch_count
+        channel = self._channel
+        if self._consumer_tag is None or self._waiting or not self._is_current(channel):
+            return
+        logger.info('Changing prefetch count', prefetch_count=prefetch_count)
+        channel.basic_qos(prefetch_count=prefetch_count)
+        channel.basic_cancel(self._consumer_tag, callback=lambda frame: self._consume_again(channel))
+
+    def _consume_again(self, channel):
+        if self._is_current(channel) and not self._closing:
+            self._consumer_tag = channel.basic_consume(self._queue, self.on_message)
+
+    def stop(self):
+        self.quarantine_publisher.flush()
+        super().stop()
+
+    def drain(self, grace, on_drained=None, clock=time.monotonic):
+        """Stops consuming, waits up to `grace` seconds for messages being processed to be settled, then closes.
+
+        Messages delivered but not yet started are left unacknowledged and requeued when the channel
+        closes. `on_drained` is called with a report of what happened to each message just before
+        the connection is closed, and the io loop stops once it has.
+        """
+        if self._draining:
+            return
+        self._draining = True
+        started = clock()
+        channel = self._channel
+        if self._consumer_tag is not None and not self._waiting and self._is_current(channel):
+            # Cancelled with a callback of our own, so the channel stays open to settle messages on
+            channel.basic_cancel(self._consumer_tag, callback=lambda frame: None)
+        self._drained["requeued"] += self.admission.clear()
+        logger.info("Draining", in_flight=self._active, requeued=self._drained["requeued"], grace=grace)
+        self._check_drained(started, started + grace, on_drained, clock)
+
+    def _check_drained(self, started, deadline, on_drained, clock):
+        if self._active == 0 and self.quarantine_publisher.pending:
+            self.quarantine_publisher.flush()
+        idle = self._active == 0 and not self.quarantine_publisher.pending
+        if not idle and clock() < deadline and self._connection is not None:
+            self._connection.ioloop.call_later(0.1, self._check_drained, started, deadline, on_drained, clock)
+            return
+
+        report = {outcome: self._drained[outcome] for outcome in ("completed", "quarantined", "nacked", "requeued")}
+        report.update(abandoned=self._active, elapsed=round(clock() - started, 3))
+        if idle:
+            logger.info("Drained", **report)
+        else:
+            logger.warning("Grace period over, abandoning messages still in flight", **report)
+        if on_drained:
+            on_drained(report)
+        self._close()
+
+    def _close(self):
+        self._closing = True
+        # Messages waiting for a worker would have nowhere to be settled once the channel has closed
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self.quarantine_publisher.close()
+        if self._channel is not None and self._channel.is_open:
+            # Closing the channel closes the connection, which stops the io loop
+            self.close_channel()
+        elif self._connection is not None and not (self._connection.is_closing or self._connection.is_closed):
+            self.close_connection()
+        elif self._connection is not None:
+            self._connection.ioloop.stop()
+
+    def on_connection_open_error(self, connection, error):
+        if self._closing:
+            # Closed while still connecting, so there is nothing to reconnect for
+            logger.info('Connection closed before it opened, stopping ioloop', error=error)
+            connection.ioloop.stop()
+            return
+        super().on_connection_open_error(connection, error)
+
+    def on_message(self, unused_channel, basic_deliver, properties, body):
+        try:
+            tx_id = self.tx_id(properties)
+            logger.info('Received message',
+                        queue=self._queue,
+                        delivery_tag=basic_deliver.delivery_tag,
+                        app_id=properties.app_id,
+                        tx_id=tx_id)
+        except KeyError:
+            self.reject_message(basic_deliver.delivery_tag)
+            logger.exception("Bad message properties - no tx_id", action="rejected")
+            return
+        except TypeError:
+            self.reject_message(basic_deliver.delivery_tag)
+            logger.exception("Bad message properties - no headers", action="rejected")
+            return
+
+        if self._draining:
+            # Delivered before the cancel reached the broker; requeued once the channel closes
+            self._drained["requeued"] += 1
+            logger.info("Draining, leaving message to be requeued", tx_id=tx_id)
+            return
+
+        if self.recorder:
+            try:
+                self.recorder.record(body, properties.headers)
+            except (IOError, ValueError):
+                logger.exception("Unable to record message", tx_id=tx_id)
+
+        estimate = len(body) * self.memory_estimate_factor
+        self.admission.submit(estimate, functools.partial(self._start, self._channel, basic_deliver.delivery_tag,
+                                                          body, tx_id, estimate))
+
+    def _start(self, channel, delivery_tag, body, tx_id, estimate):
+        if not self._is_current(channel):
+            # The broker has already requeued everything delivered on the old channel
+            self.admission.release(estimate)
+            return
+        ioloop = self._connection.ioloop
+        self._active += 1
+        future = self._executor.submit(self._process, body, tx_id)
+        future.add_done_callback(lambda done: ioloop.add_callback(self._on_processed, done, channel,
+                                                                  delivery_tag, body, tx_id, estimate))
+
+    def _process(self, body, tx_id):
+        try:
+            return self.process(body.decode("utf-8"), tx_id)
+        except TypeError:
+            logger.error('Incorrect call to process method')
+            raise QuarantinableError
+
+    def _on_processed(self, future, channel, delivery_tag, body, tx_id, estimate, slot=True):
+        if future.cancelled():
+            # Never started, and requeued by the broker as the channel closed
+            self.admission.release(estimate, slot=slot)
+            self._active -= 1
+            return
+        if slot and future.exception() is None and isinstance(future.result(), concurrent.futures.Future):
+            # `process` has handed the rest of the work to a scheduler; free the worker for the
+            # next delivery but keep the memory reserved until the handed off work is done
+            self.admission.release_slot()
+            ioloop = self._connection.ioloop
+            future.result().add_done_callback(
+                lambda done: ioloop.add_callback(self._on_processed, done, channel, delivery_tag, body, tx_id,
+                                                 estimate, False))
+            return
+
+        self.admission.release(estimate, slot=slot)
+        self._active -= 1
+        if not self._is_current(channel):
+            logger.warning("Channel closed while processing, message will be redelivered", tx_id=tx_id)
+            return
+        try:
+            future.result()
+            self.acknowledge_message(delivery_tag, tx_id=tx_id)
+            outcome = "completed"
+        except (QuarantinableError, BadMessageError):
+            logger.exception("Quarantinable error occured", action="quarantining", tx_id=tx_id)
+            self.quarantine(channel, delivery_tag, body, tx_id)
+            outcome = "quarantined"
+        except RetryableError:
+            self.nack_message(delivery_tag, tx_id=tx_id)
+            logger.exception("Failed to process", action="nack", tx_id=tx_id)
+            outcome = "nacked"
+        except Exception:
+            self.nack_message(delivery_tag, tx_id=tx_id)
+            logger.exception("Unexpected exception occurred, failed to process", action="nack", tx_id=tx_id)
+            outcome = "nacked"
+        if self._draining:
+            self._drained[outcome] += 1
+
+    def _is_current(self, channel):
+        return channel is not None and channel is self._channel and channel.is_open
+
+    def quarantine(self, channel, delivery_tag, body, tx_id):
+        """Queues the message for the quarantine queue, settling the delivery once the publish is confirmed.
+
+        Delivery tags are only valid on the channel they arrived on, so if the channel has been
+        replaced by the time the confirm arrives the delivery has already been requeued by the broker
+        and there is nothing left to settle.
+        """
+        def on_confirmed():
+            if self._is_current(channel):
+                self.reject_message(delivery_tag, tx_id=tx_id)
+                logger.info("Message quarantined", action="quarantined", tx_id=tx_id)
+
+        def on_failed():
+            if self._is_current(channel):
+                logger.error("Unable to publish message to quarantine queue. Rejecting message and requeuing.", tx_id=tx_id)
+                self.reject_message(delivery_tag, requeue=True, tx_id=tx_id)
+
+        self.quarantine_publisher.quarantine(body, {'tx_id': tx_id}, on_confirmed, on_failed)
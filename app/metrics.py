@@ -0,0 +1,101 @@
+import collections
+import contextlib
+import threading
+import time
+
+from tornado.web import RequestHandler
+
+
+class Timing:
+    """Count, total and max of a timing, plus a window of recent samples for percentiles."""
+
+    def __init__(self, sample_size):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = collections.deque(maxlen=sample_size)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.samples.append(seconds)
+
+    def summary(self):
+        samples = sorted(self.samples)
+
+        def percentile(p):
+            return round(samples[min(len(samples) - 1, int(len(samples) * p))], 6) if samples else 0
+
+        return {
+            "count": self.count,
+            "mean": round(self.total / self.count, 6) if self.count else 0,
+            "p50": percentile(0.50),
+            "p95": percentile(0.95),
+            "p99": percentile(0.99),
+            "max": round(self.max, 6),
+        }
+
+
+class Metrics:
+    """In-process counters, gauges and timings, safe to update from any thread."""
+
+    def __init__(self, sample_size=1024):
+        self.sample_size = sample_size
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counters = collections.defaultdict(int)
+            self._gauges = {}
+            self._timings = {}
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            timing = self._timings.get(name)
+            if timing is None:
+                timing = self._timings[name] = Timing(self.sample_size)
+            timing.observe(seconds)
+
+    def recent_mean(self, name):
+        """The mean of the recent samples of a timing, or None if it has none."""
+        with self._lock:
+            timing = self._timings.get(name)
+            if timing is None or not timing.samples:
+                return None
+            return sum(timing.samples) / len(timing.samples)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+                "timings": {name: timing.summary() for name, timing in self._timings.items()},
+            }
+
+
+metrics = Metrics()
+
+
+class MetricsHandler(RequestHandler):
+    """Returns the metrics of the process that handles the request."""
+
+    def get(self):
+        self.write(metrics.snapshot())
@@ -0,0 +1,152 @@
+"""Runs encrypted submissions from disk through the SeftConsumer pipeline without rabbit.
+
+Used for backfills and migrations. Submissions are either a directory of files each holding
+one encrypted JWT, or a JSON lines stream of {"tx_id": ..., "jwt": ...} records (use - for
+stdin). Each worker process has its own SeftConsumer, so decryption, A/V and delivery all
+run in parallel. Files go to the FTP server unless --output is given.
+
+    python -m app.offline encrypted_files/ --output /tmp/seft --workers 8
+    cat backlog.jsonl | python -m app.offline -
+"""
+import argparse
+import collections
+import concurrent.futures
+import json
+import os
+import sys
+import time
+import uuid
+
+from sdc.rabbit.exceptions import BadMessageError, QuarantinableError, RetryableError
+import yaml
+
+from app import create_and_wrap_logger
+from app import settings
+from app.delivery import LocalDirectoryDelivery
+from app.main import SeftConsumer
+
+logger = create_and_wrap_logger(__name__)
+
+# A submission that couldn't be read has the reason in `error`, and is counted as failed
+Submission = collections.namedtuple('Submission', 'tx_id source jwt error', defaults=(None,))
+
+_consumer = None
+
+
+def read_directory(path):
+    """Yields a submission for every file in `path`, the JWT is read by the worker."""
+    for entry in sorted(os.scandir(path), key=lambda e: e.name):
+        if entry.is_file() and not entry.name.startswith('.'):
+            yield Submission(tx_id=str(uuid.uuid4()), source=entry.path, jwt=None)
+
+
+def read_jsonl(stream, name="stdin"):
+    for line_number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        source = "{}:{}".format(name, line_number)
+        try:
+            record = json.loads(line)
+            yield Submission(tx_id=record.get('tx_id') or str(uuid.uuid4()), source=source, jwt=record['jwt'])
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            yield Submission(tx_id=None, source=source, jwt=None, error=repr(e))
+
+
+def read_jsonl_file(path):
+    """Yields the submissions in the JSON lines file at `path` as it is read, rather than all at once."""
+    with open(path) as stream:
+        yield from read_jsonl(stream, name=path)
+
+
+def read_source(source):
+    if source == '-':
+        return read_jsonl(sys.stdin)
+    if os.path.isdir(source):
+        return read_directory(source)
+    return read_jsonl_file(source)
+
+
+def _init_worker(keys, output, skip_av):
+    global _consumer
+    if skip_av:
+        settings.ANTI_VIRUS_ENABLED = False
+    delivery = LocalDirectoryDelivery(logger, output) if output else None
+    _consumer = SeftConsumer(keys, delivery=delivery)
+
+
+def process_submission(submission):
+    """Runs in a worker process, returning the outcome for the submission."""
+    jwt = submission.jwt
+    if jwt is None:
+        with open(submission.source) as encrypted_file:
+            jwt = encrypted_file.read().strip()
+    try:
+        _consumer.process(jwt, submission.tx_id)
+        return "delivered"
+    except (QuarantinableError, BadMessageError):
+        return "quarantined"
+    except RetryableError:
+        return "failed"
+
+
+def run(submissions, keys, output=None, workers=None, skip_av=False):
+    """Processes every submission, returning a count of each outcome."""
+    workers = workers or os.cpu_count()
+    counts = collections.Counter()
+    started = time.monotonic()
+    pending = {}
+
+    def settle(done):
+        for future in done:
+            submission = pending.pop(future)
+            try:
+                outcome = future.result()
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error("Unexpected error processing submission", source=submission.source, exception=repr(e))
+                outcome = "failed"
+            if outcome != "delivered":
+                logger.error("Submission not delivered", outcome=outcome, source=submission.source, tx_id=submission.tx_id)
+            counts[outcome] += 1
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                initializer=_init_worker,
+                                                initargs=(keys, output, skip_av)) as pool:
+        for submission in submissions:
+            if submission.error:
+                logger.error("Unreadable submission", source=submission.source, error=submission.error)
+                counts["failed"] += 1
+                continue
+            # Bound the submissions held in memory when reading a large stream
+            if len(pending) >= workers * 2:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                settle(done)
+            pending[pool.submit(process_submission, submission)] = submission
+        settle(concurrent.futures.wait(pending).done)
+
+    elapsed = time.monotonic() - started
+    logger.info("Offline batch complete", elapsed=round(elapsed, 2),
+                rate=round(sum(counts.values()) / max(elapsed, 0.001), 1), **counts)
+    return counts
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Process encrypted SEFT submissions from disk")
+    parser.add_argument('source', help="directory of encrypted files, a .jsonl file, or - to stream JSON lines from stdin")
+    parser.add_argument('--output', help="deliver to this directory instead of the FTP server")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument('--keys-file', default=settings.SDX_SEFT_CONSUMER_KEYS_FILE)
+    parser.add_argument('--skip-av', action='store_true', help="don't send files for A/V scanning")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with open(args.keys_file) as file:
+        keys = yaml.safe_load(file)
+    counts = run(read_source(args.source), keys, output=args.output, workers=args.workers, skip_av=args.skip_av)
+    return 0 if counts["delivered"] == sum(counts.values()) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
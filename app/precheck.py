@@ -0,0 +1,53 @@
+import base64
+import binascii
+import json
+
+from sdc.crypto.exceptions import InvalidTokenException
+
+# What sdc.crypto's JWEHelper decrypts with
+ALGORITHM = "RSA-OAEP"
+ENCRYPTION = "A256GCM"
+
+# Bigger than any header we produce, small enough that decoding one costs nothing
+MAX_HEADER_BYTES = 4096
+
+
+def check_jwe_header(token, key_store, purpose, max_bytes=0):
+    """Rejects a compact JWE that can't be decrypted, by looking only at its size, shape and header.
+
+    Raises InvalidTokenException if the token is bigger than `max_bytes` (0 for no limit), isn't
+    five segments, or its protected header asks for an algorithm, encryption or key we don't have
+    a private key for under `purpose`. Nothing proportional to the size of the token is allocated.
+    """
+    if max_bytes and len(token) > max_bytes:
+        raise InvalidTokenException("Token of {} bytes is over the limit of {}".format(len(token), max_bytes))
+
+    separators = []
+    position = token.find(".")
+    while position != -1 and len(separators) < 5:
+        separators.append(position)
+        position = token.find(".", position + 1)
+    if len(separators) != 4:
+        raise InvalidTokenException("Incorrect number of tokens")
+
+    header_end, key_end, iv_end, ciphertext_end = separators
+    if not header_end or header_end > MAX_HEADER_BYTES:
+        raise InvalidTokenException("Missing or oversized header")
+    if key_end == header_end + 1 or iv_end == key_end + 1 or ciphertext_end == iv_end + 1 \
+            or ciphertext_end == len(token) - 1:
+        raise InvalidTokenException("Empty token segment")
+
+    encoded = token[:header_end]
+    try:
+        header = json.loads(base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4)))
+    except (binascii.Error, ValueError) as e:
+        raise InvalidTokenException("Invalid Header") from e
+    if not isinstance(header, dict):
+        raise InvalidTokenException("Invalid Header")
+
+    if header.get("alg") != ALGORITHM or header.get("enc") != ENCRYPTION:
+        raise InvalidTokenException("Unsupported alg {} or enc {}".format(header.get("alg"), header.get("enc")))
+    if "kid" not in header:
+        raise InvalidTokenException("Missing kid")
+    key_store.get_private_key_by_kid(purpose, header["kid"])
+    return header
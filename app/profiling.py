@@ -0,0 +1,94 @@
+import collections
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+from app import create_and_wrap_logger
+
+logger = create_and_wrap_logger(__name__)
+
+KINDS = ("cpu", "memory")
+
+# One profile at a time per process; a second would skew the first and tracemalloc is process wide
+_running = threading.Lock()
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+def _collapse(frame, thread_name):
+    stack = []
+    while frame is not None:
+        stack.append("{}:{}".format(frame.f_globals.get("__name__", "?"), frame.f_code.co_name))
+        frame = frame.f_back
+    stack.append(thread_name)
+    return ";".join(reversed(stack))
+
+
+def sample_stacks(seconds, interval=0.005):
+    """Samples the stack of every other thread every `interval` seconds, returning a Counter of
+       collapsed stacks (`thread;module:function;...`) ready for flamegraph tools."""
+    stacks = collections.Counter()
+    me = threading.get_ident()
+    samples = 0
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():  # pylint: disable=protected-access
+            if ident != me:
+                stacks[_collapse(frame, names.get(ident, str(ident)))] += 1
+        samples += 1
+        time.sleep(interval)
+    return samples, stacks
+
+
+def allocation_diff(seconds, limit):
+    """Traces allocations for `seconds`, returning the `limit` call sites whose memory grew the most."""
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start(25)
+    try:
+        before = tracemalloc.take_snapshot()
+        time.sleep(seconds)
+        after = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        if started:
+            tracemalloc.stop()
+
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    stats = after.filter_traces(filters).compare_to(before.filter_traces(filters), "traceback")
+    return {
+        "traced_bytes": current,
+        "peak_bytes": peak,
+        "allocations": [{
+            "size_diff": stat.size_diff,
+            "size": stat.size,
+            "count_diff": stat.count_diff,
+            "count": stat.count,
+            "traceback": stat.traceback.format(most_recent_first=True),
+        } for stat in stats[:limit]],
+    }
+
+
+def profile(kind, seconds, limit=50):
+    """Profiles this process for `seconds`, returning a JSON serialisable result.
+
+    Raises ProfilerBusy if a profile is already running.
+    """
+    if not _running.acquire(blocking=False):
+        raise ProfilerBusy()
+    try:
+        logger.info("Profiling", kind=kind, seconds=seconds)
+        result = {"pid": os.getpid(), "kind": kind, "seconds": seconds}
+        if kind == "cpu":
+            samples, stacks = sample_stacks(seconds)
+            result.update(samples=samples, stacks=dict(stacks.most_common()))
+        else:
+            result.update(allocation_diff(seconds, limit))
+        return result
+    finally:
+        _running.release()
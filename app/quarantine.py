@@ -0,0 +1,184 @@
+import collections
+import time
+
+import pika
+from pika.spec import Basic
+
+from app import create_and_wrap_logger
+
+logger = create_and_wrap_logger(__name__)
+
+PendingQuarantine = collections.namedtuple('PendingQuarantine', 'body headers on_confirmed on_failed')
+
+
+class QuarantinePublisher:
+    """Publishes quarantined messages in batches over a channel in confirm mode.
+
+       Rather than opening a blocking connection and waiting for the broker for every
+       quarantined message, messages are buffered until either `batch_size` messages are
+       waiting or `batch_window` seconds have passed since the first one arrived. The batch
+       is then published on a dedicated channel of the consumer's own connection and the
+       broker confirms arrive asynchronously on the io loop.
+
+       `on_confirmed` is only called once the broker has confirmed the quarantine publish,
+       so the caller can safely settle the original delivery at that point. If the broker
+       nacks the publish, or the channel goes away before the confirm arrives, `on_failed`
+       is called instead so the original delivery can be requeued.
+
+       Deliveries stay unacknowledged until their quarantine is confirmed, so once every one the
+       consumer's `prefetch_count` allows is waiting here no more can arrive to fill the batch,
+       and it is published straight away rather than after the window."""
+
+    def __init__(self, queue, batch_size, batch_window, prefetch_count=None):
+        self.queue = queue
+        self.batch_size = max(1, batch_size)
+        self.batch_window = batch_window
+        self.prefetch_count = prefetch_count
+        self._connection = None
+        self._channel = None
+        self._ready = False
+        self._buffer = []
+        self._unconfirmed = collections.OrderedDict()
+        self._next_delivery_tag = 1
+        self._flush_timeout = None
+
+    def open(self, connection):
+        """Opens the confirm channel on the given (already open) connection."""
+        self._connection = connection
+        self._ready = False
+        logger.info("Opening quarantine channel", queue=self.queue)
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    @property
+    def pending(self):
+        """How many messages are buffered or waiting for a confirm."""
+        return len(self._buffer) + len(self._unconfirmed)
+
+    def close(self):
+        """Closes the confirm channel, failing anything that has not been confirmed."""
+        self._cancel_flush_timeout()
+        self._fail_outstanding("Quarantine publisher closed")
+        if self._channel and self._channel.is_open:
+            self._channel.close()
+        self._channel = None
+
+    def quarantine(self, body, headers, on_confirmed, on_failed):
+        """Buffers a message for publishing to the quarantine queue."""
+        self._buffer.append(PendingQuarantine(body=body, headers=headers,
+                                              on_confirmed=on_confirmed, on_failed=on_failed))
+        if len(self._buffer) >= self.batch_size or (self.prefetch_count and self.pending >= self.prefetch_count):
+            self.flush()
+        elif self._flush_timeout is None and self._connection is not None:
+            self._flush_timeout = self._connection.ioloop.call_later(self.batch_window, self.flush)
+
+    def flush(self):
+        """Publishes every buffered message. Confirms are handled by `_on_delivery_confirmation`."""
+        self._cancel_flush_timeout()
+        if not self._ready:
+            if len(self._buffer) > self.batch_size:
+                # Bound the buffer while the channel is unavailable, the oldest messages go back on their queue
+                overflow = self._buffer[:-self.batch_size]
+                self._buffer = self._buffer[-self.batch_size:]
+                for pending in overflow:
+                    pending.on_failed()
+                logger.warning("Quarantine channel not ready, requeued overflow", count=len(overflow))
+            return
+
+        batch, self._buffer = self._buffer, []
+        for pending in batch:
+            try:
+                self._channel.basic_publish(exchange='',
+                                            routing_key=self.queue,
+                                            body=pending.body,
+                                            properties=pika.BasicProperties(headers=pending.headers,
+                                                                            delivery_mode=2,
+                                                                            timestamp=int(time.time())))
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Unable to publish message to quarantine queue", tx_id=pending.headers.get('tx_id'))
+                pending.on_failed()
+                continue
+            self._unconfirmed[self._next_delivery_tag] = pending
+            self._next_delivery_tag += 1
+
+        if batch:
+            logger.info("Published quarantine batch", queue=self.queue, count=len(batch),
+                        unconfirmed=len(self._unconfirmed))
+
+    def _on_channel_open(self, channel):
+        self._channel = channel
+        self._next_delivery_tag = 1
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.queue_declare(queue=self.queue, durable=True, callback=self._on_queue_declareok)
+
+    def _on_queue_declareok(self, _unused_frame):
+        self._channel.confirm_delivery(self._on_delivery_confirmation, callback=self._on_confirm_selectok)
+
+    def _on_confirm_selectok(self, _unused_frame):
+        logger.info("Quarantine channel ready", queue=self.queue)
+        self._ready = True
+        if self._buffer:
+            self.flush()
+
+    def _on_channel_closed(self, channel, reason):
+        logger.warning("Quarantine channel closed", reason=str(reason))
+        self._ready = False
+        self._channel = None
+        self._cancel_flush_timeout()
+        self._fail_outstanding("Quarantine channel closed")
+
+    def _on_delivery_confirmation(self, method_frame):
+        method = method_frame.method
+        if method.multiple:
+            delivery_tags = [tag for tag in self._unconfirmed if tag <= method.delivery_tag]
+        else:
+            delivery_tags = [method.delivery_tag]
+
+        confirmed = isinstance(method, Basic.Ack)
+        for tag in delivery_tags:
+            pending = self._unconfirmed.pop(tag, None)
+            if pending is None:
+                continue
+            if confirmed:
+                pending.on_confirmed()
+            else:
+                logger.error("Quarantine publish nacked by broker", tx_id=pending.headers.get('tx_id'))
+                pending.on_failed()
+
+    def _fail_outstanding(self, reason):
+        outstanding = list(self._unconfirmed.values()) + self._buffer
+        self._unconfirmed.clear()
+        self._buffer = []
+        if outstanding:
+            logger.warning(reason, action="requeue", count=len(outstanding))
+        for pending in outstanding:
+            pending.on_failed()
+
+    def _cancel_flush_timeout(self):
+        if self._flush_timeout is not None and self._connection is not None:
+            self._connection.ioloop.remove_timeout(self._flush_timeout)
+        self._flush_timeout = None
+
+
+class DiscardingQuarantinePublisher:
+    """Stands in for QuarantinePublisher in shadow mode, confirming every message without publishing it.
+
+       Shadow consumers work on copies of production messages, so what they would quarantine is
+       only counted and logged, and the copy is dropped."""
+
+    pending = 0
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def open(self, connection):
+        pass
+
+    def close(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def quarantine(self, body, headers, on_confirmed, on_failed):
+        logger.info("Shadow mode, not publishing to quarantine queue", queue=self.queue, tx_id=headers.get('tx_id'))
+        on_confirmed()
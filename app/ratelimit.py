@@ -0,0 +1,172 @@
+import contextlib
+import fcntl
+import os
+import struct
+import threading
+import time
+
+
+class TokenBucket:
+    """A thread safe token bucket.
+
+       Tokens are added at `rate` per second up to `capacity`. A rate of 0 means unlimited,
+       in which case acquiring never waits."""
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1, rate)
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = self.capacity
+        self._updated = clock()
+
+    def try_acquire(self, tokens=1):
+        """Takes `tokens` if they are available, returning 0. Otherwise returns the number of seconds to wait."""
+        if not self.rate:
+            return 0
+        with self._lock:
+            self._tokens, self._updated, wait = self._take(self._tokens, self._updated, tokens)
+            return wait
+
+    def _take(self, available, updated, tokens):
+        now = self._clock()
+        available = min(self.capacity, available + max(0, now - updated) * self.rate)
+        if available >= tokens:
+            return available - tokens, now, 0
+        return available, now, (tokens - available) / self.rate
+
+    def set_rate(self, rate, capacity=None):
+        """Changes the rate, and the capacity as the constructor would, for callers already waiting too."""
+        with self._lock:
+            self.rate = rate
+            self.capacity = capacity if capacity is not None else max(1, rate)
+            self._tokens = min(self._tokens, self.capacity)
+
+    def acquire(self, tokens=1):
+        """Blocks until `tokens` have been taken from the bucket."""
+        wait = self.try_acquire(tokens)
+        while wait:
+            self._sleep(wait)
+            wait = self.try_acquire(tokens)
+
+
+class SharedTokenBucket(TokenBucket):
+    """A TokenBucket shared by every process on the host using the same `path`.
+
+       The bucket lives in a small file, locked with flock while tokens are taken, so the forked
+       tornado processes (and any scripts) draw from one rate between them. The clock has to be
+       one every process agrees on, hence wall clock time rather than monotonic."""
+
+    _state = struct.Struct(">dd")
+
+    def __init__(self, path, rate, capacity=None, clock=time.time, sleep=time.sleep):
+        super().__init__(rate, capacity=capacity, clock=clock, sleep=sleep)
+        self.path = path
+
+    def try_acquire(self, tokens=1):
+        if not self.rate:
+            return 0
+        # flock is held per open file, so threads in this process still need to take turns
+        with self._lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                state = os.pread(fd, self._state.size, 0)
+                if len(state) == self._state.size:
+                    available, updated = self._state.unpack(state)
+                else:
+                    available, updated = self.capacity, self._clock()
+                available, updated, wait = self._take(available, updated, tokens)
+                os.pwrite(fd, self._state.pack(available, updated), 0)
+                return wait
+            finally:
+                os.close(fd)
+
+
+class ConcurrencyLimit:
+    """Limits how many callers hold a slot at once, like a semaphore whose size can change.
+
+       Lowering the limit doesn't take slots back; new callers wait until enough are released."""
+
+    def __init__(self, limit):
+        self.limit = max(1, limit)
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, timeout=None):
+        """Blocks until a call may start, returning False if `timeout` seconds pass first."""
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.in_flight < self.limit, timeout):
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    @contextlib.contextmanager
+    def slot(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def set_limit(self, limit):
+        with self._condition:
+            self.limit = max(1, limit)
+            self._condition.notify_all()
+
+
+class AIMDLimiter(ConcurrencyLimit):
+    """Limits how many calls to a service are in flight, adapting the limit to how it copes.
+
+       The limit starts at `maximum`. Every `increase_after` successful calls it goes up by one
+       (additive increase); when the service reports it is overloaded it is multiplied by
+       `decrease_factor` (multiplicative decrease), never going below `minimum`. Overloads
+       reported within `cooldown` seconds of a decrease are put down to calls that were already
+       in flight and don't decrease it again."""
+
+    def __init__(self, maximum, minimum=1, increase_after=10, decrease_factor=0.5, cooldown=5,
+                 clock=time.monotonic):
+        super().__init__(maximum)
+        self.maximum = self.limit
+        self.minimum = max(1, min(minimum, self.maximum))
+        self.increase_after = increase_after
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self._clock = clock
+        self._successes = 0
+        self._decreased = None
+
+    def set_bounds(self, maximum, minimum):
+        """Changes the bounds, starting again from the new maximum, as an operator asking for
+        more (or less) wants it now rather than after the next few increases."""
+        with self._condition:
+            self.maximum = max(1, maximum)
+            self.minimum = max(1, min(minimum, self.maximum))
+            self.limit = self.maximum
+            self._successes = 0
+            self._condition.notify_all()
+
+    def on_success(self):
+        with self._condition:
+            self._successes += 1
+            if self._successes >= self.increase_after and self.limit < self.maximum:
+                self._successes = 0
+                self.limit += 1
+                self._condition.notify()
+
+    def on_overload(self):
+        """Returns True if the limit was lowered."""
+        with self._condition:
+            now = self._clock()
+            if self._decreased is not None and now - self._decreased < self.cooldown:
+                return False
+            self._decreased = now
+            self._successes = 0
+            self.limit = max(self.minimum, int(self.limit * self.decrease_factor))
+            return True
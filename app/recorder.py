@@ -0,0 +1,68 @@
+import json
+import random
+import struct
+import threading
+import time
+
+from app import create_and_wrap_logger
+
+logger = create_and_wrap_logger(__name__)
+
+MAGIC = b"SEFTREC1"
+
+# received time, length of the JSON headers, length of the (still encrypted) body
+RECORD_HEADER = struct.Struct(">dII")
+
+
+class TrafficRecorder:
+    """Appends consumed messages to a file so the traffic can be replayed later.
+
+       Each record is the time the message was received, its headers as JSON and its body
+       exactly as it came off the queue. Only `sample_rate` of messages are kept, and recording
+       stops once the file reaches `max_bytes`."""
+
+    def __init__(self, path, sample_rate=1.0, max_bytes=0):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+            self._file.flush()
+
+    def record(self, body, headers, received=None):
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return False
+        encoded_headers = json.dumps(headers or {}, default=str).encode()
+        with self._lock:
+            if self.max_bytes and self._file.tell() >= self.max_bytes:
+                return False
+            self._file.write(RECORD_HEADER.pack(received or time.time(), len(encoded_headers), len(body)))
+            self._file.write(encoded_headers)
+            self._file.write(body)
+            self._file.flush()
+        return True
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def read_records(path):
+    """Yields (received, headers, body) for every complete record in a recording."""
+    with open(path, 'rb') as recording:
+        if recording.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a traffic recording".format(path))
+        while True:
+            header = recording.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            received, headers_length, body_length = RECORD_HEADER.unpack(header)
+            headers = recording.read(headers_length)
+            body = recording.read(body_length)
+            if len(body) < body_length:
+                # The recorder was stopped part way through writing this record
+                logger.warning("Ignoring truncated record at end of recording", path=path)
+                return
+            yield received, json.loads(headers.decode()), body
@@ -0,0 +1,153 @@
+"""Replays recorded traffic through SeftConsumer.process and reports throughput and stage latency.
+
+Recordings are made by setting RECORD_TRAFFIC_FILE on a running consumer. Messages are replayed
+at the rate they originally arrived, scaled by --speed (0 replays as fast as possible). A/V and
+delivery are stubbed by default so a replay has no side effects. Messages are processed on
+--workers threads (CONSUMER_WORKERS by default), so the effect of more workers can be measured.
+
+    python -m app.replay /tmp/traffic.1234 /tmp/traffic.1235 --speed 2 --av-latency 3 --workers 4
+"""
+import argparse
+import collections
+import concurrent.futures
+import functools
+import heapq
+import json
+import sys
+import time
+
+from sdc.rabbit.exceptions import BadMessageError, QuarantinableError, RetryableError
+import yaml
+
+from app import create_and_wrap_logger
+from app import logs
+from app import settings
+from app.anti_virus_check import SimulatedAntiVirusCheck
+from app.delivery import LocalDirectoryDelivery, NullDelivery
+from app.ftp_targets import ftp_from_settings
+from app.main import SeftConsumer
+from app.metrics import Timing, metrics
+from app.recorder import read_records
+
+logger = create_and_wrap_logger(__name__)
+
+
+def load_records(paths):
+    """Merges recordings (one per consumer process) into a single stream in the order they were received."""
+    return heapq.merge(*(read_records(path) for path in paths), key=lambda record: record[0])
+
+
+class Replayer:
+    """Replays messages through `consumer` on `workers` threads, as the consumer's worker pool would.
+
+       At most `workers` messages are processed at once; a message that comes due while they are
+       all busy waits for one to finish, and the wait shows in the reported lag."""
+
+    def __init__(self, consumer, speed=1.0, workers=None):
+        self.consumer = consumer
+        self.speed = speed
+        self.workers = workers or settings.CONSUMER_WORKERS
+
+    def run(self, records, limit=0):
+        metrics.reset()
+        logs.measuring = True
+        outcomes = collections.Counter()
+        lag = Timing(metrics.sample_size)
+        total_bytes = 0
+        first_received = None
+        started = time.monotonic()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            in_flight = set()
+            for count, (received, headers, body) in enumerate(records, 1):
+                if len(in_flight) >= self.workers:
+                    done, in_flight = concurrent.futures.wait(in_flight,
+                                                              return_when=concurrent.futures.FIRST_COMPLETED)
+                    outcomes.update(future.result() for future in done)
+                if first_received is None:
+                    first_received = received
+                if self.speed:
+                    due = started + (received - first_received) / self.speed
+                    delay = due - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    lag.observe(max(0.0, -delay))
+
+                in_flight.add(pool.submit(self._process, body, headers.get('tx_id')))
+                total_bytes += len(body)
+                if limit and count >= limit:
+                    break
+            outcomes.update(future.result() for future in concurrent.futures.as_completed(in_flight))
+
+        elapsed = time.monotonic() - started
+        logs.measuring = False
+        messages = sum(outcomes.values())
+        snapshot = metrics.snapshot()
+        logging_calls = snapshot["timings"].pop("logging.call", Timing(1).summary())
+        return {
+            "messages": messages,
+            "workers": self.workers,
+            "elapsed": round(elapsed, 3),
+            "messages_per_second": round(messages / max(elapsed, 0.001), 2),
+            "encrypted_bytes_per_second": round(total_bytes / max(elapsed, 0.001)),
+            "outcomes": dict(outcomes),
+            "lag": lag.summary(),
+            "stages": snapshot["timings"],
+            "logging": {
+                "calls_per_message": round(logging_calls["count"] / max(messages, 1), 1),
+                "seconds_per_message": round(logging_calls["count"] * logging_calls["mean"] / max(messages, 1), 6),
+                "call": logging_calls,
+            },
+        }
+
+    def _process(self, body, tx_id):
+        try:
+            self.consumer.process(body.decode("utf-8"), tx_id)
+            return "delivered"
+        except (QuarantinableError, BadMessageError):
+            return "quarantined"
+        except RetryableError:
+            return "retried"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay recorded SEFT traffic")
+    parser.add_argument('recordings', nargs='+', help="recording files written by the consumer")
+    parser.add_argument('--speed', type=float, default=1.0, help="replay speed relative to the recording, 0 for no delay")
+    parser.add_argument('--workers', type=int, default=settings.CONSUMER_WORKERS,
+                        help="messages processed at once, as CONSUMER_WORKERS")
+    parser.add_argument('--limit', type=int, default=0, help="stop after this many messages")
+    parser.add_argument('--av', choices=("stub", "real", "off"), default="stub", help="how to handle A/V scanning")
+    parser.add_argument('--av-latency', type=float, default=settings.ANTI_VIRUS_WAIT_TIME,
+                        help="seconds the stubbed A/V scan takes")
+    parser.add_argument('--delivery', choices=("null", "ftp", "directory"), default="null", help="where files are delivered")
+    parser.add_argument('--output', help="directory to deliver to with --delivery directory")
+    parser.add_argument('--keys-file', default=settings.SDX_SEFT_CONSUMER_KEYS_FILE)
+    args = parser.parse_args(argv)
+    if args.delivery == "directory" and not args.output:
+        parser.error("--output is required with --delivery directory")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with open(args.keys_file) as file:
+        keys = yaml.safe_load(file)
+
+    settings.ANTI_VIRUS_ENABLED = args.av != "off"
+    anti_virus = functools.partial(SimulatedAntiVirusCheck, latency=args.av_latency) if args.av == "stub" else None
+    if args.delivery == "null":
+        delivery = NullDelivery(logger)
+    elif args.delivery == "directory":
+        delivery = LocalDirectoryDelivery(logger, args.output)
+    else:
+        delivery = ftp_from_settings(logger)
+
+    consumer = SeftConsumer(keys, delivery=delivery, anti_virus=anti_virus)
+    report = Replayer(consumer, speed=args.speed, workers=args.workers).run(load_records(args.recordings), limit=args.limit)
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import collections
+import concurrent.futures
+import threading
+import time
+
+from app import create_and_wrap_logger
+from app.metrics import metrics
+
+logger = create_and_wrap_logger(__name__)
+
+Job = collections.namedtuple('Job', 'survey_id queued fn args future')
+
+
+class Lane:
+    """A pool of workers for files up to `max_bytes` (no limit if None).
+
+       Jobs are queued per survey and the workers take turns between surveys, so one survey
+       uploading a lot of files at once can't hold up everyone else in the lane."""
+
+    def __init__(self, name, workers, max_bytes=None):
+        self.name = name
+        self.workers = max(1, workers)
+        self.max_bytes = max_bytes
+        self._queues = collections.OrderedDict()
+        self._queued = 0
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._threads = []
+
+    def accepts(self, size):
+        return self.max_bytes is None or size <= self.max_bytes
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name="seft-{}-{}".format(self.name, i), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+
+    def put(self, job):
+        with self._condition:
+            self._queues.setdefault(job.survey_id, collections.deque()).append(job)
+            self._queued += 1
+            metrics.set_gauge("scheduler.{}.queued".format(self.name), self._queued)
+            self._condition.notify()
+
+    def _next(self):
+        # Take from the survey that has waited longest for a turn, then send it to the back
+        survey_id, jobs = next(iter(self._queues.items()))
+        job = jobs.popleft()
+        if jobs:
+            self._queues.move_to_end(survey_id)
+        else:
+            del self._queues[survey_id]
+        self._queued -= 1
+        metrics.set_gauge("scheduler.{}.queued".format(self.name), self._queued)
+        return job
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._queues and not self._stopping:
+                    self._condition.wait()
+                if self._stopping:
+                    return
+                job = self._next()
+
+            metrics.observe("scheduler.{}.wait".format(self.name), time.monotonic() - job.queued)
+            if not job.future.set_running_or_notify_cancel():
+                continue
+            try:
+                job.future.set_result(job.fn(*job.args))
+            except BaseException as e:  # pylint: disable=broad-except
+                job.future.set_exception(e)
+
+
+class Scheduler:
+    """Sends each decrypted file to the first lane that accepts its size.
+
+       Messages handed to a lane no longer count against admission's workers, so the jobs queued
+       or running in the lanes are published as `scheduler.in_flight` for `/capacity` to count."""
+
+    def __init__(self, lanes):
+        self.lanes = lanes
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        for lane in lanes:
+            lane.start()
+        logger.info("Started scheduler", lanes={lane.name: lane.workers for lane in lanes})
+
+    def submit(self, survey_id, size, fn, *args):
+        """Queues `fn(*args)`, returning a Future for its result."""
+        lane = next((lane for lane in self.lanes if lane.accepts(size)), self.lanes[-1])
+        future = concurrent.futures.Future()
+        self._count(1)
+        future.add_done_callback(lambda done: self._count(-1))
+        lane.put(Job(survey_id=survey_id, queued=time.monotonic(), fn=fn, args=args, future=future))
+        return future
+
+    def _count(self, change):
+        with self._lock:
+            self.in_flight += change
+            metrics.set_gauge("scheduler.in_flight", self.in_flight)
+
+    def stop(self):
+        for lane in self.lanes:
+            lane.stop()
@@ -1,17 +1,33 @@
-from ftplib import FTP
+from ftplib import FTP, all_errors, error_temp
 import io
+import threading
 from os.path import join
 
+from app.deadline import NO_DEADLINE
+from app.ratelimit import ConcurrencyLimit
+from app.timeline import NO_TIMELINE
+
+
+class ConnectionFailed(OSError):
+    """Raised when a delivery couldn't connect or log in, so nothing was sent to the server."""
+
 
 class SDXFTP(object):
 
-    def __init__(self, logger, host, user, passwd, port=21):
+    def __init__(self, logger, host, user, passwd, port=21, pool_size=1, timeout=None):
         self._conn = None
         self.host = host
         self.user = user
         self.passwd = passwd
         self.logger = logger
         self.port = port
+        # Socket timeout for connecting and for each read or write, unless a deadline is shorter
+        self.timeout = timeout
+        # Deliveries each take a connection of their own from a small pool, so up to
+        # pool_size transfers can run at once without logging in for every file
+        self._slots = ConcurrencyLimit(pool_size)
+        self._idle = []
+        self._idle_lock = threading.Lock()
         return
 
     def get_connection(self):
@@ -36,16 +52,111 @@ class SDXFTP(object):
             return self._conn
 
     def _connect(self):
-        self._conn = FTP()
-        self._conn.connect(self.host, self.port)
-        self._conn.login(user=self.user, passwd=self.passwd)
+        self._conn = self._open()
         return self._conn
 
-    def deliver_binary(self, folder, filename, data):
+    def _open(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        conn = FTP()
+        conn.connect(self.host, self.port, timeout=-999 if timeout is None else timeout)
+        try:
+            conn.login(user=self.user, passwd=self.passwd)
+        except BaseException:
+            # Otherwise every failed login, as targets are failed over or retried, leaks a socket
+            conn.close()
+            raise
+        return conn
+
+    def _checkout(self, deadline):
+        """Takes an idle pooled connection that still answers, or opens a new one.
+
+        Returns the connection and whether it was reused.
+        """
+        while True:
+            with self._idle_lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                self.logger.info("Establishing new FTP connection", host=self.host)
+                return self._open(deadline.timeout("ftp connect", self.timeout)), False
+            try:
+                self._set_timeout(conn, deadline.timeout("ftp connect", self.timeout))
+                conn.voidcmd("NOOP")
+                return conn, True
+            except (IOError, EOFError, AttributeError):
+                self.logger.info("FTP connection no longer alive, discarding", host=self.host)
+                self._discard(conn)
+
+    @staticmethod
+    def _set_timeout(conn, timeout):
+        # Applies to the control connection now and to the data connection STOR opens
+        conn.timeout = timeout
+        conn.sock.settimeout(timeout)
+
+    def warm(self, timeout=None):
+        """Opens a connection and adds it to the idle pool, so the first delivery doesn't have to log in.
+
+           `timeout` overrides the socket timeout while connecting and logging in."""
+        self.logger.info("Establishing new FTP connection", host=self.host)
+        self._checkin(self._open(timeout))
+
+    def resize(self, pool_size):
+        """Changes how many deliveries may run at once, closing idle connections beyond the new size."""
+        self._slots.set_limit(pool_size)
+        with self._idle_lock:
+            surplus = self._idle[self._slots.limit:]
+            del self._idle[self._slots.limit:]
+        for conn in surplus:
+            self._discard(conn)
+
+    def close(self):
+        """Logs out of and closes the idle connections. Deliveries in progress keep theirs."""
+        with self._idle_lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            try:
+                conn.quit()
+            except all_errors + (AttributeError,):
+                pass
+            self._discard(conn)
+        self.logger.info("Closed FTP connections", host=self.host, count=len(idle))
+
+    def _checkin(self, conn):
+        with self._idle_lock:
+            if len(self._idle) < self._slots.limit:
+                self._idle.append(conn)
+                return
+        self._discard(conn)
+
+    @staticmethod
+    def _discard(conn):
+        try:
+            conn.close()
+        except (IOError, EOFError):
+            pass
+
+    def deliver_binary(self, folder, filename, data, deadline=NO_DEADLINE, timeline=NO_TIMELINE):
         """Delivery binary delivers a single binary file to the given folder
+
+        `data` is the file's bytes or a file open for reading. The transfer is abandoned with
+        DeadlineExceeded if `deadline` passes part way through.
         """
         self.logger.info("Delivering binary file to FTP", host=self.host, folder=folder, filename=filename)
-        stream = io.BytesIO(data)
-        conn = self.get_connection()
-        conn.storbinary('STOR ' + join(folder, filename), stream)
+        stream = data if hasattr(data, "read") else io.BytesIO(data)
+        with self._slots.slot():
+            with timeline.stage("ftp_connect"):
+                try:
+                    conn, reused = self._checkout(deadline)
+                except (OSError, EOFError, error_temp) as e:
+                    raise ConnectionFailed("Unable to connect to {}: {}".format(self.host, e)) from e
+            timeline.note(ftp_reused=reused)
+            try:
+                self._set_timeout(conn, deadline.timeout("ftp stor", self.timeout))
+                with timeline.stage("ftp_stor"):
+                    conn.storbinary('STOR ' + join(folder, filename), stream,
+                                    callback=lambda block: deadline.check("ftp stor"))
+            except BaseException:
+                # The transfer may have left the control connection in an unknown state
+                self._discard(conn)
+                raise
+            self._checkin(conn)
         self.logger.info("Delivered binary file to FTP", host=self.host, folder=folder, filename=filename)
@@ -0,0 +1,104 @@
+import functools
+import time
+
+import tornado.ioloop
+from tornado.web import RequestHandler
+
+from app import create_and_wrap_logger
+from app.metrics import metrics
+
+logger = create_and_wrap_logger(__name__)
+
+
+class Startup:
+    """Runs the slow parts of starting a process at the same time, rather than one after another.
+
+       Each task runs on the io loop's executor and is timed. Once the tasks named in `required`
+       have finished `on_ready` is called, or `on_failed` with the error from one that failed. The
+       others (warming connections, say) carry on in the background, in `background`, and only
+       log a warning if they fail, as the first message would have made the connection anyway.
+
+       Anything else the process waits on, like the rabbit connection, can be timed alongside
+       with `mark`, so the breakdown logged at the end shows where the time went."""
+
+    def __init__(self, tasks, on_ready, on_failed, required=(), clock=time.monotonic):
+        self.tasks = tasks
+        self.on_ready = on_ready
+        self.on_failed = on_failed
+        self.required = required
+        self.clock = clock
+        self.started = None
+        self.timings = {}
+        self.ready = False
+        self.background = []
+
+    async def run(self):
+        self.started = self.clock()
+        loop = tornado.ioloop.IOLoop.current()
+        futures = {name: loop.run_in_executor(None, self._timed, name, task) for name, task in self.tasks.items()}
+        for name, future in futures.items():
+            if name not in self.required:
+                self.background.append(future)
+                loop.add_future(future, functools.partial(self._finished_in_background, name))
+
+        for name, future in futures.items():
+            if name not in self.required:
+                continue
+            try:
+                await future
+            except Exception as e:  # pylint: disable=broad-except
+                logger.critical("Startup failed", task=name, error=str(e), timings=self.timings)
+                status.failed = True
+                self.on_failed(e)
+                return
+
+        self.mark("total")
+        self.ready = True
+        status.ready = True
+        status.timings = self.timings
+        metrics.set_gauge("startup.ready", 1)
+        logger.info("Startup complete", **self.timings)
+        self.on_ready()
+
+    def mark(self, name):
+        """Records how long after the start `name` happened, the first time it happens."""
+        if self.started is not None and name not in self.timings:
+            self.timings[name] = round(self.clock() - self.started, 6)
+            metrics.observe("startup." + name, self.timings[name])
+            if self.ready:
+                logger.info("Startup step finished after startup", step=name, seconds=self.timings[name])
+
+    def _finished_in_background(self, name, future):
+        error = future.exception()
+        if error is not None:
+            logger.warning("Startup task failed, carrying on", task=name, error=str(error))
+        elif self.ready:
+            logger.info("Startup step finished after startup", step=name, seconds=self.timings[name])
+
+    def _timed(self, name, task):
+        start = self.clock()
+        try:
+            return task()
+        finally:
+            self.timings[name] = round(self.clock() - start, 6)
+            metrics.observe("startup." + name, self.timings[name])
+
+
+class StartupStatus:
+
+    def __init__(self):
+        self.ready = False
+        self.failed = False
+        self.timings = {}
+
+
+status = StartupStatus()
+
+
+class ReadinessHandler(RequestHandler):
+    """Returns 200 once the process handling the request has started up, 503 until then."""
+
+    def get(self):
+        if not status.ready:
+            self.set_status(503)
+        self.write({"ready": status.ready, "failed": status.failed, "timings": status.timings})
@@ -0,0 +1,92 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from tornado import testing
+
+from app import admin, settings
+from app.main import make_app
+from app.profiling import profile
+
+
+class AdminDisabledTests(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        with patch.object(settings, "ADMIN_TOKEN", None):
+            return make_app()
+
+    def test_not_served_without_token(self):
+        self.assertEqual(self.fetch("/admin/profile").code, 404)
+
+
+class ProfileHandlerTests(testing.AsyncHTTPTestCase):
+
+    def setUp(self):
+        token = patch.object(settings, "ADMIN_TOKEN", "secret")
+        token.start()
+        self.addCleanup(token.stop)
+        super().setUp()
+
+    def get_app(self):
+        return make_app()
+
+    def _fetch(self, query, token="secret"):
+        return self.fetch("/admin/profile?" + query, headers={"Authorization": "Bearer " + token})
+
+    def test_wrong_token_forbidden(self):
+        self.assertEqual(self._fetch("scope=process", token="guess").code, 403)
+
+    def test_cpu_profile_collapsed(self):
+        response = self._fetch("kind=cpu&seconds=0.2&scope=process")
+        self.assertEqual(response.code, 200)
+        self.assertIn("MainThread;", response.body.decode())
+
+    def test_memory_profile_json(self):
+        response = self._fetch("kind=memory&seconds=0.1&scope=process")
+        result = json.loads(response.body)
+        self.assertEqual(result["processes"][0]["pid"], os.getpid())
+        self.assertIn("allocations", result["processes"][0])
+
+    def test_rejects_long_profiles(self):
+        self.assertEqual(self._fetch("seconds=3600").code, 400)
+        self.assertEqual(self._fetch("kind=memory&format=collapsed").code, 400)
+
+
+class ProcessRegistryTests(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.registry = admin.ProcessRegistry(directory.name)
+        self.registry.register()
+
+    def test_registered_and_stale_pids(self):
+        with open(os.path.join(self.registry.processes, "999999999"), "w") as stale:
+            stale.write("1")
+        self.assertEqual(self.registry.pids(), [os.getpid()])
+        self.assertEqual(os.listdir(self.registry.processes), [str(os.getpid())])
+
+    def test_request_and_reply(self):
+        request_id, pids = self.registry.broadcast({"kind": "cpu", "seconds": 0.05, "limit": 10})
+        self.assertEqual(pids, [])
+
+        handled = []
+        pending = list(self.registry.pending(handled))
+        self.assertEqual(pending[0][0], request_id)
+
+        with patch.object(admin, "registry", self.registry):
+            admin._serve(request_id, pending[0][1])
+        replies = self.registry.replies(request_id, [os.getpid()])
+        self.assertEqual(replies[os.getpid()]["kind"], "cpu")
+
+        self.registry.forget(request_id, [os.getpid()])
+        self.assertEqual(list(self.registry.pending(handled)), [])
+
+
+class ProfilingTests(unittest.TestCase):
+
+    def test_cpu_samples(self):
+        result = profile("cpu", 0.05)
+        self.assertGreater(result["samples"], 0)
@@ -0,0 +1,96 @@
+import unittest
+from unittest.mock import Mock
+
+from app.admission import AdmissionController
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class AdmissionControllerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.admission = AdmissionController(budget_bytes=100, max_in_flight=4, max_bypass_wait=30, clock=self.clock)
+
+    def test_admits_within_budget(self):
+        first, second = Mock(), Mock()
+        self.admission.submit(60, first)
+        self.admission.submit(40, second)
+        self.assertTrue(first.called)
+        self.assertTrue(second.called)
+        self.assertEqual(self.admission.reserved_bytes, 100)
+
+    def test_waits_while_budget_exhausted(self):
+        first, second = Mock(), Mock()
+        self.admission.submit(60, first)
+        self.admission.submit(60, second)
+        self.assertFalse(second.called)
+        self.assertEqual(self.admission.waiting, 1)
+
+        self.admission.release(60)
+        self.assertTrue(second.called)
+        self.assertEqual(self.admission.reserved_bytes, 60)
+
+    def test_small_messages_bypass_large(self):
+        large, small = Mock(), Mock()
+        self.admission.submit(70, Mock())
+        self.admission.submit(50, large)
+        self.admission.submit(10, small)
+        self.assertFalse(large.called)
+        self.assertTrue(small.called)
+
+    def test_no_bypass_once_head_waited_too_long(self):
+        large, small = Mock(), Mock()
+        self.admission.submit(70, Mock())
+        self.admission.submit(50, large)
+        self.clock.now = 31
+        self.admission.submit(10, small)
+        self.assertFalse(small.called)
+
+    def test_oversized_message_runs_alone(self):
+        huge, small = Mock(), Mock()
+        self.admission.submit(10, Mock())
+        self.admission.submit(500, huge)
+        self.assertFalse(huge.called)
+
+        self.admission.release(10)
+        self.assertTrue(huge.called)
+        self.admission.submit(10, small)
+        self.assertFalse(small.called)
+
+    def test_limits_messages_in_flight(self):
+        started = [Mock() for _ in range(5)]
+        for start in started:
+            self.admission.submit(1, start)
+        self.assertEqual([start.called for start in started], [True] * 4 + [False])
+        self.admission.release(1)
+        self.assertTrue(started[4].called)
+
+    def test_raising_limit_starts_waiting_messages(self):
+        started = [Mock() for _ in range(6)]
+        for start in started:
+            self.admission.submit(1, start)
+        self.admission.set_max_in_flight(6)
+        self.assertTrue(all(start.called for start in started))
+
+    def test_clear_forgets_waiting_messages(self):
+        started = [Mock() for _ in range(5)]
+        for start in started:
+            self.admission.submit(1, start)
+        self.assertEqual(self.admission.clear(), 1)
+        self.admission.release(1)
+        self.assertFalse(started[4].called)
+
+    def test_zero_budget_is_unlimited(self):
+        admission = AdmissionController(budget_bytes=0, max_in_flight=2)
+        first, second = Mock(), Mock()
+        admission.submit(10 ** 12, first)
+        admission.submit(10 ** 12, second)
+        self.assertTrue(second.called)
@@ -1,4 +1,5 @@
 import unittest
+from unittest.mock import patch
 
 import requests
 import responses
@@ -6,6 +7,8 @@ from sdc.rabbit.exceptions import QuarantinableError, RetryableError, BadMessage
 
 from app import settings
 from app.anti_virus_check import AntiVirusCheck
+from app.deadline import Deadline, DeadlineExceeded
+from app.ratelimit import AIMDLimiter
 from app.main import Payload
 
 
@@ -189,6 +192,20 @@ class AntiVirusCheckTests(unittest.TestCase):
         with self.assertRaises(RetryableError):
             anti_virus.send_for_av_scan(payload)
 
+    @responses.activate
+    def test_usage_limit_lowers_scans_in_flight(self):
+        responses.add(responses.POST, settings.ANTI_VIRUS_BASE_URL, status=403)
+        limiter = AIMDLimiter(maximum=4)
+
+        payload = Payload(decoded_contents="test", file_name="test", case_id="1", survey_id="1")
+
+        with patch('app.anti_virus_check.concurrency', limiter):
+            with self.assertRaises(RetryableError):
+                AntiVirusCheck(tx_id=1).send_for_av_scan(payload)
+
+        self.assertEqual(limiter.limit, 2)
+        self.assertEqual(limiter.in_flight, 0)
+
     @responses.activate
     def test_send_for_av_scan_internal_server_error(self):
         responses.add(responses.POST, settings.ANTI_VIRUS_BASE_URL, status=500)
@@ -228,3 +245,53 @@ class AntiVirusCheckTests(unittest.TestCase):
 
         with self.assertRaises(RetryableError):
             anti_virus.send_for_av_scan(payload)
+
+    @responses.activate
+    def test_send_for_av_scan_service_unavailable_within_deadline(self):
+        responses.add(responses.POST, settings.ANTI_VIRUS_BASE_URL, status=503)
+        deadline = Deadline(settings.ANTI_VIRUS_WAIT_TIME / 2, clock=lambda: 0.0)
+
+        payload = Payload(decoded_contents="test", file_name="test", case_id="1", survey_id="1")
+
+        with patch.object(deadline._cancelled, "wait") as wait, self.assertRaises(DeadlineExceeded):
+            AntiVirusCheck(tx_id=1).send_for_av_scan(payload, deadline=deadline)
+        self.assertFalse(wait.called)
+
+    @responses.activate
+    def test_unreachable_service_retried(self):
+        data_id = '123'
+        responses.add(responses.POST, settings.ANTI_VIRUS_BASE_URL, body=requests.ConnectTimeout())
+        responses.add(responses.POST, settings.ANTI_VIRUS_BASE_URL, json={'data_id': data_id}, status=200)
+        responses.add(responses.GET, settings.ANTI_VIRUS_BASE_URL + "/" + data_id, body=requests.ConnectionError())
+        responses.add(responses.GET, settings.ANTI_VIRUS_BASE_URL + "/" + data_id,
+                      json={
+                          'scan_results': {'scan_all_result_a': 'No Threat Detected'},
+                          'process_info': {'progress_percentage': 100, 'result': 'Allowed'}
+                      }, status=200)
+
+        payload = Payload(decoded_contents="test", file_name="test", case_id="1", survey_id="1")
+
+        self.assertTrue(AntiVirusCheck(tx_id=1).send_for_av_scan(payload))
+        self.assertEqual(len(responses.calls), 4)
+
+    @responses.activate
+    def test_submit_not_retried_once_connected(self):
+        responses.add(responses.POST, settings.ANTI_VIRUS_BASE_URL, body=requests.ConnectionError())
+
+        payload = Payload(decoded_contents="test", file_name="test", case_id="1", survey_id="1")
+
+        with self.assertRaises(RetryableError):
+            AntiVirusCheck(tx_id=1).send_for_av_scan(payload)
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    def test_connection_retries_stop_at_deadline(self):
+        responses.add(responses.POST, settings.ANTI_VIRUS_BASE_URL, body=requests.ConnectTimeout())
+        deadline = Deadline(0.25, clock=lambda: 0.0)
+
+        payload = Payload(decoded_contents="test", file_name="test", case_id="1", survey_id="1")
+
+        with patch.object(deadline._cancelled, "wait", return_value=False), self.assertRaises(DeadlineExceeded):
+            AntiVirusCheck(tx_id=1).send_for_av_scan(payload, deadline=deadline)
+        # Waits of 0.1 and 0.2 seconds fit in the deadline, 0.4 doesn't
+        self.assertEqual(len(responses.calls), 3)
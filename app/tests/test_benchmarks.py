@@ -0,0 +1,219 @@
+"""Micro-benchmarks of the per-message hot path, checked against stored baselines.
+
+Each benchmark is timed as the best of several runs and divided by the time of a fixed
+calibration workload, so baselines recorded on one machine stay meaningful on another. A
+benchmark fails if its ratio is more than BENCHMARK_TOLERANCE (a fraction) above its baseline.
+
+Skipped unless BENCHMARKS is set:
+
+    BENCHMARKS=1 pytest -s -p no:logging app/tests/test_benchmarks.py
+
+Set BENCHMARK_UPDATE=1 as well to record the current ratios as the new baselines.
+"""
+import base64
+import contextlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import timeit
+import unittest
+from unittest.mock import Mock, patch
+
+import requests
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.servers import ThreadedFTPServer
+from sdc.crypto.encrypter import encrypt
+import yaml
+
+from app import create_and_wrap_logger
+from app import settings
+from app.anti_virus_check import AntiVirusCheck
+from app.delivery import LocalDirectoryDelivery
+from app.keys import ParsedKeyStore
+from app.main import SeftConsumer, KEY_PURPOSE_CONSUMER
+from app.sdxftp import SDXFTP
+
+logger = create_and_wrap_logger(__name__)
+# Benchmarks are reported while the rest of the app is quiet
+logging.getLogger(__name__).setLevel(logging.INFO)
+
+BENCHMARKS = os.getenv("BENCHMARKS")
+BENCHMARK_UPDATE = os.getenv("BENCHMARK_UPDATE")
+BENCHMARK_TOLERANCE = float(os.getenv("BENCHMARK_TOLERANCE", "0.3"))
+BASELINES_FILE = os.path.join(os.path.dirname(__file__), "benchmarks.json")
+
+SIZES = {"1KB": 1024, "64KB": 64 * 1024, "1MB": 1024 ** 2, "8MB": 8 * 1024 ** 2}
+
+
+def best_time(function, repeat=5):
+    """Seconds a call to `function` takes, the best of `repeat` runs of enough calls to take 0.2s."""
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+@contextlib.contextmanager
+def log_level(name, level):
+    # setLevel rather than patching `level`, so loggers' cached levels are cleared
+    log = logging.getLogger(name)
+    previous = log.level
+    log.setLevel(level)
+    try:
+        yield log
+    finally:
+        log.setLevel(previous)
+
+
+def calibrate():
+    """Times a fixed mix of interpreter work and hashing that the benchmarks are measured against."""
+    data = bytes(range(256)) * 256
+
+    def workload():
+        sum(i * i for i in range(2000))
+        base64.b64encode(data)
+
+    return best_time(workload)
+
+
+def av_result(engines=40):
+    """An OPSWAT scan result the size of a real one, with a result per engine."""
+    return json.dumps({
+        "data_id": "bzIwMDEwMUhKa2dhOTFwdQ",
+        "scan_results": {
+            "scan_details": {"Engine{}".format(i): {"scan_result_i": 0, "threat_found": "", "def_time": "2020-10-23T00:00:00Z",
+                                                    "scan_time": 12} for i in range(engines)},
+            "scan_all_result_i": 0, "scan_all_result_a": "No Threat Detected", "total_avs": engines,
+            "progress_percentage": 100,
+        },
+        "file_info": {"file_size": 642329, "display_name": "test1.xls", "md5": "0" * 32, "sha256": "0" * 64},
+        "process_info": {"progress_percentage": 100, "result": "Allowed", "profile": "Password Protected Allowed",
+                         "post_processing": {"actions_ran": "", "actions_failed": ""}},
+    }).encode()
+
+
+@unittest.skipIf(not BENCHMARKS, "Benchmarks, set BENCHMARKS to run")
+class HotPathBenchmarks(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # Measured without the cost of writing log lines, which `test_bound_logging` covers
+        cls.quiet = log_level("app", logging.WARNING)
+        cls.quiet.__enter__()
+        cls.calibration = calibrate()
+        try:
+            with open(BASELINES_FILE) as file:
+                cls.baselines = json.load(file)
+        except FileNotFoundError:
+            cls.baselines = {}
+        cls.results = {}
+
+        with open("./sdx_test_keys/keys.yml") as file:
+            cls.consumer = SeftConsumer(yaml.safe_load(file), delivery=Mock())
+        with open("./ras_test_keys/keys.yml") as file:
+            cls.ras_key_store = ParsedKeyStore(yaml.safe_load(file))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.quiet.__exit__(None, None, None)
+        if BENCHMARK_UPDATE:
+            baselines = dict(cls.baselines, **cls.results)
+            with open(BASELINES_FILE, "w") as file:
+                json.dump(dict(sorted(baselines.items())), file, indent=2)
+                file.write("\n")
+
+    def check(self, name, function, attempts=3):
+        """Times `function` against the baseline for `name`, timing it again if it looks slower in case that was noise."""
+        baseline = self.baselines.get(name)
+        limit = None if baseline is None or BENCHMARK_UPDATE else baseline * (1 + BENCHMARK_TOLERANCE)
+        ratio = None
+        for _ in range(attempts):
+            seconds = best_time(function)
+            ratio = min(ratio or float("inf"), round(seconds / self.calibration, 3))
+            if limit is None or ratio <= limit:
+                break
+        self.results[name] = ratio
+        logger.info("Benchmark", name=name, microseconds=round(ratio * self.calibration * 1e6, 1), ratio=ratio,
+                    baseline=baseline, change=None if baseline is None else "{:+.0%}".format(ratio / baseline - 1))
+        if limit is not None:
+            self.assertLessEqual(ratio, limit, "{} is {:.0%} slower than its baseline".format(name, ratio / baseline - 1))
+
+    def _claims(self, size):
+        return {"filename": "test1.xls", "case_id": "601c4ee4-83ed-11e7-bb31-be2e44b06b34", "survey_id": "221",
+                "file": base64.b64encode(os.urandom(size)).decode()}
+
+    def test_extract_file(self):
+        for label, size in SIZES.items():
+            with self.subTest(size=label):
+                claims = self._claims(size)
+                self.check("extract_file_" + label, lambda: self.consumer.extract_file(claims, "1"))
+
+    def test_decrypt(self):
+        for label in ("1KB", "1MB"):
+            with self.subTest(size=label):
+                jwt = encrypt(self._claims(SIZES[label]), self.ras_key_store, KEY_PURPOSE_CONSUMER)
+                self.check("decrypt_" + label, lambda: self.consumer._decrypt(jwt, "1"))
+
+    def test_anti_virus_result(self):
+        response = requests.Response()
+        response.status_code = 200
+        response._content = av_result()
+        anti_virus = AntiVirusCheck(tx_id="1")
+        anti_virus.session = Mock(request=Mock(return_value=response))
+        self.check("anti_virus_result", lambda: anti_virus._get_anti_virus_result("bzIwMDEwMUhKa2dhOTFwdQ"))
+
+    def test_deliver_binary(self):
+        root = tempfile.mkdtemp()
+        authorizer = DummyAuthorizer()
+        authorizer.add_user("ons", "ons", root, perm="elradfmw")
+        handler = type("BenchmarkFTPHandler", (FTPHandler,), {"authorizer": authorizer})
+        server = ThreadedFTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        ftp = SDXFTP(Mock(), "127.0.0.1", "ons", "ons", server.address[1], pool_size=1, timeout=10)
+        try:
+            with log_level("pyftpdlib", logging.WARNING):
+                for label in ("64KB", "1MB"):
+                    with self.subTest(size=label):
+                        data = os.urandom(SIZES[label])
+                        self.check("deliver_binary_" + label, lambda: ftp.deliver_binary(".", "file", data))
+        finally:
+            server.close_all()
+            shutil.rmtree(root, ignore_errors=True)
+
+    def test_deliver_file(self):
+        root = tempfile.mkdtemp()
+        # Without fsync, so the copy is measured rather than the disk
+        delivery = LocalDirectoryDelivery(Mock(), root)
+        try:
+            for label in ("64KB", "1MB"):
+                with self.subTest(size=label):
+                    data = os.urandom(SIZES[label])
+                    self.check("deliver_file_" + label, lambda: delivery.deliver_binary(".", "file", data))
+            with self.subTest(size="8MB"), tempfile.TemporaryFile() as spill:
+                spill.write(os.urandom(SIZES["8MB"]))
+
+                def deliver_spill_file():
+                    spill.seek(0)
+                    delivery.deliver_binary(".", "file", spill)
+
+                self.check("deliver_file_spill_8MB", deliver_spill_file)
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+
+    def test_bound_logging(self):
+        with open(os.devnull, "w") as devnull, log_level("app.main", logging.INFO) as main_logger:
+            handler = logging.StreamHandler(devnull)
+            handler.setFormatter(logging.Formatter(settings.LOGGING_FORMAT))
+            # As `prepare` logs: bind the tx_id, then a skipped debug line and an emitted info line
+            with patch.object(main_logger, "handlers", [handler]), patch.object(main_logger, "propagate", False):
+                bound = create_and_wrap_logger("app.main")
+
+                def log():
+                    bound_logger = bound.bind(tx_id="0f0e0d0c-0b0a-0908-0706-050403020100")
+                    bound_logger.debug("Message Received")
+                    bound_logger.info("Decrypting message")
+
+                self.check("bound_logging", log)
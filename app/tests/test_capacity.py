@@ -0,0 +1,74 @@
+import json
+from unittest.mock import Mock, patch
+
+from tornado import testing
+from tornado.httpclient import HTTPError
+
+from app.capacity import CapacitySignals
+from app.metrics import metrics
+
+
+def queue(**figures):
+    return dict({"name": "Seft.Responses", "messages": 0, "messages_ready": 0, "messages_unacknowledged": 0,
+                 "consumers": 2}, **figures)
+
+
+class CapacitySignalsTests(testing.AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        metrics.reset()
+        metrics.set_gauge("admission.in_flight", 3)
+        metrics.set_gauge("admission.max_in_flight", 4)
+        self.clock = Mock(return_value=100.0)
+        self.signals = CapacitySignals("http://rabbit/api/queues/%2f/Seft.Responses", clock=self.clock)
+
+    def _fetch(self, body=None, error=None):
+        async def fetch(url, **kwargs):
+            if error:
+                raise error
+            return Mock(body=json.dumps(body).encode())
+        return patch("app.capacity.AsyncHTTPClient", return_value=Mock(fetch=fetch))
+
+    def test_drain_time_from_ack_rate(self):
+        figures = CapacitySignals.calculate(queue(messages=120, message_stats={"ack_details": {"rate": 4.0}}))
+        self.assertEqual(figures["drain_time"], 30.0)
+        self.assertEqual(figures["utilisation"], 0.75)
+
+    def test_drain_time_from_processing_time(self):
+        metrics.observe("messages.duration", 10.0)
+        figures = CapacitySignals.calculate(queue(messages=16))
+        # 2 consumers each working on 4 messages at a time
+        self.assertEqual(figures["drain_time"], 20.0)
+        self.assertEqual(figures["processing_time"], 10.0)
+
+    def test_no_drain_time_when_nothing_getting_through(self):
+        self.assertIsNone(CapacitySignals.calculate(queue(messages=5, consumers=0))["drain_time"])
+        self.assertEqual(CapacitySignals.calculate(queue())["drain_time"], 0)
+
+    def test_scheduled_messages_count_as_in_flight(self):
+        metrics.set_gauge("scheduler.in_flight", 3)
+        figures = CapacitySignals.calculate(queue())
+        self.assertEqual(figures["scheduled"], 3)
+        self.assertEqual(figures["in_flight"], 6)
+        self.assertEqual(figures["utilisation"], 1.5)
+
+    @testing.gen_test
+    def test_refresh_caches_figures(self):
+        with self._fetch(queue(messages=7)):
+            yield self.signals.refresh()
+        self.clock.return_value = 112.0
+        served = self.signals.as_dict()
+        self.assertEqual(served["messages"], 7)
+        self.assertEqual(served["age"], 12.0)
+        self.assertIsNone(served["error"])
+
+    @testing.gen_test
+    def test_failed_refresh_keeps_last_figures(self):
+        with self._fetch(queue(messages=7)):
+            yield self.signals.refresh()
+        with self._fetch(error=HTTPError(503)):
+            yield self.signals.refresh()
+        served = self.signals.as_dict()
+        self.assertEqual(served["messages"], 7)
+        self.assertIn("503", served["error"])
@@ -0,0 +1,140 @@
+import base64
+import functools
+import gzip
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import Mock
+
+from sdc.crypto.encrypter import encrypt
+from sdc.crypto.key_store import KeyStore
+from sdc.rabbit.exceptions import QuarantinableError
+import yaml
+
+from app.anti_virus_check import SimulatedAntiVirusCheck
+from app.chunks import ChunkError, ChunkStore
+from app.delivery import LocalDirectoryDelivery
+from app.main import SeftConsumer, KEY_PURPOSE_CONSUMER
+
+CONTENTS = b"0123456789" * 100
+DIGEST = hashlib.sha256(CONTENTS).hexdigest()
+
+
+def chunks_of(contents, count):
+    size = -(-len(contents) // count)
+    return [base64.b64encode(contents[i * size:(i + 1) * size]).decode() for i in range(count)]
+
+
+class ChunkStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.clock = Mock(return_value=1000.0)
+        self.store = ChunkStore(self.directory, timeout=60, clock=self.clock)
+
+    def test_assembles_once_every_chunk_arrives(self):
+        chunks = chunks_of(CONTENTS, 3)
+        self.assertIsNone(self.store.add("case", DIGEST, 2, 3, chunks[2], "tx2"))
+        self.assertIsNone(self.store.add("case", DIGEST, 0, 3, chunks[0], "tx0"))
+        path = self.store.add("case", DIGEST, 1, 3, chunks[1], "tx1")
+        with open(path, "rb") as assembled:
+            self.assertEqual(assembled.read(), CONTENTS)
+
+    def test_redelivered_chunk_counted_once(self):
+        chunks = chunks_of(CONTENTS, 2)
+        self.store.add("case", DIGEST, 0, 2, chunks[0], "tx0")
+        self.assertIsNone(self.store.add("case", DIGEST, 0, 2, chunks[0], "tx0"))
+        self.assertIsNotNone(self.store.add("case", DIGEST, 1, 2, chunks[1], "tx1"))
+
+    def test_digest_mismatch_discards_set(self):
+        chunks = chunks_of(CONTENTS, 2)
+        self.store.add("case", DIGEST, 0, 2, chunks[0], "tx0")
+        with self.assertRaises(ChunkError):
+            self.store.add("case", DIGEST, 1, 2, base64.b64encode(b"x" * 500).decode(), "tx1")
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_claimed_set_only_picked_up_by_its_owner(self):
+        chunks = chunks_of(CONTENTS, 2)
+        self.store.add("case", DIGEST, 0, 2, chunks[0], "tx0")
+        path = self.store.add("case", DIGEST, 1, 2, chunks[1], "tx1")
+        # Another message completing the set at the same moment leaves it to tx1...
+        self.assertIsNone(self.store.add("case", DIGEST, 0, 2, chunks[0], "tx0"))
+        # ...which gets the same file back if it is redelivered
+        self.assertEqual(self.store.add("case", DIGEST, 1, 2, chunks[1], "tx1"), path)
+
+    def test_malformed_chunks_rejected(self):
+        with self.assertRaises(ChunkError):
+            self.store.add("case", "not a digest", 0, 1, "", "tx")
+        with self.assertRaises(ChunkError):
+            self.store.add("case", DIGEST, 1, 1, "", "tx")
+        with self.assertRaises(ChunkError):
+            self.store.add("case", DIGEST, 0, 1, "not base64!", "tx")
+
+    def test_expire_moves_stale_sets_aside(self):
+        self.store.add("case", DIGEST, 0, 2, chunks_of(CONTENTS, 2)[0], "tx0")
+        self.clock.return_value = os.stat(self.directory).st_mtime + 30
+        self.assertEqual(self.store.expire(), 0)
+        self.clock.return_value += 60
+        with self.assertLogs(level="ERROR") as logs:
+            self.assertEqual(self.store.expire(), 1)
+        self.assertEqual(os.listdir(self.directory), [".expired"])
+        expired, = os.listdir(os.path.join(self.directory, ".expired"))
+        self.assertEqual(os.listdir(os.path.join(self.directory, ".expired", expired, "parts")), ["000000"])
+        self.assertIn("case_id=case", logs.output[0])
+
+        # Expired sets are kept, and not expired again
+        self.clock.return_value += 3600
+        self.assertEqual(self.store.expire(), 0)
+
+
+class ChunkedSubmissionTests(unittest.TestCase):
+
+    def setUp(self):
+        with open("./sdx_test_keys/keys.yml") as file:
+            sdx_keys = yaml.safe_load(file)
+        with open("./ras_test_keys/keys.yml") as file:
+            self.ras_key_store = KeyStore(yaml.safe_load(file))
+        self.output = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output)
+        self.consumer = SeftConsumer(sdx_keys, delivery=LocalDirectoryDelivery(Mock(), self.output),
+                                     anti_virus=functools.partial(SimulatedAntiVirusCheck, latency=0))
+        self.consumer.chunks = ChunkStore(os.path.join(self.output, "spill"), timeout=60)
+
+    def _message(self, chunk, index, count, digest=DIGEST, **claims):
+        return encrypt(dict({"filename": "big.xlsx", "case_id": "601c4ee4", "survey_id": "221", "file": chunk,
+                             "chunk_index": index, "chunk_count": count, "file_digest": digest}, **claims),
+                       self.ras_key_store, KEY_PURPOSE_CONSUMER)
+
+    def test_chunks_quarantined_without_spill_directory(self):
+        self.consumer.chunks = None
+        with self.assertRaises(QuarantinableError):
+            self.consumer.process(self._message(chunks_of(CONTENTS, 2)[0], 0, 2), tx_id="0")
+
+    def test_file_delivered_after_last_chunk(self):
+        chunks = chunks_of(CONTENTS, 3)
+        delivered = os.path.join(self.output, "221", "big.xlsx")
+        for index in (1, 0):
+            self.consumer.process(self._message(chunks[index], index, 3), tx_id=str(index))
+            self.assertFalse(os.path.exists(delivered))
+
+        self.consumer.process(self._message(chunks[2], 2, 3), tx_id="2")
+        with open(delivered, "rb") as file:
+            self.assertEqual(file.read(), CONTENTS)
+        self.assertEqual(os.listdir(os.path.join(self.output, "spill")), [])
+
+    def test_bad_digest_quarantined(self):
+        chunk = chunks_of(CONTENTS, 1)[0]
+        with self.assertRaises(QuarantinableError):
+            self.consumer.process(self._message(chunk, 0, 1, digest="0" * 64), tx_id="1")
+
+    def test_compressed_file_decompressed_after_assembly(self):
+        compressed = gzip.compress(CONTENTS)
+        chunks = chunks_of(compressed, 2)
+        digest = hashlib.sha256(compressed).hexdigest()
+        for index, chunk in enumerate(chunks):
+            self.consumer.process(self._message(chunk, index, 2, digest, content_encoding="gzip"), tx_id=str(index))
+        with open(os.path.join(self.output, "221", "big.xlsx"), "rb") as file:
+            self.assertEqual(file.read(), CONTENTS)
@@ -1,5 +1,7 @@
 import base64
+import concurrent.futures
 import json
+import threading
 import unittest
 import unittest.mock
 import uuid
@@ -12,6 +14,7 @@ from sdc.crypto.exceptions import InvalidTokenException
 from sdc.rabbit.exceptions import QuarantinableError, RetryableError
 import yaml
 
+from app.deadline import DeadlineExceeded
 from app.main import SeftConsumer, KEY_PURPOSE_CONSUMER
 from app.tests import TEST_FILES_PATH
 from app.sdxftp import SDXFTP
@@ -87,7 +90,8 @@ class ConsumerTests(unittest.TestCase):
             payload_as_json = json.loads(payload)
             encrypted_jwt = encrypt(payload_as_json, self.ras_key_store, KEY_PURPOSE_CONSUMER)
             self.consumer.process(encrypted_jwt, uuid.uuid4())
-        mock_deliver_binary.assert_called_with("./SomeSurveyId", 'test1.xls', unittest.mock.ANY)
+        mock_deliver_binary.assert_called_with("./SomeSurveyId", 'test1.xls', unittest.mock.ANY, deadline=unittest.mock.ANY,
+                                               timeline=unittest.mock.ANY)
         self.assertTrue(mock_send_for_av_scan.called)
 
     def test_on_message_fails_with_empty_filename(self):
@@ -203,6 +207,15 @@ class ConsumerTests(unittest.TestCase):
                 self.consumer.process(encrypted_jwt, uuid.uuid4())
         self.assertTrue(mock_send_for_av_scan.called)
 
+    @patch('app.anti_virus_check.AntiVirusCheck.send_for_av_scan')
+    def test_send_ftp_connection_dropped(self, mock_send_for_av_scan):
+        encrypted_jwt = encrypt({"filename": "test1", "case_id": "601c4ee4-83ed-11e7-bb31-be2e44b06b34", "survey_id": "221",
+                                 "file": base64.b64encode(b"contents").decode()}, self.ras_key_store, KEY_PURPOSE_CONSUMER)
+        with unittest.mock.patch.object(SDXFTP, 'deliver_binary') as mock_method:
+            mock_method.side_effect = EOFError
+            with self.assertRaises(RetryableError):
+                self.consumer.process(encrypted_jwt, uuid.uuid4())
+
     def test_decrypt_invalid_token_exception(self):
 
         with open(join(TEST_FILES_PATH, "test1.xls"), "rb") as fb:
@@ -232,3 +245,36 @@ class ConsumerTests(unittest.TestCase):
         with unittest.mock.patch('app.main.decrypt', side_effect=Exception):
             with self.assertRaises(QuarantinableError):
                 self.consumer.process(encrypted_jwt, uuid.uuid4())
+
+
+class DrainTests(unittest.TestCase):
+
+    def setUp(self):
+        with open("./sdx_test_keys/keys.yml") as file:
+            sdx_keys = yaml.safe_load(file)
+        with open("./ras_test_keys/keys.yml") as file:
+            ras_key_store = KeyStore(yaml.safe_load(file))
+        self.scanning, self.release = threading.Event(), threading.Event()
+        anti_virus = unittest.mock.Mock()
+        anti_virus.return_value.send_for_av_scan.side_effect = lambda *args, **kwargs: (
+            self.scanning.set(), self.release.wait(5))
+        self.delivery = unittest.mock.Mock()
+        self.consumer = SeftConsumer(sdx_keys, delivery=self.delivery, anti_virus=anti_virus)
+        self.encrypted_jwt = encrypt({"filename": "test1.xls", "file": base64.b64encode(b"contents").decode(),
+                                      "case_id": "601c4ee4-83ed-11e7-bb31-be2e44b06b34", "survey_id": "221"},
+                                     ras_key_store, KEY_PURPOSE_CONSUMER)
+
+    def test_nothing_delivered_after_drain_report(self):
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            in_flight = executor.submit(self.consumer.process, self.encrypted_jwt, "1")
+            self.assertTrue(self.scanning.wait(5))
+
+            self.consumer._on_drained({"abandoned": 1})
+            self.release.set()
+            with self.assertRaises(DeadlineExceeded):
+                in_flight.result(5)
+
+        with self.assertRaises(DeadlineExceeded):
+            self.consumer.process(self.encrypted_jwt, "2")
+        self.assertFalse(self.delivery.deliver_binary.called)
+        self.assertEqual(self.consumer.abandoned, 1)
@@ -0,0 +1,96 @@
+import threading
+import time
+import unittest
+from unittest.mock import Mock, patch
+
+from sdc.rabbit.exceptions import RetryableError
+
+from app.deadline import Deadline, DeadlineExceeded
+from app.sdxftp import SDXFTP
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class DeadlineTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.deadline = Deadline(10, clock=self.clock)
+
+    def test_exceeded_is_retryable(self):
+        self.assertTrue(issubclass(DeadlineExceeded, RetryableError))
+
+    def test_timeout_is_time_remaining_capped(self):
+        self.clock.now = 4
+        self.assertEqual(self.deadline.timeout("stage"), 6)
+        self.assertEqual(self.deadline.timeout("stage", cap=2), 2)
+
+    def test_check_raises_once_expired(self):
+        self.clock.now = 9.9
+        self.deadline.check("stage")
+        self.clock.now = 10
+        with self.assertRaises(DeadlineExceeded):
+            self.deadline.check("stage")
+        with self.assertRaises(DeadlineExceeded):
+            self.deadline.timeout("stage")
+
+    def test_sleep_past_deadline_gives_up_immediately(self):
+        self.clock.now = 8
+        with patch.object(self.deadline._cancelled, "wait") as wait:
+            with self.assertRaises(DeadlineExceeded):
+                self.deadline.sleep(5, "stage")
+        self.assertFalse(wait.called)
+
+    def test_cancel_interrupts_sleep(self):
+        deadline = Deadline(0)
+        threading.Timer(0.05, deadline.cancel).start()
+        started = time.monotonic()
+        with self.assertRaises(DeadlineExceeded):
+            deadline.sleep(30, "stage")
+        self.assertLess(time.monotonic() - started, 5)
+
+    def test_no_deadline(self):
+        deadline = Deadline(0, clock=self.clock)
+        self.clock.now = 10 ** 6
+        deadline.check("stage")
+        self.assertIsNone(deadline.remaining())
+        self.assertEqual(deadline.timeout("stage", cap=30), 30)
+
+    def test_cancelled(self):
+        for deadline in (self.deadline, Deadline(0, clock=self.clock)):
+            deadline.cancel()
+            self.assertEqual(deadline.remaining(), 0)
+            with self.assertRaises(DeadlineExceeded):
+                deadline.check("stage")
+
+
+@patch('app.sdxftp.FTP')
+class FTPDeadlineTests(unittest.TestCase):
+
+    def test_socket_timeout_is_time_remaining(self, ftp_class):
+        clock = FakeClock()
+        ftp = SDXFTP(Mock(), "localhost", "user", "pass", timeout=60)
+        ftp.deliver_binary("/009", "a.xlsx", b"a", deadline=Deadline(10, clock=clock))
+        ftp_class.return_value.connect.assert_called_with("localhost", 21, timeout=10)
+        ftp_class.return_value.sock.settimeout.assert_called_with(10)
+
+    def test_transfer_abandoned_when_deadline_passes(self, ftp_class):
+        clock = FakeClock()
+        deadline = Deadline(10, clock=clock)
+
+        def stor(command, stream, callback):
+            clock.now = 11
+            callback(b"block")
+
+        ftp_class.return_value.storbinary.side_effect = stor
+        ftp = SDXFTP(Mock(), "localhost", "user", "pass")
+        with self.assertRaises(DeadlineExceeded):
+            ftp.deliver_binary("/009", "a.xlsx", b"a", deadline=deadline)
+        self.assertTrue(ftp_class.return_value.close.called)
@@ -0,0 +1,91 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import Mock, patch
+
+from app import settings
+from app.deadline import Deadline, DeadlineExceeded
+from app.delivery import LocalDirectoryDelivery, NullDelivery, delivery_from_settings
+from app.sdxftp import SDXFTP
+
+
+class LocalDirectoryDeliveryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.delivery = LocalDirectoryDelivery(Mock(), self.root, fsync=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def read(self, *path):
+        with open(os.path.join(self.root, *path), "rb") as file:
+            return file.read()
+
+    def test_delivers_bytes(self):
+        self.delivery.deliver_binary("./009", "a.xlsx", b"contents")
+        self.assertEqual(self.read("009", "a.xlsx"), b"contents")
+        self.assertEqual(os.listdir(os.path.join(self.root, "009")), ["a.xlsx"])
+
+    def test_delivers_spill_file(self):
+        with tempfile.TemporaryFile() as spill:
+            spill.write(os.urandom(3 * 1024 ** 2))
+            spill.seek(0)
+            with patch("app.delivery.COPY_BLOCK_SIZE", 1024 ** 2), patch("app.delivery.os.sendfile",
+                                                                         wraps=os.sendfile) as sendfile:
+                self.delivery.deliver_binary("./009", "a.xlsx", spill)
+            spill.seek(0)
+            self.assertEqual(self.read("009", "a.xlsx"), spill.read())
+        self.assertEqual(sendfile.call_count, 4)
+
+    def test_delivers_stream_without_a_file(self):
+        self.delivery.deliver_binary("./009", "a.xlsx", io.BytesIO(b"contents"))
+        self.assertEqual(self.read("009", "a.xlsx"), b"contents")
+
+    def test_replaces_existing_file(self):
+        self.delivery.deliver_binary("./009", "a.xlsx", b"first")
+        self.delivery.deliver_binary("./009", "a.xlsx", b"second")
+        self.assertEqual(self.read("009", "a.xlsx"), b"second")
+
+    def test_failed_write_leaves_nothing_behind(self):
+        clock = Mock(side_effect=[0, 0, 11])
+        with patch("app.delivery.COPY_BLOCK_SIZE", 4), self.assertRaises(DeadlineExceeded):
+            self.delivery.deliver_binary("./009", "a.xlsx", b"contents", deadline=Deadline(10, clock=clock))
+        self.assertEqual(os.listdir(os.path.join(self.root, "009")), [])
+
+    def test_refuses_to_deliver_outside_root(self):
+        with self.assertRaises(IOError):
+            self.delivery.deliver_binary("../..", "a.xlsx", b"contents")
+
+    def test_available(self):
+        self.assertTrue(self.delivery.available())
+        self.assertTrue(LocalDirectoryDelivery(Mock(), os.path.join(self.root, "new")).available())
+
+
+class DeliveryFromSettingsTests(unittest.TestCase):
+
+    def test_ftp(self):
+        with patch.multiple(settings, DELIVERY_BACKEND="ftp", FTP_TARGETS=""):
+            self.assertIsInstance(delivery_from_settings(Mock()), SDXFTP)
+
+    def test_filesystem(self):
+        with patch.multiple(settings, DELIVERY_BACKEND="filesystem", DELIVERY_DIR="/mnt/collection",
+                            DELIVERY_FSYNC=False):
+            delivery = delivery_from_settings(Mock())
+        self.assertIsInstance(delivery, LocalDirectoryDelivery)
+        self.assertEqual(delivery.root, "/mnt/collection")
+        self.assertFalse(delivery.fsync)
+
+    def test_filesystem_without_directory(self):
+        with patch.multiple(settings, DELIVERY_BACKEND="filesystem", DELIVERY_DIR=None), self.assertRaises(ValueError):
+            delivery_from_settings(Mock())
+
+    def test_null(self):
+        with patch.object(settings, "DELIVERY_BACKEND", "null"):
+            self.assertIsInstance(delivery_from_settings(Mock()), NullDelivery)
+
+    def test_unknown(self):
+        with patch.object(settings, "DELIVERY_BACKEND", "s3"), self.assertRaises(ValueError):
+            delivery_from_settings(Mock())
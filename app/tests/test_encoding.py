@@ -0,0 +1,89 @@
+import base64
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import Mock, patch
+
+from sdc.rabbit.exceptions import QuarantinableError, RetryableError
+
+from app import settings
+from app.encoding import DecodingError, check_encoding, decompress, decompress_spilling, decompress_stream
+from app.main import SeftConsumer
+from app.tests import TEST_FILES_PATH
+
+with open(TEST_FILES_PATH + "test1.xls", "rb") as file:
+    XLS = file.read()
+
+
+class DecompressTests(unittest.TestCase):
+
+    def test_gzip(self):
+        self.assertEqual(decompress(gzip.compress(XLS), "gzip"), XLS)
+
+    def test_stream(self):
+        decompressed = io.BytesIO()
+        self.assertEqual(decompress_stream(io.BytesIO(gzip.compress(XLS)), decompressed, "gzip"), len(XLS))
+        self.assertEqual(decompressed.getvalue(), XLS)
+
+    def test_spills_past_memory_limit(self):
+        self.assertEqual(decompress_spilling(gzip.compress(XLS), "gzip", max_in_memory=len(XLS)), (XLS, None))
+
+        contents, path = decompress_spilling(gzip.compress(XLS), "gzip", max_in_memory=1024)
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        self.assertIsNone(contents)
+        with open(path, "rb") as file:
+            self.assertEqual(file.read(), XLS)
+
+    def test_failed_spill_removed(self):
+        bomb = gzip.compress(b"\0" * 10 * 1024 ** 2)
+        directory = self.enterContext(tempfile.TemporaryDirectory())
+        with self.assertRaises(DecodingError):
+            decompress_spilling(bomb, "gzip", max_bytes=1024 ** 2, max_in_memory=1024, directory=directory)
+        self.assertEqual(os.listdir(directory), [])
+
+    def test_limit(self):
+        bomb = gzip.compress(b"\0" * 10 * 1024 ** 2)
+        with self.assertRaises(DecodingError):
+            decompress(bomb, "gzip", max_bytes=1024 ** 2)
+
+    def test_corrupt(self):
+        with self.assertRaises(DecodingError):
+            decompress(gzip.compress(XLS)[:-100], "gzip")
+        with self.assertRaises(DecodingError):
+            decompress(XLS, "gzip")
+
+    def test_unsupported(self):
+        for encoding in ("br", "zstd"):
+            with self.assertRaises(DecodingError):
+                check_encoding(encoding)
+
+
+class ExtractCompressedFileTests(unittest.TestCase):
+
+    claims = {"filename": "test1.xls", "case_id": "601c4ee4", "survey_id": "221"}
+
+    def test_gzip_claim_decompressed(self):
+        claims = dict(self.claims, file=base64.b64encode(gzip.compress(XLS)).decode(), content_encoding="gzip")
+        self.assertEqual(SeftConsumer.extract_file(claims, "1").decoded_contents, XLS)
+
+    def test_file_bigger_than_message_reserved_spilled(self):
+        claims = dict(self.claims, file=base64.b64encode(gzip.compress(b"\0" * 1024 ** 2)).decode(),
+                      content_encoding="gzip")
+        payload = SeftConsumer.extract_file(claims, "1")
+        self.assertIsNone(payload.decoded_contents)
+        self.assertTrue(payload.temporary)
+        self.assertEqual(payload.size, 1024 ** 2)
+
+        # Removed once delivered, whatever happens
+        consumer = SeftConsumer(None, delivery=Mock(deliver_binary=Mock(side_effect=IOError)))
+        with patch.object(settings, "ANTI_VIRUS_ENABLED", False), self.assertRaises(RetryableError):
+            consumer.deliver(payload, "1")
+        self.assertFalse(os.path.exists(payload.spill_path))
+
+    def test_undecompressable_file_quarantined(self):
+        claims = dict(self.claims, file=base64.b64encode(XLS).decode(), content_encoding="gzip")
+        with self.assertRaises(QuarantinableError):
+            SeftConsumer.extract_file(claims, "1")
@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+from unittest.mock import Mock
+
+from sdc.crypto.decrypter import decrypt
+from sdc.crypto.encrypter import encrypt
+from sdc.crypto.exceptions import CryptoError
+from sdc.crypto.key_store import KeyStore
+from tornado import gen, testing
+import yaml
+
+from app.keys import KeyStoreReloader, ParsedKeyStore, load_key_store
+from app.main import KEY_PURPOSE_CONSUMER
+
+
+class KeysTestCase(testing.AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, "keys.yml")
+        shutil.copy("./sdx_test_keys/keys.yml", self.path)
+        with open(self.path) as file:
+            self.keys = yaml.safe_load(file)
+
+    def _write(self, keys):
+        with open(self.path, "w") as file:
+            yaml.safe_dump(keys, file)
+        # Make sure the change is seen even within the filesystem's timestamp granularity
+        os.utime(self.path, ns=(0, os.stat(self.path).st_mtime_ns + 10 ** 9))
+
+
+class ParsedKeyStoreTests(KeysTestCase):
+
+    def test_keys_parsed_once(self):
+        key_store = ParsedKeyStore(self.keys)
+        kid = next(iter(key_store.keys))
+        self.assertIs(key_store.keys[kid].as_jwk(), key_store.keys[kid].as_jwk())
+
+    def test_decrypts(self):
+        with open("./ras_test_keys/keys.yml") as file:
+            ras_key_store = KeyStore(yaml.safe_load(file))
+        token = encrypt({"survey_id": "221"}, ras_key_store, KEY_PURPOSE_CONSUMER)
+        self.assertEqual(decrypt(token, ParsedKeyStore(self.keys), KEY_PURPOSE_CONSUMER)["survey_id"], "221")
+
+    def test_unparseable_key_fails_load(self):
+        kid = next(iter(self.keys["keys"]))
+        self.keys["keys"][kid]["value"] = "not a pem"
+        with self.assertRaises(CryptoError):
+            ParsedKeyStore(self.keys)
+
+    def test_load_validates_required_keys(self):
+        self.keys["keys"] = {kid: key for kid, key in self.keys["keys"].items() if key["type"] != "private"}
+        self._write(self.keys)
+        with self.assertRaises(CryptoError):
+            load_key_store(self.path, KEY_PURPOSE_CONSUMER)
+
+
+class KeyStoreReloaderTests(KeysTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.on_reload = Mock()
+        self.reloader = KeyStoreReloader(self.path, KEY_PURPOSE_CONSUMER, self.on_reload)
+
+    @testing.gen_test
+    def test_unchanged_file_not_reloaded(self):
+        self.reloader.check()
+        self.assertIsNone(self.reloader._loading)
+
+    @testing.gen_test
+    def test_changed_file_swapped_in(self):
+        self._write(self.keys)
+        self.reloader.check()
+        yield self.reloader._loading
+        yield gen.moment
+        self.assertIsInstance(self.on_reload.call_args[0][0], ParsedKeyStore)
+
+    @testing.gen_test
+    def test_bad_file_keeps_current_keys(self):
+        with open(self.path, "w") as file:
+            file.write("keys: [")
+        try:
+            yield self.reloader.reload()
+        except Exception:  # pylint: disable=broad-except
+            pass
+        yield gen.moment
+        self.assertFalse(self.on_reload.called)
+
+        # Not retried until the file changes again
+        self.reloader.check()
+        self.assertIsNone(self.reloader._loading)
@@ -0,0 +1,82 @@
+import logging
+import queue
+import unittest
+from unittest.mock import Mock, patch
+
+from structlog import wrap_logger
+
+from app import logs
+from app.logs import DroppingQueueHandler, Lazy, QueuedLogging, SeftBoundLogger
+from app.metrics import metrics
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class SeftBoundLoggerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = ListHandler()
+        stdlib_logger = logging.getLogger("test_logs")
+        stdlib_logger.propagate = False
+        stdlib_logger.handlers = [self.handler]
+        stdlib_logger.setLevel(logging.INFO)
+        self.addCleanup(stdlib_logger.removeHandler, self.handler)
+        self.logger = wrap_logger(stdlib_logger, wrapper_class=SeftBoundLogger)
+
+    def test_disabled_level_skips_lazy_fields(self):
+        compute = Mock(return_value="body")
+        self.logger.debug("Response received", response=Lazy(compute))
+        self.assertFalse(compute.called)
+        self.assertEqual(self.handler.messages, [])
+
+        self.logger.info("Response received", response=Lazy(compute))
+        self.assertIn("response=body", self.handler.messages[0])
+
+    @patch.object(logs, "sample_every", 3)
+    def test_samples_repeated_lines(self):
+        for _ in range(7):
+            self.logger.info("Results not ready", _sample="scan-1")
+        self.logger.info("Results not ready", _sample="scan-2")
+        self.assertEqual(len(self.handler.messages), 4)
+        self.assertNotIn("_sample", self.handler.messages[0])
+
+    @patch.object(logs, "measuring", True)
+    def test_measures_calls(self):
+        metrics.reset()
+        self.logger.info("measured")
+        self.logger.debug("skipped")
+        self.assertEqual(metrics.snapshot()["timings"]["logging.call"]["count"], 2)
+
+
+class QueuedLoggingTests(unittest.TestCase):
+
+    def test_full_queue_drops(self):
+        metrics.reset()
+        handler = DroppingQueueHandler(queue.Queue(1))
+        record = logging.makeLogRecord({"msg": "line"})
+        handler.emit(record)
+        handler.emit(record)
+        self.assertEqual(metrics.snapshot()["counters"]["logging.dropped"], 1)
+
+    def test_records_written_by_listener(self):
+        root = logging.getLogger()
+        original = root.handlers[:]
+        self.addCleanup(setattr, root, "handlers", original)
+        written = ListHandler()
+        root.handlers = [written]
+
+        queued = QueuedLogging(100)
+        with patch("app.logs.os.register_at_fork"):
+            queued.start()
+        self.assertIsInstance(root.handlers[0], DroppingQueueHandler)
+        logging.getLogger("test_logs_queued").warning("queued line")
+        queued.stop()
+        self.assertEqual(written.messages, ["queued line"])
@@ -0,0 +1,97 @@
+import base64
+import filecmp
+import io
+import json
+import os
+import tempfile
+import types
+import unittest
+from os.path import join
+from unittest.mock import Mock
+
+from sdc.crypto.encrypter import encrypt
+from sdc.crypto.key_store import KeyStore
+import yaml
+
+from app.delivery import LocalDirectoryDelivery
+from app.main import KEY_PURPOSE_CONSUMER
+from app.offline import read_directory, read_jsonl, read_source, run
+from app.tests import TEST_FILES_PATH
+
+
+class OfflineTests(unittest.TestCase):
+
+    def setUp(self):
+        with open("./sdx_test_keys/keys.yml") as file:
+            self.sdx_keys = yaml.safe_load(file)
+        with open("./ras_test_keys/keys.yml") as file:
+            self.ras_key_store = KeyStore(yaml.safe_load(file))
+        self.encrypted_dir = tempfile.mkdtemp()
+        self.output_dir = tempfile.mkdtemp()
+
+    def _encrypt(self, file_name, survey_id="221"):
+        with open(join(TEST_FILES_PATH, file_name), "rb") as fb:
+            encoded_contents = base64.b64encode(fb.read())
+        payload = {"filename": file_name, "file": encoded_contents.decode(),
+                   "case_id": "601c4ee4-83ed-11e7-bb31-be2e44b06b34", "survey_id": survey_id}
+        return encrypt(payload, self.ras_key_store, KEY_PURPOSE_CONSUMER)
+
+    def test_directory_delivered_to_output(self):
+        for file_name in ("test1.xls", "test2.xlsx"):
+            with open(join(self.encrypted_dir, file_name), "w") as encrypted_file:
+                encrypted_file.write(self._encrypt(file_name))
+        with open(join(self.encrypted_dir, "bad"), "w") as encrypted_file:
+            encrypted_file.write("not a jwt")
+
+        counts = run(read_directory(self.encrypted_dir), self.sdx_keys, output=self.output_dir, workers=2, skip_av=True)
+
+        self.assertEqual(counts["delivered"], 2)
+        self.assertEqual(counts["quarantined"], 1)
+        for file_name in ("test1.xls", "test2.xlsx"):
+            self.assertTrue(filecmp.cmp(join(TEST_FILES_PATH, file_name), join(self.output_dir, "221", file_name)))
+
+    def test_read_directory_skips_hidden_files(self):
+        open(join(self.encrypted_dir, ".placeholder"), "w").close()
+        open(join(self.encrypted_dir, "submission"), "w").close()
+        sources = [submission.source for submission in read_directory(self.encrypted_dir)]
+        self.assertEqual(sources, [join(self.encrypted_dir, "submission")])
+
+    def test_read_jsonl(self):
+        stream = io.StringIO(json.dumps({"tx_id": "abc", "jwt": "token"}) + "\n\n" + json.dumps({"jwt": "other"}) + "\n")
+        submissions = list(read_jsonl(stream))
+        self.assertEqual(len(submissions), 2)
+        self.assertEqual(submissions[0].tx_id, "abc")
+        self.assertEqual(submissions[0].jwt, "token")
+        self.assertEqual(submissions[1].source, "stdin:3")
+        self.assertTrue(submissions[1].tx_id)
+
+    def test_malformed_lines_counted_as_failed(self):
+        path = join(self.encrypted_dir, "backlog.jsonl")
+        with open(path, "w") as backlog:
+            backlog.write(json.dumps({"jwt": self._encrypt("test1.xls")}) + "\n")
+            backlog.write('{"jwt": "trunc\n')
+            backlog.write(json.dumps({"tx_id": "no jwt"}) + "\n")
+            backlog.write(json.dumps({"jwt": self._encrypt("test2.xlsx")}) + "\n")
+
+        with self.assertLogs(level="ERROR") as logs:
+            counts = run(read_source(path), self.sdx_keys, output=self.output_dir, workers=1, skip_av=True)
+
+        self.assertEqual(counts, {"delivered": 2, "failed": 2})
+        self.assertIn("source={}:2".format(path), logs.output[0])
+        self.assertTrue(os.path.exists(join(self.output_dir, "221", "test2.xlsx")))
+
+    def test_read_source_streams_jsonl_file(self):
+        path = join(self.encrypted_dir, "backlog.jsonl")
+        with open(path, "w") as backlog:
+            backlog.write(json.dumps({"tx_id": "abc", "jwt": "token"}) + "\n" + json.dumps({"jwt": "other"}) + "\n")
+
+        submissions = read_source(path)
+        self.assertIsInstance(submissions, types.GeneratorType)
+        self.assertEqual(next(submissions).tx_id, "abc")
+        self.assertEqual([submission.source for submission in submissions], [path + ":2"])
+
+    def test_local_delivery_stays_in_output(self):
+        delivery = LocalDirectoryDelivery(Mock(), self.output_dir)
+        with self.assertRaises(IOError):
+            delivery.deliver_binary("./221", "../../escape", b"data")
+        self.assertFalse(os.path.exists(join(self.output_dir, "..", "escape")))
@@ -0,0 +1,63 @@
+import base64
+import json
+import unittest
+import uuid
+from unittest.mock import patch
+
+from sdc.crypto.encrypter import encrypt
+from sdc.crypto.exceptions import InvalidTokenException
+from sdc.crypto.key_store import KeyStore
+from sdc.rabbit.exceptions import QuarantinableError
+import yaml
+
+from app.main import KEY_PURPOSE_CONSUMER, SeftConsumer
+from app.precheck import check_jwe_header
+
+
+def with_header(token, **changes):
+    encoded, rest = token.split(".", 1)
+    header = json.loads(base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4)))
+    header.update(changes)
+    encoded = base64.urlsafe_b64encode(json.dumps(header).encode()).decode().rstrip("=")
+    return encoded + "." + rest
+
+
+class CheckJweHeaderTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        with open("./sdx_test_keys/keys.yml") as file:
+            cls.sdx_keys = yaml.safe_load(file)
+        with open("./ras_test_keys/keys.yml") as file:
+            ras_key_store = KeyStore(yaml.safe_load(file))
+        cls.key_store = KeyStore(cls.sdx_keys)
+        cls.token = encrypt({"filename": "test.xlsx", "file": "dGVzdA==", "case_id": "1", "survey_id": "221"},
+                            ras_key_store, KEY_PURPOSE_CONSUMER)
+
+    def _check(self, token, max_bytes=0):
+        return check_jwe_header(token, self.key_store, KEY_PURPOSE_CONSUMER, max_bytes)
+
+    def test_valid_token(self):
+        self.assertEqual(self._check(self.token)["alg"], "RSA-OAEP")
+
+    def test_rejects(self):
+        for token in (self.token + ".extra",
+                      self.token.rsplit(".", 1)[0],
+                      "." + self.token.split(".", 1)[1],
+                      "bm90IGpzb24." + self.token.split(".", 1)[1],
+                      with_header(self.token, kid="unknown"),
+                      with_header(self.token, alg="RSA1_5"),
+                      with_header(self.token, enc="A128CBC-HS256")):
+            with self.assertRaises(InvalidTokenException):
+                self._check(token)
+
+    def test_rejects_oversized_token(self):
+        with self.assertRaises(InvalidTokenException):
+            self._check(self.token, max_bytes=len(self.token) - 1)
+
+    def test_quarantined_without_decrypting(self):
+        consumer = SeftConsumer(self.sdx_keys)
+        with patch('app.main.decrypt') as decrypt:
+            with self.assertRaises(QuarantinableError):
+                consumer.process(with_header(self.token, kid="unknown"), uuid.uuid4())
+        self.assertFalse(decrypt.called)
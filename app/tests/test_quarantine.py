@@ -0,0 +1,254 @@
+import concurrent.futures
+import unittest
+from unittest.mock import MagicMock, Mock
+
+from pika.spec import Basic
+from sdc.rabbit.exceptions import QuarantinableError, RetryableError
+
+from app.message_consumer import SeftMessageConsumer
+from app.quarantine import QuarantinePublisher
+
+
+def confirm(method):
+    frame = Mock()
+    frame.method = method
+    return frame
+
+
+class QuarantinePublisherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = MagicMock()
+        self.channel = MagicMock()
+        self.publisher = QuarantinePublisher(queue="Seft.Responses.Quarantine", batch_size=3, batch_window=0.2)
+        self.publisher.open(self.connection)
+        self.publisher._on_channel_open(self.channel)
+        self.publisher._on_queue_declareok(None)
+        self.publisher._on_confirm_selectok(None)
+
+    def _quarantine(self, tx_id):
+        confirmed, failed = Mock(), Mock()
+        self.publisher.quarantine(b"body", {'tx_id': tx_id}, confirmed, failed)
+        return confirmed, failed
+
+    def test_buffers_until_batch_size(self):
+        self._quarantine("1")
+        self._quarantine("2")
+        self.assertFalse(self.channel.basic_publish.called)
+        self.assertTrue(self.connection.ioloop.call_later.called)
+
+        self._quarantine("3")
+        self.assertEqual(self.channel.basic_publish.call_count, 3)
+
+    def test_window_flush_publishes_partial_batch(self):
+        self._quarantine("1")
+        self.publisher.flush()
+        self.assertEqual(self.channel.basic_publish.call_count, 1)
+
+    def test_publishes_without_waiting_once_every_prefetched_delivery_is_waiting(self):
+        self.publisher.prefetch_count = 1
+        self._quarantine("1")
+        self.assertEqual(self.channel.basic_publish.call_count, 1)
+        self.assertFalse(self.connection.ioloop.call_later.called)
+
+    def test_waits_for_window_while_more_deliveries_can_arrive(self):
+        self.publisher.prefetch_count = 4
+        self._quarantine("1")
+        self._quarantine("2")
+        self.assertFalse(self.channel.basic_publish.called)
+
+        # Two unconfirmed and two buffered fill the prefetch
+        self.publisher.flush()
+        self._quarantine("3")
+        self._quarantine("4")
+        self.assertEqual(self.channel.basic_publish.call_count, 4)
+
+    def test_multiple_ack_confirms_batch(self):
+        pending = [self._quarantine(str(i)) for i in range(3)]
+        for confirmed, _ in pending:
+            self.assertFalse(confirmed.called)
+
+        self.publisher._on_delivery_confirmation(confirm(Basic.Ack(delivery_tag=2, multiple=True)))
+        self.assertTrue(pending[0][0].called)
+        self.assertTrue(pending[1][0].called)
+        self.assertFalse(pending[2][0].called)
+
+        self.publisher._on_delivery_confirmation(confirm(Basic.Ack(delivery_tag=3, multiple=False)))
+        self.assertTrue(pending[2][0].called)
+
+    def test_nack_fails_publish(self):
+        pending = [self._quarantine(str(i)) for i in range(3)]
+        self.publisher._on_delivery_confirmation(confirm(Basic.Nack(delivery_tag=1, multiple=False)))
+        confirmed, failed = pending[0]
+        self.assertFalse(confirmed.called)
+        self.assertTrue(failed.called)
+
+    def test_channel_closed_fails_outstanding(self):
+        pending = [self._quarantine(str(i)) for i in range(4)]
+        self.publisher._on_channel_closed(self.channel, "closed")
+        for confirmed, failed in pending:
+            self.assertFalse(confirmed.called)
+            self.assertTrue(failed.called)
+
+    def test_overflow_requeued_while_channel_unavailable(self):
+        self.publisher._on_channel_closed(self.channel, "closed")
+        pending = [self._quarantine(str(i)) for i in range(4)]
+        self.assertTrue(pending[0][1].called)
+        for _, failed in pending[1:]:
+            self.assertFalse(failed.called)
+
+
+class SeftMessageConsumerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.publisher = Mock(pending=0)
+        self.process = Mock()
+        self.consumer = SeftMessageConsumer(durable_queue=True, exchange="message", exchange_type="topic",
+                                            rabbit_queue="Seft.Responses", rabbit_urls=[],
+                                            quarantine_publisher=self.publisher, process=self.process)
+        self.consumer._channel = MagicMock()
+        self.consumer._connection = MagicMock()
+        self.consumer._connection.ioloop.add_callback.side_effect = lambda callback, *args: callback(*args)
+        self.properties = Mock(headers={'tx_id': "123"})
+        self.deliver = Mock(delivery_tag=7)
+
+    def _on_message(self):
+        self.consumer.on_message(None, self.deliver, self.properties, b"body")
+        self.consumer._executor.shutdown(wait=True)
+
+    def test_held_consumer_waits_for_resume(self):
+        connected = Mock()
+        self.consumer.on_connected = connected
+        self.consumer.hold()
+        self.consumer.start_consuming()
+        self.assertTrue(connected.called)
+        self.assertFalse(self.consumer._channel.basic_consume.called)
+
+        self.consumer.resume()
+        self.assertTrue(self.consumer._channel.basic_consume.called)
+
+    def test_resume_before_connecting_consumes_on_connect(self):
+        self.consumer.hold()
+        self.consumer.resume()
+        self.assertFalse(self.consumer._channel.basic_consume.called)
+        self.consumer.start_consuming()
+        self.assertTrue(self.consumer._channel.basic_consume.called)
+
+    def test_set_prefetch_consumes_again(self):
+        self.consumer.start_consuming()
+        self.consumer._channel.basic_cancel.side_effect = lambda tag, callback: callback(None)
+        self.consumer.set_prefetch(10)
+        self.consumer._channel.basic_qos.assert_called_with(prefetch_count=10)
+        self.assertEqual(self.consumer._channel.basic_consume.call_count, 2)
+        self.assertEqual(self.publisher.prefetch_count, 10)
+
+    def test_set_workers_grows_pool(self):
+        self.consumer.set_workers(3)
+        self.assertEqual(self.consumer.admission.max_in_flight, 3)
+        self._on_message()
+        self.consumer._channel.basic_ack.assert_called_with(7)
+
+    def test_quarantine_only_rejects_after_confirm(self):
+        self.process.side_effect = QuarantinableError
+        self._on_message()
+
+        self.assertFalse(self.consumer._channel.basic_reject.called)
+        body, headers, on_confirmed, _ = self.publisher.quarantine.call_args[0]
+        self.assertEqual(headers, {'tx_id': "123"})
+
+        on_confirmed()
+        self.consumer._channel.basic_reject.assert_called_with(7, requeue=False)
+
+    def test_failed_quarantine_requeues(self):
+        self.process.side_effect = QuarantinableError
+        self._on_message()
+
+        _, _, _, on_failed = self.publisher.quarantine.call_args[0]
+        on_failed()
+        self.consumer._channel.basic_reject.assert_called_with(7, requeue=True)
+
+    def test_success_acks(self):
+        self._on_message()
+        self.consumer._channel.basic_ack.assert_called_with(7)
+        self.assertFalse(self.publisher.quarantine.called)
+        self.process.assert_called_with("body", "123")
+
+    def test_retryable_error_nacks(self):
+        self.process.side_effect = RetryableError
+        self._on_message()
+        self.consumer._channel.basic_nack.assert_called_with(7)
+
+    def test_result_dropped_when_channel_replaced(self):
+        channel = self.consumer._channel
+        self.process.side_effect = lambda body, tx_id: setattr(self.consumer, '_channel', MagicMock())
+        self._on_message()
+        self.assertFalse(channel.basic_ack.called)
+        self.assertEqual(self.consumer.admission.in_flight, 0)
+
+    def test_handed_off_work_frees_slot_but_keeps_reservation(self):
+        handed_off = concurrent.futures.Future()
+        self.process.return_value = handed_off
+        self._on_message()
+
+        self.assertEqual(self.consumer.admission.in_flight, 0)
+        self.assertEqual(self.consumer.admission.reserved_bytes, len(b"body"))
+        self.assertFalse(self.consumer._channel.basic_ack.called)
+
+        handed_off.set_result(None)
+        self.consumer._channel.basic_ack.assert_called_with(7)
+        self.assertEqual(self.consumer.admission.reserved_bytes, 0)
+
+    def test_handed_off_failure_quarantines(self):
+        handed_off = concurrent.futures.Future()
+        self.process.return_value = handed_off
+        self._on_message()
+
+        handed_off.set_exception(QuarantinableError())
+        self.assertTrue(self.publisher.quarantine.called)
+        self.assertEqual(self.consumer.admission.in_flight, 0)
+
+    def test_drain_waits_for_in_flight_message(self):
+        handed_off = concurrent.futures.Future()
+        self.process.return_value = handed_off
+        self.consumer.start_consuming()
+        self._on_message()
+        drained = Mock()
+
+        self.consumer.drain(30, on_drained=drained, clock=lambda: 0)
+        self.consumer._channel.basic_cancel.assert_called_once()
+        self.assertFalse(drained.called)
+        check = self.consumer._connection.ioloop.call_later.call_args[0]
+
+        handed_off.set_result(None)
+        check[1](*check[2:])
+        self.consumer._channel.basic_ack.assert_called_with(7)
+        report = drained.call_args[0][0]
+        self.assertEqual(report["completed"], 1)
+        self.assertEqual(report["abandoned"], 0)
+        self.assertTrue(self.consumer._channel.close.called)
+
+    def test_drain_requeues_messages_not_started(self):
+        self.consumer.drain(30)
+        self._on_message()
+        self.assertFalse(self.process.called)
+        self.assertFalse(self.consumer._channel.basic_ack.called)
+        self.assertEqual(self.consumer._drained["requeued"], 1)
+
+    def test_drain_abandons_messages_after_grace_period(self):
+        handed_off = concurrent.futures.Future()
+        self.process.return_value = handed_off
+        self._on_message()
+        drained = Mock()
+        times = iter([0, 31, 31])
+
+        self.consumer.drain(30, on_drained=drained, clock=lambda: next(times))
+        self.assertEqual(drained.call_args[0][0]["abandoned"], 1)
+        self.assertTrue(self.consumer._closing)
+        self.assertTrue(self.consumer._channel.close.called)
+
+    def test_drain_waits_for_quarantine_confirms(self):
+        self.publisher.pending = 1
+        drained = Mock()
+        self.consumer.drain(30, on_drained=drained, clock=lambda: 0)
+        self.assertTrue(self.publisher.flush.called)
+        self.assertFalse(drained.called)
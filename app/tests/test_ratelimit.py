@@ -0,0 +1,164 @@
+import os
+import tempfile
+import threading
+import unittest
+
+from app.ratelimit import AIMDLimiter, ConcurrencyLimit, SharedTokenBucket, TokenBucket
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TokenBucketTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_burst_up_to_capacity(self):
+        bucket = TokenBucket(rate=10, capacity=5, clock=self.clock, sleep=self.clock.sleep)
+        for _ in range(5):
+            self.assertEqual(bucket.try_acquire(), 0)
+        self.assertAlmostEqual(bucket.try_acquire(), 0.1)
+
+    def test_refills_at_rate(self):
+        bucket = TokenBucket(rate=10, capacity=1, clock=self.clock, sleep=self.clock.sleep)
+        self.assertEqual(bucket.try_acquire(), 0)
+        self.clock.now += 0.1
+        self.assertEqual(bucket.try_acquire(), 0)
+
+    def test_acquire_waits_for_tokens(self):
+        bucket = TokenBucket(rate=4, capacity=1, clock=self.clock, sleep=self.clock.sleep)
+        for _ in range(5):
+            bucket.acquire()
+        self.assertAlmostEqual(self.clock.now, 1.0)
+
+    def test_set_rate(self):
+        bucket = TokenBucket(rate=10, capacity=5, clock=self.clock, sleep=self.clock.sleep)
+        bucket.set_rate(1)
+        self.assertEqual(bucket.capacity, 1)
+        self.assertEqual(bucket.try_acquire(), 0)
+        self.assertEqual(bucket.try_acquire(), 1)
+
+    def test_zero_rate_is_unlimited(self):
+        bucket = TokenBucket(rate=0, clock=self.clock, sleep=self.clock.sleep)
+        for _ in range(1000):
+            self.assertEqual(bucket.try_acquire(), 0)
+
+
+class SharedTokenBucketTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "bucket")
+
+    def _bucket(self):
+        return SharedTokenBucket(self.path, rate=10, capacity=2, clock=self.clock, sleep=self.clock.sleep)
+
+    def test_buckets_on_same_file_share_tokens(self):
+        first, second = self._bucket(), self._bucket()
+        self.assertEqual(first.try_acquire(), 0)
+        self.assertEqual(second.try_acquire(), 0)
+        self.assertAlmostEqual(first.try_acquire(), 0.1)
+        self.assertAlmostEqual(second.try_acquire(), 0.1)
+
+        self.clock.now += 0.1
+        self.assertEqual(second.try_acquire(), 0)
+        self.assertAlmostEqual(first.try_acquire(), 0.1)
+
+    def test_unlimited_does_not_touch_file(self):
+        bucket = SharedTokenBucket(self.path, rate=0)
+        self.assertEqual(bucket.try_acquire(), 0)
+        self.assertFalse(os.path.exists(self.path))
+
+
+class AIMDLimiterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = AIMDLimiter(maximum=8, minimum=2, increase_after=3, cooldown=5, clock=self.clock)
+
+    def test_overload_halves_limit(self):
+        self.assertTrue(self.limiter.on_overload())
+        self.assertEqual(self.limiter.limit, 4)
+        self.clock.now += 5
+        self.limiter.on_overload()
+        self.clock.now += 5
+        self.limiter.on_overload()
+        self.assertEqual(self.limiter.limit, 2)
+
+    def test_overloads_within_cooldown_decrease_once(self):
+        self.limiter.on_overload()
+        self.assertFalse(self.limiter.on_overload())
+        self.assertEqual(self.limiter.limit, 4)
+
+    def test_successes_increase_limit_up_to_maximum(self):
+        self.limiter.on_overload()
+        for _ in range(3):
+            self.limiter.on_success()
+        self.assertEqual(self.limiter.limit, 5)
+        for _ in range(30):
+            self.limiter.on_success()
+        self.assertEqual(self.limiter.limit, 8)
+
+    def test_acquire_waits_for_slot(self):
+        limiter = AIMDLimiter(maximum=1)
+        limiter.acquire()
+        started = threading.Event()
+
+        def second():
+            with limiter.slot():
+                started.set()
+
+        thread = threading.Thread(target=second)
+        thread.start()
+        self.assertFalse(started.wait(0.05))
+        limiter.release()
+        self.assertTrue(started.wait(5))
+        thread.join()
+
+    def test_set_bounds_applies_new_maximum(self):
+        self.limiter.on_overload()
+        self.limiter.set_bounds(16, 4)
+        self.assertEqual(self.limiter.limit, 16)
+        self.limiter.set_bounds(2, 4)
+        self.assertEqual((self.limiter.limit, self.limiter.minimum), (2, 2))
+
+
+class ConcurrencyLimitTests(unittest.TestCase):
+
+    def test_raising_limit_lets_waiter_in(self):
+        limit = ConcurrencyLimit(1)
+        limit.acquire()
+        started = threading.Event()
+
+        def second():
+            with limit.slot():
+                started.set()
+
+        thread = threading.Thread(target=second)
+        thread.start()
+        self.assertFalse(started.wait(0.05))
+        limit.set_limit(2)
+        self.assertTrue(started.wait(5))
+        thread.join()
+
+    def test_lowering_limit_waits_for_releases(self):
+        limit = ConcurrencyLimit(2)
+        limit.acquire()
+        limit.acquire()
+        limit.set_limit(1)
+        limit.release()
+        self.assertFalse(limit.acquire(timeout=0))
+        limit.release()
+        self.assertTrue(limit.acquire(timeout=0))
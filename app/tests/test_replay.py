@@ -0,0 +1,141 @@
+import base64
+import functools
+import os
+import tempfile
+import threading
+import unittest
+from os.path import join
+from unittest.mock import Mock, patch
+
+from sdc.crypto.encrypter import encrypt
+from sdc.crypto.key_store import KeyStore
+import yaml
+
+from app.anti_virus_check import SimulatedAntiVirusCheck
+from app.delivery import LocalDirectoryDelivery
+from app.main import SeftConsumer, KEY_PURPOSE_CONSUMER
+from app.metrics import Metrics
+from app.recorder import TrafficRecorder, read_records
+from app.replay import Replayer, load_records, parse_args
+from app.tests import TEST_FILES_PATH
+
+
+class RecorderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = join(tempfile.mkdtemp(), "traffic")
+
+    def test_round_trip(self):
+        recorder = TrafficRecorder(self.path)
+        recorder.record(b"first", {'tx_id': "1"}, received=10.0)
+        recorder.record(b"second", {'tx_id': "2"}, received=11.5)
+        recorder.close()
+
+        records = list(read_records(self.path))
+        self.assertEqual(records, [(10.0, {'tx_id': "1"}, b"first"), (11.5, {'tx_id': "2"}, b"second")])
+
+    def test_appends_to_existing_recording(self):
+        TrafficRecorder(self.path).record(b"first", {'tx_id': "1"})
+        TrafficRecorder(self.path).record(b"second", {'tx_id': "2"})
+        self.assertEqual([body for _, _, body in read_records(self.path)], [b"first", b"second"])
+
+    def test_sampling(self):
+        recorder = TrafficRecorder(self.path, sample_rate=0)
+        self.assertFalse(recorder.record(b"body", {}))
+        recorder.close()
+        self.assertEqual(list(read_records(self.path)), [])
+
+    def test_stops_at_max_bytes(self):
+        recorder = TrafficRecorder(self.path, max_bytes=32)
+        self.assertTrue(recorder.record(b"x" * 64, {}))
+        self.assertFalse(recorder.record(b"x" * 64, {}))
+
+    def test_truncated_record_ignored(self):
+        recorder = TrafficRecorder(self.path)
+        recorder.record(b"complete", {})
+        recorder.record(b"truncated", {})
+        recorder.close()
+        with open(self.path, 'r+b') as recording:
+            recording.truncate(os.path.getsize(self.path) - 3)
+        self.assertEqual([body for _, _, body in read_records(self.path)], [b"complete"])
+
+    def test_merges_recordings_by_time(self):
+        other = self.path + ".2"
+        TrafficRecorder(self.path).record(b"a", {}, received=1.0)
+        TrafficRecorder(other).record(b"b", {}, received=0.5)
+        self.assertEqual([body for _, _, body in load_records([self.path, other])], [b"b", b"a"])
+
+
+class MetricsTests(unittest.TestCase):
+
+    def test_timing_summary(self):
+        metrics = Metrics()
+        for value in range(1, 101):
+            metrics.observe("stage", value / 100)
+        metrics.increment("messages")
+        summary = metrics.snapshot()["timings"]["stage"]
+        self.assertEqual(summary["count"], 100)
+        self.assertEqual(summary["max"], 1.0)
+        self.assertAlmostEqual(summary["p50"], 0.51)
+        self.assertEqual(metrics.snapshot()["counters"]["messages"], 1)
+
+
+class ReplayTests(unittest.TestCase):
+
+    def setUp(self):
+        with open("./sdx_test_keys/keys.yml") as file:
+            self.sdx_keys = yaml.safe_load(file)
+        with open("./ras_test_keys/keys.yml") as file:
+            self.ras_key_store = KeyStore(yaml.safe_load(file))
+        self.path = join(tempfile.mkdtemp(), "traffic")
+        self.output = tempfile.mkdtemp()
+
+    def _record(self, recorder, file_name, received):
+        with open(join(TEST_FILES_PATH, file_name), "rb") as fb:
+            encoded_contents = base64.b64encode(fb.read())
+        payload = {"filename": file_name, "file": encoded_contents.decode(),
+                   "case_id": "601c4ee4-83ed-11e7-bb31-be2e44b06b34", "survey_id": "221"}
+        jwt = encrypt(payload, self.ras_key_store, KEY_PURPOSE_CONSUMER)
+        recorder.record(jwt.encode(), {'tx_id': file_name}, received=received)
+
+    @patch('app.settings.ANTI_VIRUS_ENABLED', True)
+    def test_replay_reports_stages(self):
+        recorder = TrafficRecorder(self.path)
+        self._record(recorder, "test1.xls", 100.0)
+        self._record(recorder, "test2.xlsx", 100.2)
+        recorder.record(b"not a jwt", {'tx_id': "bad"}, received=100.3)
+        recorder.close()
+
+        consumer = SeftConsumer(self.sdx_keys,
+                                delivery=LocalDirectoryDelivery(Mock(), self.output),
+                                anti_virus=functools.partial(SimulatedAntiVirusCheck, latency=0))
+        report = Replayer(consumer, speed=10).run(load_records([self.path]))
+
+        self.assertEqual(report["messages"], 3)
+        self.assertEqual(report["outcomes"], {"delivered": 2, "quarantined": 1})
+        for stage in ("stage.decrypt", "stage.extract", "stage.anti_virus", "stage.deliver"):
+            self.assertEqual(report["stages"][stage]["count"], 2 if stage != "stage.decrypt" else 3)
+        self.assertGreaterEqual(report["elapsed"], 0.03)
+        self.assertGreater(report["logging"]["calls_per_message"], 0)
+        self.assertTrue(os.path.exists(join(self.output, "221", "test2.xlsx")))
+
+    def test_replays_on_workers(self):
+        recorder = TrafficRecorder(self.path)
+        for i in range(8):
+            recorder.record(b"body", {'tx_id': str(i)}, received=100.0)
+        recorder.close()
+
+        # Each message waits for three others to be processed alongside it
+        barrier = threading.Barrier(4, timeout=5)
+        consumer = Mock()
+        consumer.process.side_effect = lambda body, tx_id: barrier.wait()
+        report = Replayer(consumer, speed=0, workers=4).run(load_records([self.path]))
+
+        self.assertEqual(report["outcomes"], {"delivered": 8})
+        self.assertEqual(report["workers"], 4)
+        self.assertFalse(barrier.broken)
+
+    def test_directory_delivery_needs_output(self):
+        with patch("sys.stderr"), self.assertRaises(SystemExit):
+            parse_args([self.path, "--delivery", "directory"])
+        self.assertEqual(parse_args([self.path, "--delivery", "directory", "--output", self.output]).output, self.output)
@@ -0,0 +1,91 @@
+import concurrent.futures
+import threading
+import time
+import unittest
+from unittest.mock import Mock
+
+from app.metrics import metrics
+from app.scheduler import Job, Lane, Scheduler
+
+
+def queue_job(lane, survey_id, done):
+    future = concurrent.futures.Future()
+    lane.put(Job(survey_id=survey_id, queued=time.monotonic(), fn=lambda: done.append(survey_id),
+                 args=(), future=future))
+    return future
+
+
+class LaneTests(unittest.TestCase):
+
+    def test_surveys_take_turns(self):
+        lane = Lane("small", workers=1)
+        done = []
+        # Queue everything before the lane starts so the order is decided by the lane alone
+        futures = [queue_job(lane, survey_id, done) for survey_id in ["009", "009", "009", "017", "023"]]
+        lane.start()
+        for future in futures:
+            future.result(timeout=5)
+        lane.stop()
+
+        self.assertEqual(done, ["009", "017", "023", "009", "009"])
+
+    def test_accepts(self):
+        self.assertTrue(Lane("small", 1, max_bytes=10).accepts(10))
+        self.assertFalse(Lane("small", 1, max_bytes=10).accepts(11))
+        self.assertTrue(Lane("large", 1).accepts(10 ** 9))
+
+
+class SchedulerTests(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.small = Lane("small", workers=2, max_bytes=100)
+        self.large = Lane("large", workers=1)
+        self.scheduler = Scheduler([self.small, self.large])
+
+    def tearDown(self):
+        self.scheduler.stop()
+
+    def test_routes_by_size(self):
+        lanes = []
+
+        def record():
+            lanes.append(threading.current_thread().name)
+
+        self.scheduler.submit("009", 50, record).result(timeout=5)
+        self.scheduler.submit("009", 500, record).result(timeout=5)
+        self.assertTrue(lanes[0].startswith("seft-small"))
+        self.assertTrue(lanes[1].startswith("seft-large"))
+
+    def test_small_files_not_blocked_by_large(self):
+        release = threading.Event()
+        large = self.scheduler.submit("009", 500, release.wait, 5)
+        small = self.scheduler.submit("017", 50, Mock(return_value="done"))
+        self.assertEqual(small.result(timeout=5), "done")
+        self.assertFalse(large.done())
+        release.set()
+        large.result(timeout=5)
+
+    def test_exceptions_propagate(self):
+        future = self.scheduler.submit("009", 50, Mock(side_effect=ValueError("bad")))
+        with self.assertRaises(ValueError):
+            future.result(timeout=5)
+
+    def test_wait_is_measured(self):
+        self.scheduler.submit("009", 50, Mock()).result(timeout=5)
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["timings"]["scheduler.small.wait"]["count"], 1)
+        self.assertEqual(snapshot["gauges"]["scheduler.small.queued"], 0)
+
+    def test_queued_and_running_jobs_in_flight(self):
+        release = threading.Event()
+        futures = [self.scheduler.submit("009", 500, release.wait, 5) for _ in range(2)]
+        self.assertEqual(metrics.snapshot()["gauges"]["scheduler.in_flight"], 2)
+        release.set()
+        for future in futures:
+            future.result(timeout=5)
+        # Done callbacks run just after result() returns
+        deadline = time.monotonic() + 5
+        while self.scheduler.in_flight and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(metrics.snapshot()["gauges"]["scheduler.in_flight"], 0)
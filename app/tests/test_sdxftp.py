@@ -0,0 +1,67 @@
+from ftplib import error_perm
+import unittest
+from unittest.mock import Mock, patch
+
+from app.sdxftp import SDXFTP
+
+
+@patch('app.sdxftp.FTP')
+class SDXFTPPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.ftp = SDXFTP(Mock(), "localhost", "user", "pass", pool_size=2)
+
+    def test_reuses_idle_connection(self, ftp_class):
+        self.ftp.deliver_binary("/009", "a.xlsx", b"a")
+        self.ftp.deliver_binary("/009", "b.xlsx", b"b")
+        self.assertEqual(ftp_class.call_count, 1)
+        ftp_class.return_value.voidcmd.assert_called_with("NOOP")
+
+    def test_dead_connection_replaced(self, ftp_class):
+        dead, fresh = Mock(), Mock()
+        dead.voidcmd.side_effect = EOFError
+        ftp_class.side_effect = [dead, fresh]
+
+        self.ftp.deliver_binary("/009", "a.xlsx", b"a")
+        self.ftp.deliver_binary("/009", "b.xlsx", b"b")
+        self.assertTrue(dead.close.called)
+        self.assertTrue(fresh.storbinary.called)
+
+    def test_failed_transfer_discards_connection(self, ftp_class):
+        ftp_class.return_value.storbinary.side_effect = IOError
+        with self.assertRaises(IOError):
+            self.ftp.deliver_binary("/009", "a.xlsx", b"a")
+        self.assertTrue(ftp_class.return_value.close.called)
+        self.assertEqual(self.ftp._idle, [])
+
+    def test_close_logs_out_of_idle_connections(self, ftp_class):
+        self.ftp.warm()
+        self.ftp.close()
+        self.assertTrue(ftp_class.return_value.quit.called)
+        self.assertEqual(self.ftp._idle, [])
+
+    def test_warmed_connection_used_by_first_delivery(self, ftp_class):
+        self.ftp.warm()
+        self.ftp.deliver_binary("/009", "a.xlsx", b"a")
+        self.assertEqual(ftp_class.call_count, 1)
+        ftp_class.return_value.voidcmd.assert_called_with("NOOP")
+
+    def test_warm_timeout(self, ftp_class):
+        ftp = SDXFTP(Mock(), "localhost", "user", "pass", timeout=60)
+        ftp.warm(timeout=5)
+        ftp_class.return_value.connect.assert_called_with("localhost", 21, timeout=5)
+
+    def test_failed_login_closes_connection(self, ftp_class):
+        ftp_class.return_value.login.side_effect = error_perm("530 Login incorrect")
+        with self.assertRaises(error_perm):
+            self.ftp.deliver_binary("/009", "a.xlsx", b"a")
+        self.assertTrue(ftp_class.return_value.close.called)
+
+    def test_resize_closes_surplus_idle_connections(self, ftp_class):
+        first, second = Mock(), Mock()
+        ftp_class.side_effect = [first, second]
+        self.ftp.warm()
+        self.ftp.warm()
+        self.ftp.resize(1)
+        self.assertEqual(self.ftp._idle, [first])
+        self.assertTrue(second.close.called)
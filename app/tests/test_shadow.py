@@ -0,0 +1,58 @@
+import base64
+import unittest
+from unittest.mock import MagicMock, Mock, patch
+
+from sdc.crypto.encrypter import encrypt
+from sdc.crypto.key_store import KeyStore
+import yaml
+
+from app import settings
+from app.anti_virus_check import SimulatedAntiVirusCheck
+from app.delivery import NullDelivery
+from app.main import SeftConsumer, KEY_PURPOSE_CONSUMER
+from app.quarantine import DiscardingQuarantinePublisher
+
+
+class ShadowModeTests(unittest.TestCase):
+
+    def setUp(self):
+        shadow_settings = patch.multiple(settings, SHADOW_ANTI_VIRUS_LATENCY=0, CHUNK_SPILL_DIR="/tmp/sdx-seft-chunks",
+                                         SHADOW_CHUNK_SPILL_DIR="/tmp/sdx-seft-shadow-chunks")
+        with open("./sdx_test_keys/keys.yml") as file, shadow_settings:
+            self.consumer = SeftConsumer(yaml.safe_load(file), shadow=True)
+        with open("./ras_test_keys/keys.yml") as file:
+            self.ras_key_store = KeyStore(yaml.safe_load(file))
+
+    def test_consumes_copy_of_production_queue(self):
+        consumer = self.consumer.consumer
+        consumer._channel = MagicMock()
+        consumer.setup_queue(consumer._queue)
+        consumer.on_queue_declareok(None)
+
+        self.assertEqual(consumer._channel.queue_declare.call_args[1]["queue"], settings.SHADOW_QUEUE)
+        self.assertIn("x-max-length", consumer._channel.queue_declare.call_args[1]["arguments"])
+        self.assertEqual(consumer._channel.queue_bind.call_args[1]["routing_key"], settings.RABBIT_QUEUE)
+
+    def test_chunks_kept_out_of_production_spill_directory(self):
+        for directory in ("/tmp/sdx-seft-chunks", "/tmp/sdx-seft-chunks/shadow"):
+            with patch.multiple(settings, CHUNK_SPILL_DIR="/tmp/sdx-seft-chunks", SHADOW_CHUNK_SPILL_DIR=directory):
+                with self.assertRaises(ValueError):
+                    SeftConsumer(None, shadow=True)
+
+    def test_no_side_effects(self):
+        self.assertIsInstance(self.consumer._ftp, NullDelivery)
+        self.assertIs(self.consumer._anti_virus.func, SimulatedAntiVirusCheck)
+        self.assertEqual(self.consumer.chunks.directory, "/tmp/sdx-seft-shadow-chunks")
+
+        on_confirmed, on_failed = Mock(), Mock()
+        self.assertIsInstance(self.consumer.publisher, DiscardingQuarantinePublisher)
+        self.consumer.publisher.quarantine(b"body", {"tx_id": "1"}, on_confirmed, on_failed)
+        self.assertTrue(on_confirmed.called)
+        self.assertFalse(on_failed.called)
+
+    @patch("app.sdxftp.SDXFTP.deliver_binary")
+    def test_processes_for_real_without_delivering(self, deliver_binary):
+        jwt = encrypt({"filename": "test1.xls", "case_id": "601c4ee4", "survey_id": "221",
+                       "file": base64.b64encode(b"contents").decode()}, self.ras_key_store, KEY_PURPOSE_CONSUMER)
+        self.consumer.process(jwt, tx_id="1")
+        self.assertFalse(deliver_binary.called)
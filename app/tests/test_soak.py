@@ -0,0 +1,382 @@
+"""Soak test: runs the consumer for a long time against local stand-ins that misbehave on a schedule.
+
+The consumer is the real SeftConsumer, with real decryption, A/V client and FTP pool. It is fed by
+an in-process stand-in for rabbit, scans against a fake OPSWAT server and delivers to pyftpdlib.
+Every `SOAK_FAULT_CYCLE` seconds the stand-ins go through the faults in FAULTS: 503 bursts, 404s as
+if OPSWAT had failed over to a server that doesn't know the scan, 403 quota errors, slow A/V
+responses, slow FTP transfers and dropped FTP control connections.
+
+Skipped unless SOAK_SECONDS is set. pytest keeps every log record of a test in memory, which would
+count as growth, so run it without the logging plugin:
+
+    SOAK_SECONDS=600 pytest -s -p no:logging app/tests/test_soak.py
+"""
+import base64
+import collections
+import http.server
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+import unittest
+import uuid
+from unittest.mock import patch
+
+from pika.spec import Basic, BasicProperties
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import DTPHandler, FTPHandler
+from pyftpdlib.servers import ThreadedFTPServer
+from sdc.crypto.encrypter import encrypt
+import tornado.ioloop
+import yaml
+
+from app import create_and_wrap_logger
+from app import settings
+from app.keys import ParsedKeyStore
+from app.main import SeftConsumer, KEY_PURPOSE_CONSUMER
+from app.sdxftp import SDXFTP
+from app.tests import TEST_FILES_PATH
+
+logger = create_and_wrap_logger(__name__)
+
+SOAK_SECONDS = float(os.getenv("SOAK_SECONDS", "0"))
+# Messages published a second
+SOAK_RATE = float(os.getenv("SOAK_RATE", "4"))
+SOAK_FAULT_CYCLE = float(os.getenv("SOAK_FAULT_CYCLE", "60"))
+# Messages settled a second over the whole run, faults included
+SOAK_MIN_THROUGHPUT = float(os.getenv("SOAK_MIN_THROUGHPUT", str(SOAK_RATE / 2)))
+# Seconds from publishing a message to it being settled, for 95% of messages
+SOAK_MAX_LATENCY = float(os.getenv("SOAK_MAX_LATENCY", "30"))
+# Bytes traced memory may grow by between the first and last third of the run
+SOAK_MAX_MEMORY_GROWTH = int(os.getenv("SOAK_MAX_MEMORY_GROWTH", str(64 * 1024 ** 2)))
+
+# (start, seconds, fault) within each fault cycle, scaled to SOAK_FAULT_CYCLE
+FAULTS = [
+    (5, 5, "anti_virus_503"),
+    (14, 3, "anti_virus_404"),
+    (20, 6, "ftp_slow"),
+    (29, 2, "ftp_drop"),
+    (35, 5, "anti_virus_403"),
+    (44, 6, "anti_virus_slow"),
+]
+SLOW_SECONDS = 0.5
+
+
+class FaultSchedule:
+    """Says which faults are active, going round FAULTS once every `cycle` seconds from `start`."""
+
+    def __init__(self, cycle, clock=time.monotonic):
+        self.cycle = cycle
+        self.clock = clock
+        self.started = clock()
+        self.injected = collections.Counter()
+        self._lock = threading.Lock()
+
+    def active(self, fault):
+        offset = (self.clock() - self.started) % self.cycle * 60 / self.cycle
+        if any(name == fault and start <= offset < start + seconds for start, seconds, name in FAULTS):
+            with self._lock:
+                self.injected[fault] += 1
+            return True
+        return False
+
+
+class FakeOpswatHandler(http.server.BaseHTTPRequestHandler):
+    """Scans take two polls; files named infected are blocked."""
+
+    protocol_version = "HTTP/1.1"
+    schedule = None
+    scans = {}
+    lock = threading.Lock()
+
+    def _fault(self, unknown_scan=False):
+        if self.schedule.active("anti_virus_slow"):
+            time.sleep(SLOW_SECONDS)
+        for fault, status in (("anti_virus_503", 503), ("anti_virus_403", 403)):
+            if self.schedule.active(fault):
+                return status
+        if unknown_scan and self.schedule.active("anti_virus_404"):
+            return 404
+        return None
+
+    def _respond(self, status, body=None):
+        data = json.dumps(body or {}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        status = self._fault()
+        if status:
+            return self._respond(status)
+        data_id = uuid.uuid4().hex
+        with self.lock:
+            self.scans[data_id] = [0, "infected" not in self.headers.get("filename", "")]
+        self._respond(200, {"data_id": data_id})
+
+    def do_GET(self):
+        data_id = self.path.rsplit("/", 1)[-1]
+        status = self._fault(unknown_scan=True)
+        with self.lock:
+            scan = self.scans.get(data_id)
+            if status == 404 and scan:
+                # The backup server has never heard of scans the primary took
+                del self.scans[data_id]
+        if status or scan is None:
+            return self._respond(status or 404)
+        scan[0] += 1
+        if scan[0] < 2:
+            return self._respond(200, {"process_info": {"progress_percentage": 50}})
+        self._respond(200, {"scan_results": {"scan_all_result_i": 0 if scan[1] else 1},
+                            "process_info": {"progress_percentage": 100,
+                                             "result": "Allowed" if scan[1] else "Blocked"}})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SlowDTPHandler(DTPHandler):
+    schedule = None
+
+    def handle_read(self):
+        if self.schedule.active("ftp_slow"):
+            time.sleep(SLOW_SECONDS / 10)
+        super().handle_read()
+
+    handle_read_event = handle_read
+
+
+class FaultyFTPHandler(FTPHandler):
+    schedule = None
+    received = None
+
+    def ftp_STOR(self, file, mode='w'):
+        if self.schedule.active("ftp_drop"):
+            self.close()
+            return
+        return super().ftp_STOR(file, mode)
+
+    def on_file_received(self, file):
+        self.received.append((os.path.basename(file), os.path.getsize(file)))
+
+
+class FakeChannel:
+    """The parts of a pika channel the consumer settles deliveries with."""
+
+    is_open = True
+
+    def __init__(self, broker):
+        self.broker = broker
+
+    def basic_ack(self, delivery_tag):
+        self.broker.settle(delivery_tag, "acked")
+
+    def basic_nack(self, delivery_tag, requeue=True):
+        self.broker.settle(delivery_tag, "requeued" if requeue else "dropped")
+
+    def basic_reject(self, delivery_tag, requeue=False):
+        self.broker.settle(delivery_tag, "requeued" if requeue else "quarantined")
+
+
+class FakeBroker:
+    """Stands in for rabbit: keeps a queue, delivers up to `prefetch` unacknowledged messages and requeues nacks.
+
+       Requeued messages go to the back of the queue and are redelivered flagged as such."""
+
+    def __init__(self, consumer, prefetch, clock=time.monotonic):
+        self.consumer = consumer
+        self.prefetch = prefetch
+        self.clock = clock
+        self.channel = FakeChannel(self)
+        self.queue = collections.deque()
+        self.unacked = {}
+        self.published = {}
+        self.settled = collections.defaultdict(list)
+        self.latencies = []
+        self.redeliveries = 0
+        self._tags = itertools.count(1)
+
+    def publish(self, tx_id, body):
+        self.published[tx_id] = self.clock()
+        self.queue.append((tx_id, body, False))
+        self.deliver()
+
+    def deliver(self):
+        while self.queue and len(self.unacked) < self.prefetch:
+            tx_id, body, redelivered = self.queue.popleft()
+            tag = next(self._tags)
+            self.unacked[tag] = (tx_id, body)
+            self.redeliveries += redelivered
+            self.consumer.on_message(self.channel, Basic.Deliver(delivery_tag=tag, redelivered=redelivered),
+                                     BasicProperties(headers={"tx_id": tx_id}), body)
+
+    def settle(self, delivery_tag, outcome):
+        tx_id, body = self.unacked.pop(delivery_tag)
+        if outcome == "requeued":
+            self.queue.append((tx_id, body, True))
+        else:
+            self.settled[tx_id].append(outcome)
+            self.latencies.append(self.clock() - self.published[tx_id])
+        tornado.ioloop.IOLoop.current().add_callback(self.deliver)
+
+    @property
+    def idle(self):
+        return not self.queue and not self.unacked
+
+
+class ConfirmingQuarantinePublisher:
+    """Confirms every quarantine straight away, as a broker that is keeping up would."""
+
+    pending = 0
+
+    def open(self, connection):
+        pass
+
+    def close(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def quarantine(self, body, headers, on_confirmed, on_failed):
+        on_confirmed()
+
+
+class FakeConnection:
+
+    def __init__(self):
+        self.ioloop = tornado.ioloop.IOLoop.current()
+
+
+@unittest.skipIf(not SOAK_SECONDS, "Soak test, set SOAK_SECONDS to run")
+class SoakTest(unittest.TestCase):
+
+    def setUp(self):
+        self.schedule = FaultSchedule(SOAK_FAULT_CYCLE)
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, "221"))
+        self.received = []
+
+        handlers = {"schedule": self.schedule}
+        FakeOpswatHandler.schedule = self.schedule
+        self.opswat = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakeOpswatHandler)
+        threading.Thread(target=self.opswat.serve_forever, daemon=True).start()
+
+        authorizer = DummyAuthorizer()
+        authorizer.add_user("ons", "ons", self.root, perm="elradfmw")
+        dtp_handler = type("SoakDTPHandler", (SlowDTPHandler,), handlers)
+        ftp_handler = type("SoakFTPHandler", (FaultyFTPHandler,),
+                           dict(handlers, authorizer=authorizer, dtp_handler=dtp_handler, received=self.received))
+        self.ftp = ThreadedFTPServer(("127.0.0.1", 0), ftp_handler)
+        threading.Thread(target=self.ftp.serve_forever, daemon=True).start()
+
+        self.settings = patch.multiple(settings,
+                                       ANTI_VIRUS_ENABLED=True,
+                                       ANTI_VIRUS_BASE_URL="http://127.0.0.1:{}/file".format(self.opswat.server_port),
+                                       ANTI_VIRUS_API_KEY=None,
+                                       ANTI_VIRUS_WAIT_TIME=0.1,
+                                       CONSUMER_WORKERS=4,
+                                       RABBIT_PREFETCH_COUNT=8)
+        self.settings.start()
+
+        with open("./sdx_test_keys/keys.yml") as file:
+            sdx_keys = yaml.safe_load(file)
+        with open("./ras_test_keys/keys.yml") as file:
+            # Parsed once, so publishing keeps up with the rate
+            self.ras_key_store = ParsedKeyStore(yaml.safe_load(file))
+        delivery = SDXFTP(logger, "127.0.0.1", "ons", "ons", self.ftp.address[1], pool_size=2, timeout=10)
+        self.seft_consumer = SeftConsumer(sdx_keys, delivery=delivery)
+        self.consumer = self.seft_consumer.consumer
+        self.consumer.quarantine_publisher = ConfirmingQuarantinePublisher()
+
+        self.files = {}
+        for name in sorted(os.listdir(TEST_FILES_PATH)):
+            with open(os.path.join(TEST_FILES_PATH, name), "rb") as file:
+                self.files[name] = file.read()
+
+    def tearDown(self):
+        self.settings.stop()
+        self.opswat.shutdown()
+        self.ftp.close_all()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def _message(self, number):
+        name = sorted(self.files)[number % len(self.files)]
+        file_name = "soak-{}-{}".format(number, name)
+        jwt = encrypt({"filename": file_name, "case_id": "601c4ee4-83ed-11e7-bb31-be2e44b06b34", "survey_id": "221",
+                       "file": base64.b64encode(self.files[name]).decode()}, self.ras_key_store, KEY_PURPOSE_CONSUMER)
+        return file_name, len(self.files[name]), jwt.encode()
+
+    def test_soak(self):
+        loop = tornado.ioloop.IOLoop.current()
+        self.consumer._connection = FakeConnection()
+        broker = FakeBroker(self.consumer, self.consumer.prefetch_count)
+        self.consumer._channel = broker.channel
+
+        expected = {}
+        memory = []
+        numbers = itertools.count()
+        started = time.monotonic()
+        tracemalloc.start()
+
+        def publish():
+            if time.monotonic() - started >= SOAK_SECONDS:
+                publisher.stop()
+                return
+            number = next(numbers)
+            file_name, size, body = self._message(number)
+            expected[str(number)] = (file_name, size)
+            broker.publish(str(number), body)
+
+        def sample():
+            memory.append(tracemalloc.get_traced_memory()[0])
+            running = time.monotonic() - started
+            # Give the last messages published as long as any should take to be settled
+            if running >= SOAK_SECONDS and (broker.idle or running > SOAK_SECONDS + SOAK_MAX_LATENCY * 2):
+                loop.stop()
+
+        publisher = tornado.ioloop.PeriodicCallback(publish, 1000 / SOAK_RATE)
+        sampler = tornado.ioloop.PeriodicCallback(sample, 1000)
+        publisher.start()
+        sampler.start()
+        loop.start()
+        sampler.stop()
+        tracemalloc.stop()
+        elapsed = time.monotonic() - started
+
+        latencies = sorted(broker.latencies)
+        p95 = latencies[int(len(latencies) * 0.95)] if latencies else None
+        third = max(1, len(memory) // 3)
+        growth = max(memory[-third:]) - max(memory[:third])
+        delivered = collections.Counter(name for name, size in self.received)
+        report = {"published": len(expected), "settled": len(broker.settled), "unsettled": len(broker.unacked),
+                  "queued": len(broker.queue), "redeliveries": broker.redeliveries,
+                  "throughput": round(len(broker.settled) / elapsed, 2), "p95_latency": p95,
+                  "memory_growth": growth, "faults": dict(self.schedule.injected)}
+        logger.info("Soak test finished", **report)
+
+        self.assertTrue(broker.idle, "Messages lost or stuck: {}".format(report))
+        for tx_id, (file_name, size) in expected.items():
+            outcomes = broker.settled[tx_id]
+            if "infected" in file_name:
+                self.assertEqual(outcomes, ["quarantined"], file_name)
+                self.assertNotIn(file_name, delivered)
+            else:
+                self.assertEqual(outcomes, ["acked"], file_name)
+                self.assertEqual(delivered[file_name], 1, "{} delivered {} times".format(file_name, delivered[file_name]))
+        self.assertTrue(all(size == dict(expected.values())[name] for name, size in self.received))
+        self.assertGreaterEqual(report["throughput"], SOAK_MIN_THROUGHPUT, report)
+        self.assertLessEqual(p95, SOAK_MAX_LATENCY, report)
+        self.assertLessEqual(growth, SOAK_MAX_MEMORY_GROWTH, report)
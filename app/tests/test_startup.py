@@ -0,0 +1,72 @@
+import threading
+from unittest.mock import Mock
+
+from tornado import testing
+
+from app import startup
+from app.startup import Startup
+
+
+class StartupTests(testing.AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        startup.status = startup.StartupStatus()
+        self.on_ready = Mock()
+        self.on_failed = Mock()
+
+    @testing.gen_test
+    def test_tasks_run_at_the_same_time(self):
+        barrier = threading.Barrier(3, timeout=5)
+        tasks = {name: barrier.wait for name in ("keys", "ftp_0", "anti_virus")}
+        run = Startup(tasks, self.on_ready, self.on_failed, required=("keys",))
+        yield run.run()
+        yield run.background
+
+        self.assertTrue(self.on_ready.called)
+        self.assertTrue(startup.status.ready)
+        self.assertEqual(set(run.timings), {"keys", "ftp_0", "anti_virus", "total"})
+
+    @testing.gen_test
+    def test_optional_task_failure_still_ready(self):
+        run = Startup({"keys": Mock(), "anti_virus": Mock(side_effect=IOError)},
+                      self.on_ready, self.on_failed, required=("keys",))
+        with self.assertLogs(level="WARNING") as logs:
+            yield run.run()
+            with self.assertRaises(IOError):
+                yield run.background
+        self.assertTrue(self.on_ready.called)
+        self.assertFalse(self.on_failed.called)
+        self.assertIn("Startup task failed, carrying on", logs.output[0])
+
+    @testing.gen_test
+    def test_ready_without_waiting_for_optional_tasks(self):
+        warmed = threading.Event()
+        run = Startup({"keys": Mock(), "ftp_0": lambda: warmed.wait(5)},
+                      self.on_ready, self.on_failed, required=("keys",))
+        yield run.run()
+        self.assertTrue(self.on_ready.called)
+        self.assertNotIn("ftp_0", run.timings)
+
+        warmed.set()
+        yield run.background
+        self.assertIn("ftp_0", run.timings)
+
+    @testing.gen_test
+    def test_required_task_failure_fails(self):
+        error = ValueError("bad keys")
+        run = Startup({"keys": Mock(side_effect=error), "ftp_0": Mock()},
+                      self.on_ready, self.on_failed, required=("keys",))
+        yield run.run()
+        self.on_failed.assert_called_with(error)
+        self.assertFalse(self.on_ready.called)
+        self.assertFalse(startup.status.ready)
+
+    @testing.gen_test
+    def test_mark_records_time_since_start(self):
+        clock = Mock(side_effect=[10.0, 10.0, 10.5, 12.0, 13.0])
+        run = Startup({"keys": Mock()}, self.on_ready, self.on_failed, required=("keys",), clock=clock)
+        yield run.run()
+        run.mark("rabbit")
+        run.mark("rabbit")
+        self.assertEqual(run.timings, {"keys": 0.5, "total": 2.0, "rabbit": 3.0})
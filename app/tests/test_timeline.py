@@ -0,0 +1,67 @@
+import json
+import unittest
+from unittest.mock import patch
+
+from sdc.rabbit.exceptions import QuarantinableError
+from tornado import testing
+
+from app.deadline import DeadlineExceeded
+from app.main import make_app
+from app.metrics import metrics
+from app.timeline import Timeline, TimelineBuffer
+
+
+def finished(tx_id, duration, buffer, error=None):
+    timeline = Timeline(tx_id)
+    with timeline.stage("decrypt"):
+        pass
+    timeline.finish(error, buffer=buffer)
+    timeline.duration = duration
+    return timeline
+
+
+class TimelineTests(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.buffer = TimelineBuffer(3)
+
+    def test_stages_feed_metrics(self):
+        timeline = finished("1", 1.0, self.buffer)
+        self.assertEqual(timeline.as_dict()["stages"][0]["stage"], "decrypt")
+        self.assertEqual(metrics.snapshot()["timings"]["stage.decrypt"]["count"], 1)
+
+    def test_outcomes(self):
+        self.assertEqual(finished("1", 1, self.buffer).outcome, "delivered")
+        self.assertEqual(finished("2", 1, self.buffer, QuarantinableError()).outcome, "quarantined")
+        self.assertEqual(finished("3", 1, self.buffer, DeadlineExceeded()).outcome, "deadline_exceeded")
+        self.assertEqual(finished("4", 1, self.buffer, ValueError()).outcome, "error")
+
+    def test_buffer_keeps_most_recent(self):
+        for tx_id, duration in [("1", 5), ("2", 1), ("3", 3), ("4", 2)]:
+            finished(tx_id, duration, self.buffer)
+        self.assertEqual([t.tx_id for t in self.buffer.recent(2)], ["4", "3"])
+        self.assertEqual([t.tx_id for t in self.buffer.slowest(2)], ["3", "4"])
+        self.assertEqual(self.buffer.find("1"), [])
+
+
+class TimelineHandlerTests(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        return make_app()
+
+    def test_returns_recent_and_slowest(self):
+        buffer = TimelineBuffer(10)
+        for tx_id, duration in [("1", 5), ("2", 1), ("3", 3)]:
+            finished(tx_id, duration, buffer)
+
+        with patch('app.timeline.timelines', buffer):
+            response = json.loads(self.fetch("/debug/timelines?limit=1").body)
+            found = json.loads(self.fetch("/debug/timelines?tx_id=2").body)
+
+        self.assertEqual([t["tx_id"] for t in response["recent"]], ["3"])
+        self.assertEqual([t["tx_id"] for t in response["slowest"]], ["1"])
+        self.assertEqual(found["timelines"][0]["duration"], 1)
+
+    def test_bad_limit(self):
+        self.assertEqual(self.fetch("/debug/timelines?limit=many").code, 400)
@@ -0,0 +1,66 @@
+import json
+import unittest
+from unittest.mock import Mock, patch
+
+from tornado import testing
+
+from app import settings, tuning
+from app.main import make_app
+
+
+class TuningTests(unittest.TestCase):
+
+    def setUp(self):
+        for name, value in tuning.values().items():
+            self.addCleanup(setattr, settings, name, value)
+        listeners = patch.object(tuning, "_listeners", tuning.collections.defaultdict(list))
+        listeners.start()
+        self.addCleanup(listeners.stop)
+
+    def test_apply_sets_and_tells_listeners(self):
+        listener = Mock()
+        tuning.listen("CONSUMER_WORKERS", listener)
+        values = tuning.apply({"CONSUMER_WORKERS": "8", "ANTI_VIRUS_WAIT_TIME": 0.5})
+        listener.assert_called_with(8)
+        self.assertEqual(settings.CONSUMER_WORKERS, 8)
+        self.assertEqual(values["ANTI_VIRUS_WAIT_TIME"], 0.5)
+
+    def test_invalid_changes_apply_nothing(self):
+        workers = settings.CONSUMER_WORKERS
+        for changes in ({"CONSUMER_WORKERS": 8, "FTP_HOST": "elsewhere"}, {"CONSUMER_WORKERS": 0},
+                        {"CONSUMER_WORKERS": "many"}, [], {}):
+            with self.assertRaises(ValueError):
+                tuning.apply(changes)
+        self.assertEqual(settings.CONSUMER_WORKERS, workers)
+
+
+class SettingsHandlerTests(testing.AsyncHTTPTestCase):
+
+    def setUp(self):
+        token = patch.object(settings, "ADMIN_TOKEN", "secret")
+        token.start()
+        self.addCleanup(token.stop)
+        for name, value in tuning.values().items():
+            self.addCleanup(setattr, settings, name, value)
+        super().setUp()
+
+    def get_app(self):
+        return make_app()
+
+    def _fetch(self, method="GET", body=None, token="secret"):
+        return self.fetch("/admin/settings?scope=process", method=method, body=body,
+                          headers={"Authorization": "Bearer " + token})
+
+    def test_get(self):
+        response = self._fetch()
+        self.assertEqual(json.loads(response.body)["settings"]["FTP_POOL_SIZE"], settings.FTP_POOL_SIZE)
+
+    def test_post_changes_setting(self):
+        response = self._fetch("POST", json.dumps({"ANTI_VIRUS_MAX_ATTEMPTS": 3}))
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body)["processes"][0]["settings"]["ANTI_VIRUS_MAX_ATTEMPTS"], 3)
+        self.assertEqual(settings.ANTI_VIRUS_MAX_ATTEMPTS, 3)
+
+    def test_post_rejects_unknown_setting(self):
+        self.assertEqual(self._fetch("POST", json.dumps({"ADMIN_TOKEN": "mine"})).code, 400)
+        self.assertEqual(self._fetch("POST", "{}", token="guess").code, 403)
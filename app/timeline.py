@@ -0,0 +1,136 @@
+import collections
+import contextlib
+import threading
+import time
+
+from sdc.rabbit.exceptions import BadMessageError, QuarantinableError, RetryableError
+from tornado.web import RequestHandler
+
+from app import settings
+from app.deadline import DeadlineExceeded
+from app.metrics import metrics
+
+
+class Timeline:
+    """When each stage of processing one message started and ended, plus a few facts about it.
+
+       Stages are also observed as `stage.<name>` metrics, so timing a stage once feeds both.
+       A timeline is only used by one thread at a time, as a message moves between threads but
+       is never processed on two at once."""
+
+    def __init__(self, tx_id, **info):
+        self.tx_id = tx_id
+        self.started = time.time()
+        self.duration = None
+        self.outcome = None
+        self.info = info
+        self.stages = []
+        self._start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.stages.append((name, start - self._start, end - self._start))
+            metrics.observe("stage." + name, end - start)
+
+    def note(self, **info):
+        self.info.update(info)
+
+    def finish(self, error=None, buffer=None):
+        """Records how processing ended and adds the timeline to `buffer` (the process's ring buffer by default)."""
+        self.duration = time.perf_counter() - self._start
+        metrics.observe("messages.duration", self.duration)
+        if error is None:
+            self.outcome = "delivered"
+        elif isinstance(error, (QuarantinableError, BadMessageError)):
+            self.outcome = "quarantined"
+        elif isinstance(error, DeadlineExceeded):
+            self.outcome = "deadline_exceeded"
+        elif isinstance(error, RetryableError):
+            self.outcome = "retry"
+        else:
+            self.outcome = "error"
+        (buffer or timelines).add(self)
+
+    def as_dict(self):
+        return {
+            "tx_id": str(self.tx_id),
+            "started": self.started,
+            "duration": round(self.duration, 6) if self.duration is not None else None,
+            "outcome": self.outcome,
+            "info": self.info,
+            "stages": [{"stage": name, "start": round(start, 6), "end": round(end, 6)}
+                       for name, start, end in self.stages],
+        }
+
+
+class NullTimeline(Timeline):
+    """Records nothing, for callers outside of message processing."""
+
+    def __init__(self):
+        super().__init__(None)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        yield
+
+    def note(self, **info):
+        pass
+
+    def finish(self, error=None, buffer=None):
+        pass
+
+
+NO_TIMELINE = NullTimeline()
+
+
+class TimelineBuffer:
+    """The last `size` finished timelines."""
+
+    def __init__(self, size):
+        self._timelines = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, timeline):
+        with self._lock:
+            self._timelines.append(timeline)
+
+    def recent(self, limit):
+        with self._lock:
+            return list(self._timelines)[-limit:][::-1] if limit > 0 else []
+
+    def slowest(self, limit):
+        with self._lock:
+            return sorted(self._timelines, key=lambda timeline: timeline.duration, reverse=True)[:limit]
+
+    def find(self, tx_id):
+        with self._lock:
+            return [timeline for timeline in self._timelines if str(timeline.tx_id) == tx_id]
+
+
+timelines = TimelineBuffer(settings.TIMELINE_BUFFER_SIZE)
+
+
+class TimelineHandler(RequestHandler):
+    """Returns the most recent and slowest timelines held by the process that handles the request,
+       or those for one message with `?tx_id=`."""
+
+    def get(self):
+        tx_id = self.get_query_argument("tx_id", None)
+        if tx_id is not None:
+            self.write({"timelines": [timeline.as_dict() for timeline in timelines.find(tx_id)]})
+            return
+        try:
+            limit = int(self.get_query_argument("limit", "20"))
+        except ValueError:
+            self.set_status(400)
+            self.write({"error": "limit must be a number"})
+            return
+        self.write({
+            "recent": [timeline.as_dict() for timeline in timelines.recent(limit)],
+            "slowest": [timeline.as_dict() for timeline in timelines.slowest(limit)],
+        })
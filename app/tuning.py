@@ -0,0 +1,70 @@
+"""Settings that can be changed on a running process, through `/admin/settings`.
+
+Each is an attribute of `app.settings`, so code that reads it as `settings.NAME` when it needs it
+sees the new value straight away. Anything sized from a setting when it was built, like a pool of
+workers or connections, registers a listener with `listen` to be resized when it changes.
+Listeners are called on the io loop. Changes only last as long as the process.
+"""
+import collections
+
+from app import create_and_wrap_logger
+from app import settings
+
+logger = create_and_wrap_logger(__name__)
+
+Tunable = collections.namedtuple('Tunable', 'type minimum')
+
+TUNABLES = {
+    "CONSUMER_WORKERS": Tunable(int, 1),
+    "RABBIT_PREFETCH_COUNT": Tunable(int, 1),
+    "ANTI_VIRUS_MAX_IN_FLIGHT": Tunable(int, 1),
+    "ANTI_VIRUS_MIN_IN_FLIGHT": Tunable(int, 1),
+    "ANTI_VIRUS_RATE_LIMIT": Tunable(float, 0),
+    "ANTI_VIRUS_WAIT_TIME": Tunable(float, 0),
+    "ANTI_VIRUS_MAX_ATTEMPTS": Tunable(int, 0),
+    "FTP_POOL_SIZE": Tunable(int, 1),
+    "MESSAGE_DEADLINE": Tunable(float, 0),
+    "SEFT_CONSUMER_HEALTHCHECK_DELAY": Tunable(int, 1),
+}
+
+_listeners = collections.defaultdict(list)
+
+
+def listen(name, callback):
+    """Calls `callback` with the new value whenever setting `name` is changed."""
+    _listeners[name].append(callback)
+
+
+def values():
+    return {name: getattr(settings, name) for name in TUNABLES}
+
+
+def validate(changes):
+    """Returns `changes` converted to each setting's type, raising ValueError if any can't be applied."""
+    if not isinstance(changes, dict) or not changes:
+        raise ValueError("expected an object of settings to change")
+    converted = {}
+    for name, value in changes.items():
+        tunable = TUNABLES.get(name)
+        if tunable is None:
+            raise ValueError("{} can't be changed at runtime".format(name))
+        try:
+            converted[name] = tunable.type(value)
+        except (TypeError, ValueError):
+            raise ValueError("{} must be a number".format(name))
+        if converted[name] < tunable.minimum:
+            raise ValueError("{} must be at least {}".format(name, tunable.minimum))
+    return converted
+
+
+def apply(changes):
+    """Validates and applies `changes` together, then tells the listeners. Returns the settings after."""
+    changes = validate(changes)
+    previous = {name: getattr(settings, name) for name in changes}
+    for name, value in changes.items():
+        setattr(settings, name, value)
+    for name, value in changes.items():
+        logger.warning("Setting changed at runtime", setting=name, previous=previous[name], value=value)
+        for callback in _listeners[name]:
+            callback(value)
+    return values()
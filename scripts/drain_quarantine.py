@@ -0,0 +1,262 @@
+"""Drains the quarantine queue in bulk, decrypting every selected message to disk.
+
+Files are written to <output>/<survey_id>/<case_id>/<filename>, and each chunk of a file sent in
+several messages to <output>/<survey_id>/<case_id>/<file_digest>/<chunk_index>. Every message seen is
+recorded in <output>/index.jsonl. Messages already written by an earlier (possibly interrupted)
+run are found in the index and are not decrypted again.
+
+Messages that are not selected, fail to decrypt, or are kept with --keep are moved to the
+back of the quarantine queue, and the run stops once it comes back round to them.
+
+    python -m scripts.drain_quarantine --output /tmp/quarantine --survey-id 221 --workers 8
+"""
+import argparse
+import base64
+import concurrent.futures
+import json
+import os
+import shutil
+import time
+import uuid
+
+from sdc.crypto.decrypter import decrypt
+
+from app import create_and_wrap_logger
+from app import settings
+from app.chunks import DIGEST, ChunkStore
+from app.keys import load_key_store
+from app.main import KEY_PURPOSE_CONSUMER
+from app.main import SeftConsumer
+from scripts.quarantine import add_common_arguments, filter_from_args, open_channel, return_to_queue, seen_this_run
+
+logger = create_and_wrap_logger(__name__)
+
+INDEX_FILE = "index.jsonl"
+
+_key_store = None
+
+
+def _init_worker(keys_file):
+    # Parsed once here, rather than from the PEM on every decrypt
+    global _key_store
+    _key_store = load_key_store(keys_file, KEY_PURPOSE_CONSUMER)
+
+
+def decrypt_to_file(body, tx_id, output_dir, survey_ids):
+    """Runs in a worker process; only the file's location comes back, never its contents."""
+    decrypted_message = decrypt(body.decode("utf-8"), _key_store, KEY_PURPOSE_CONSUMER)
+    if 'chunk_count' in decrypted_message:
+        return _chunk_to_file(decrypted_message, output_dir, survey_ids)
+
+    payload = SeftConsumer.extract_file(decrypted_message, tx_id)
+    try:
+        result = {"survey_id": payload.survey_id, "case_id": payload.case_id, "file_name": payload.file_name}
+        if survey_ids and payload.survey_id not in survey_ids:
+            result["status"] = "skipped"
+            return result
+
+        path = os.path.join(_folder(output_dir, payload.survey_id, payload.case_id), os.path.basename(payload.file_name))
+        with open(path, 'wb') as recovered_file, payload.contents() as contents:
+            if hasattr(contents, "read"):
+                shutil.copyfileobj(contents, recovered_file)
+            else:
+                recovered_file.write(contents)
+        result.update(status="written", path=path)
+        return result
+    finally:
+        # Files decompressed to disk rather than memory are left in a spill file of their own
+        if payload.temporary:
+            ChunkStore.discard(payload.spill_path)
+
+
+def _chunk_to_file(claims, output_dir, survey_ids):
+    """Writes one chunk of a file as it was sent, to <file_digest>/<chunk_index> in the case's folder.
+
+    The chunks of a file may be anywhere on the queue, so they are kept apart for the whole file to
+    be put back together (and decompressed, if it has a content_encoding) once they have all been written.
+    """
+    try:
+        survey_id, case_id, file_name = claims['survey_id'], claims['case_id'], claims['filename']
+        digest, index, count = claims['file_digest'], int(claims['chunk_index']), int(claims['chunk_count'])
+        contents = base64.b64decode(claims['file'])
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError("Unusable chunk: {!r}".format(e))
+    if not isinstance(digest, str) or not DIGEST.match(digest) or not 0 <= index < count:
+        raise ValueError("Unusable chunk: file_digest {!r}, chunk {} of {}".format(digest, index, count))
+    result = {"survey_id": survey_id, "case_id": case_id, "file_name": file_name,
+              "file_digest": digest, "chunk_index": index, "chunk_count": count,
+              "content_encoding": claims.get('content_encoding')}
+    if survey_ids and survey_id not in survey_ids:
+        result["status"] = "skipped"
+        return result
+
+    folder = os.path.join(_folder(output_dir, survey_id, case_id), digest)
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, str(index))
+    with open(path, 'wb') as chunk_file:
+        chunk_file.write(contents)
+    result.update(status="written", path=path)
+    return result
+
+
+def _folder(output_dir, survey_id, case_id):
+    # The claims come from outside, so don't let them walk out of the output tree
+    folder = os.path.join(output_dir, os.path.basename(str(survey_id)), os.path.basename(str(case_id)))
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+class Index:
+    """Append-only record of every message handled, doubling as the checkpoint for resumed runs."""
+
+    def __init__(self, output_dir):
+        self.path = os.path.join(output_dir, INDEX_FILE)
+        self.written = set()
+        if os.path.exists(self.path):
+            with open(self.path) as index_file:
+                for line in index_file:
+                    entry = json.loads(line)
+                    if entry.get("status") == "written":
+                        self.written.add(entry["tx_id"])
+        self._file = open(self.path, 'a')
+
+    def record(self, tx_id, properties, **fields):
+        entry = {"tx_id": tx_id, "timestamp": properties.timestamp, "headers": properties.headers}
+        entry.update(fields)
+        self._file.write(json.dumps(entry, default=str) + "\n")
+        self._file.flush()
+        if fields.get("status") == "written":
+            self.written.add(tx_id)
+
+    def close(self):
+        self._file.close()
+
+
+class Drain:
+
+    def __init__(self, args):
+        self.args = args
+        self.run_id = str(uuid.uuid4())
+        self.header_filter = filter_from_args(args)
+        self.survey_ids = set(args.survey_ids or [])
+        self.index = Index(args.output)
+        self.pending = {}
+        self.counts = {"written": 0, "skipped": 0, "failed": 0, "indexed": 0, "returned": 0}
+        self.started = time.monotonic()
+        self.last_report = self.started
+        self.connection, self.channel = open_channel(args.url, args.prefetch)
+
+    def run(self):
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.args.workers,
+                                                    initializer=_init_worker,
+                                                    initargs=(self.args.keys_file,)) as pool:
+            for method, properties, body in self.channel.consume(self.args.queue,
+                                                                 inactivity_timeout=self.args.idle_timeout):
+                self._settle_done()
+                if method is None:
+                    if not self.pending:
+                        logger.info("Quarantine queue idle, finishing")
+                        break
+                    self._settle_done(wait=True)
+                    continue
+
+                if seen_this_run(properties, self.run_id):
+                    logger.info("Reached messages already returned by this run, finishing")
+                    self.channel.basic_nack(method.delivery_tag, requeue=True)
+                    break
+
+                self._handle(pool, method, properties, body)
+                if len(self.pending) >= self.args.prefetch:
+                    self._settle_done(wait=True)
+
+            while self.pending:
+                self._settle_done(wait=True)
+
+        self.channel.cancel()
+        self.connection.close()
+        self.index.close()
+        self._report(final=True)
+
+    def _handle(self, pool, method, properties, body):
+        tx_id = (properties.headers or {}).get('tx_id')
+        if not self.header_filter.matches(properties):
+            self._return(method, properties, body)
+        elif self.args.dry_run:
+            self.index.record(tx_id, properties, status="indexed", size=len(body))
+            self.counts["indexed"] += 1
+            self._return(method, properties, body)
+        elif tx_id in self.index.written:
+            logger.info("Already written by an earlier run", tx_id=tx_id)
+            self._finish(method, properties, body)
+        else:
+            future = pool.submit(decrypt_to_file, body, tx_id, self.args.output, self.survey_ids)
+            self.pending[future] = (method, properties, body)
+
+    def _settle_done(self, wait=False):
+        if not self.pending:
+            return
+        if wait:
+            done, _ = concurrent.futures.wait(self.pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        else:
+            done = [future for future in self.pending if future.done()]
+
+        for future in done:
+            method, properties, body = self.pending.pop(future)
+            tx_id = (properties.headers or {}).get('tx_id')
+            try:
+                result = future.result()
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error("Unable to decrypt message", tx_id=tx_id, exception=repr(e))
+                self.index.record(tx_id, properties, status="failed", error=repr(e))
+                self.counts["failed"] += 1
+                self._return(method, properties, body)
+                continue
+
+            self.index.record(tx_id, properties, **result)
+            self.counts[result["status"]] += 1
+            if result["status"] == "written":
+                self._finish(method, properties, body)
+            else:
+                self._return(method, properties, body)
+        self._report()
+
+    def _finish(self, method, properties, body):
+        if self.args.keep:
+            self._return(method, properties, body)
+        else:
+            self.channel.basic_ack(method.delivery_tag)
+
+    def _return(self, method, properties, body):
+        return_to_queue(self.channel, self.args.queue, method, properties, body, self.run_id)
+        self.counts["returned"] += 1
+
+    def _report(self, final=False):
+        now = time.monotonic()
+        if not final and now - self.last_report < 5:
+            return
+        self.last_report = now
+        handled = sum(self.counts[status] for status in ("written", "skipped", "failed", "indexed"))
+        logger.info("Quarantine drain finished" if final else "Quarantine drain progress",
+                    rate=round(handled / max(now - self.started, 0.001), 1), in_flight=len(self.pending), **self.counts)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Drain and decrypt the SEFT quarantine queue in bulk")
+    add_common_arguments(parser)
+    parser.add_argument('--output', required=True, help="directory to write recovered files and the index to")
+    parser.add_argument('--keys-file', default=settings.SDX_SEFT_CONSUMER_KEYS_FILE)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="number of decrypt processes")
+    parser.add_argument('--survey-id', action='append', dest='survey_ids', help="only write this survey (repeatable)")
+    parser.add_argument('--dry-run', action='store_true', help="only index the headers, nothing is decrypted")
+    parser.add_argument('--keep', action='store_true', help="leave written messages on the quarantine queue")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    os.makedirs(args.output, exist_ok=True)
+    Drain(args).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Helpers shared by the bulk quarantine scripts."""
+from datetime import datetime
+
+import pika
+
+from app import settings
+
+# Set on messages a script has put back on the quarantine queue, so a run can tell when
+# it has been all the way round the queue and stop instead of looping forever.
+RUN_HEADER = 'x-quarantine-run'
+
+
+class HeaderFilter:
+    """Selects quarantined messages by their headers, without decrypting them."""
+
+    def __init__(self, tx_ids=None, since=None, until=None):
+        self.tx_ids = set(tx_ids) if tx_ids else None
+        self.since = since
+        self.until = until
+
+    def matches(self, properties):
+        headers = properties.headers or {}
+        if self.tx_ids is not None and headers.get('tx_id') not in self.tx_ids:
+            return False
+        if self.since is not None or self.until is not None:
+            # Messages quarantined before timestamps were recorded can't be placed in a time range
+            if properties.timestamp is None:
+                return False
+            if self.since is not None and properties.timestamp < self.since:
+                return False
+            if self.until is not None and properties.timestamp > self.until:
+                return False
+        return True
+
+
+def _timestamp(value):
+    return int(datetime.fromisoformat(value).timestamp())
+
+
+def add_common_arguments(parser):
+    parser.add_argument('--url', default=settings.RABBIT_URL, help="rabbit url (defaults to the service settings)")
+    parser.add_argument('--queue', default=settings.RABBIT_QUARANTINE_QUEUE, help="queue to read from")
+    parser.add_argument('--prefetch', type=int, default=100, help="number of unacknowledged messages to hold")
+    parser.add_argument('--tx-id', action='append', dest='tx_ids', help="only select this tx_id (repeatable)")
+    parser.add_argument('--tx-id-file', help="file with one tx_id per line to select")
+    parser.add_argument('--since', type=_timestamp, help="only select messages quarantined at or after this ISO time")
+    parser.add_argument('--until', type=_timestamp, help="only select messages quarantined at or before this ISO time")
+    parser.add_argument('--idle-timeout', type=float, default=5,
+                        help="stop after this many seconds without a message")
+
+
+def filter_from_args(args):
+    tx_ids = list(args.tx_ids or [])
+    if args.tx_id_file:
+        with open(args.tx_id_file) as tx_id_file:
+            tx_ids.extend(line.strip() for line in tx_id_file if line.strip())
+    return HeaderFilter(tx_ids=tx_ids or None, since=args.since, until=args.until)
+
+
+def open_channel(url, prefetch):
+    connection = pika.BlockingConnection(pika.URLParameters(url))
+    channel = connection.channel()
+    channel.confirm_delivery()
+    channel.basic_qos(prefetch_count=prefetch)
+    return connection, channel
+
+
+def seen_this_run(properties, run_id):
+    return (properties.headers or {}).get(RUN_HEADER) == run_id
+
+
+def return_to_queue(channel, queue, method, properties, body, run_id):
+    """Moves a message to the back of its queue, acking the original once the broker has confirmed the copy."""
+    headers = dict(properties.headers or {})
+    headers[RUN_HEADER] = run_id
+    channel.basic_publish(exchange='',
+                          routing_key=queue,
+                          body=body,
+                          properties=pika.BasicProperties(headers=headers,
+                                                          timestamp=properties.timestamp,
+                                                          delivery_mode=2))
+    channel.basic_ack(method.delivery_tag)
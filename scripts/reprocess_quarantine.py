@@ -1,37 +1,126 @@
-from pika import BlockingConnection
-from pika import URLParameters
-from sdc.rabbit.publishers import QueuePublisher, PublishMessageError
-
-
-def reprocess():
-    # To use this script, fill in the credentials for rabbit.  They should be found in app/settings.py
-    rabbit_url = 'amqp://<user>:<pass>@<host>:<port>/%2f'
-    connection = BlockingConnection(URLParameters(rabbit_url))
-    channel = connection.channel()
-    method, properties, body = channel.basic_get('Seft.Responses.Quarantine')
-    if method:
+"""Moves quarantined messages back onto Seft.Responses so they are processed again.
+
+Each worker thread has its own connection, publishes with confirms and only acks the
+quarantined copy once the broker has confirmed the new one. Publishes are shared out
+through a token bucket so a large replay doesn't swamp the consumers.
+
+Messages that don't match the filters are moved to the back of the quarantine queue.
+
+    python -m scripts.reprocess_quarantine --limit 500 --rate 20 --concurrency 4
+"""
+import argparse
+import threading
+import time
+import uuid
+
+import pika
+from pika.exceptions import AMQPError, NackError, UnroutableError
+
+from app import create_and_wrap_logger
+from app import settings
+from app.ratelimit import TokenBucket
+from scripts.quarantine import RUN_HEADER, add_common_arguments, filter_from_args, open_channel, return_to_queue, seen_this_run
+
+logger = create_and_wrap_logger(__name__)
+
+
+class Reprocessor:
+
+    def __init__(self, args):
+        self.args = args
+        self.run_id = str(uuid.uuid4())
+        self.header_filter = filter_from_args(args)
+        self.bucket = TokenBucket(rate=args.rate, capacity=args.concurrency)
+        self.counts = {"moved": 0, "skipped": 0, "failed": 0}
+        self.claimed = 0
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+
+    def run(self):
+        started = time.monotonic()
+        workers = [threading.Thread(target=self._work, name="reprocess-{}".format(i)) for i in range(self.args.concurrency)]
+        for worker in workers:
+            worker.start()
+        while any(worker.is_alive() for worker in workers):
+            for worker in workers:
+                worker.join(timeout=5)
+            self._report("Reprocess progress", started)
+        self._report("Reprocess finished", started)
+        return self.counts
+
+    def _claim(self):
+        with self._lock:
+            if self.args.limit and self.claimed >= self.args.limit:
+                return False
+            self.claimed += 1
+            return True
+
+    def _count(self, outcome):
+        with self._lock:
+            self.counts[outcome] += 1
+
+    def _report(self, message, started):
+        with self._lock:
+            counts = dict(self.counts)
+        logger.info(message, rate=round(counts["moved"] / max(time.monotonic() - started, 0.001), 1), **counts)
+
+    def _work(self):
+        connection, channel = open_channel(self.args.url, self.args.prefetch)
+        try:
+            for method, properties, body in channel.consume(self.args.queue, inactivity_timeout=self.args.idle_timeout):
+                if method is None:
+                    break
+                if self._finished.is_set() or seen_this_run(properties, self.run_id):
+                    channel.basic_nack(method.delivery_tag, requeue=True)
+                    self._finished.set()
+                    break
+                if not self.header_filter.matches(properties):
+                    return_to_queue(channel, self.args.queue, method, properties, body, self.run_id)
+                    self._count("skipped")
+                    continue
+                if not self._claim():
+                    channel.basic_nack(method.delivery_tag, requeue=True)
+                    self._finished.set()
+                    break
+
+                self.bucket.acquire()
+                self._move(channel, method, properties, body)
+            channel.cancel()
+        except AMQPError:
+            logger.exception("Lost connection to rabbit, unacknowledged messages will be requeued")
+        finally:
+            if connection.is_open:
+                connection.close()
+
+    def _move(self, channel, method, properties, body):
+        headers = {key: value for key, value in (properties.headers or {}).items() if key != RUN_HEADER}
         try:
-            print("Recovered quarantine message")
-            print("Headers:")
-            print(properties.headers)
-
-            # Uncomment if extra information is needed (payload is encrypted so it's not likely to be useful)
-            # print("Body:")
-            # print(body)
-
-            publisher = QueuePublisher(urls=[rabbit_url],
-                                       queue='Seft.Responses')
-
-            publisher.publish_message(body, headers=properties.headers)
-            print("Message successfully reprocessed")
-
-            channel.basic_ack(method.delivery_tag)
-            print("Message ACK")
-        except PublishMessageError as e:
-            print(e)
-            channel.basic_nack(method.delivery_tag)
-    else:
-        print('No message found on quarantine queue')
+            channel.basic_publish(exchange='',
+                                  routing_key=self.args.target,
+                                  body=body,
+                                  properties=pika.BasicProperties(headers=headers, delivery_mode=2))
+        except (NackError, UnroutableError):
+            logger.error("Broker did not confirm reprocessed message", tx_id=headers.get('tx_id'))
+            channel.basic_nack(method.delivery_tag, requeue=True)
+            self._count("failed")
+            return
+        channel.basic_ack(method.delivery_tag)
+        self._count("moved")
+        logger.debug("Message reprocessed", tx_id=headers.get('tx_id'))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Move quarantined SEFT messages back for reprocessing")
+    add_common_arguments(parser)
+    parser.add_argument('--target', default=settings.RABBIT_QUEUE, help="queue to move messages to")
+    parser.add_argument('--limit', type=int, default=0, help="maximum number of messages to move (0 for all)")
+    parser.add_argument('--rate', type=float, default=10, help="maximum messages moved per second (0 for unlimited)")
+    parser.add_argument('--concurrency', type=int, default=2, help="number of connections moving messages")
+    return parser.parse_args(argv)
+
+
+def reprocess(argv=None):
+    return Reprocessor(parse_args(argv)).run()
 
 
 if __name__ == '__main__':
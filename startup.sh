@@ -1,2 +1,2 @@
 #!/bin/bash
-python3 -m app.main
+exec python3 -m app.main